@@ -0,0 +1,67 @@
+"""Пропускная способность: последовательная обработка обновлений против
+concurrent_updates с блокировками per_user.
+
+Каждое обновление имитирует обработчик с сетевой задержкой (редактирование
+сообщения в Telegram). Запуск: python benchmarks/concurrent_updates.py [игроки] [обновления] [задержка_мс]
+"""
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from gamecode_ru import per_user, user_locks  # noqa: E402
+
+def make_handler(latency: float, active: dict, violations: list):
+    async def handler(update, context):
+        uid = update.effective_user.id
+        # Проверяем, что обновления одного игрока не выполняются одновременно
+        if active.get(uid):
+            violations.append(uid)
+        active[uid] = True
+        await asyncio.sleep(latency)
+        active[uid] = False
+    return handler
+
+async def run(updates, handler, concurrent: bool) -> float:
+    start = time.perf_counter()
+    if concurrent:
+        # Как в Application: не больше 256 обновлений одновременно
+        limit = asyncio.Semaphore(256)
+
+        async def one(update):
+            async with limit:
+                await handler(update, None)
+
+        await asyncio.gather(*(one(u) for u in updates))
+    else:
+        for update in updates:
+            await handler(update, None)
+    return time.perf_counter() - start
+
+async def main() -> None:
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    per_player = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    latency = (float(sys.argv[3]) if len(sys.argv) > 3 else 20) / 1000
+
+    updates = [
+        SimpleNamespace(effective_user=SimpleNamespace(id=uid))
+        for _ in range(per_player) for uid in range(users)
+    ]
+    active, violations = {}, []
+    handler = per_user(make_handler(latency, active, violations))
+
+    seq = await run(updates, handler, concurrent=False)
+    conc = await run(updates, handler, concurrent=True)
+
+    total = len(updates)
+    print(f"updates:            {total} ({users} players x {per_player}), handler latency {latency * 1000:.0f} ms")
+    print(f"sequential:         {seq:8.2f} s  {total / seq:9.1f} updates/s")
+    print(f"concurrent+locks:   {conc:8.2f} s  {total / conc:9.1f} updates/s  (x{seq / conc:.1f})")
+    print(f"same-user overlaps: {len(violations)}")
+    print(f"locks still alive:  {len(user_locks)}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,112 @@
+"""Задержка «ход -> экран» в дуэли: две последовательные правки против render_duel.
+
+Игроки делают ходы каждые клик_мс, каждая правка сообщения занимает задержка_мс.
+Раньше обработчик ждал обе правки по очереди под блокировкой дуэли, и частые клики
+выстраивались в очередь. render_duel отправляет оба сообщения параллельно и
+склеивает правки, так что уходит только последнее состояние боя.
+Запуск: python benchmarks/duel_render.py [дуэли] [ходы] [задержка_мс] [клик_мс]
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from gamecode_ru import (  # noqa: E402
+    LockRegistry, build_pvp_actions_kb, flush_message_edits, format_pvp_battle_text,
+    get_coalesce_stats, render_duel, safe_edit_message_by_id,
+)
+
+class FakeBot:
+    """Вместо Bot API: правка занимает latency секунд, запоминаем, какой ход увидел игрок."""
+
+    def __init__(self, latency: float, turn_of_text: dict):
+        self.latency = latency
+        self.turn_of_text = turn_of_text
+        self.shown = {}  # ключ сообщения -> [(ход, время показа), ...]
+        self.calls = 0
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        self.shown.setdefault((chat_id, message_id), []).append((self.turn_of_text[text], time.perf_counter()))
+
+def make_duel(i: int) -> dict:
+    return {
+        "id": f"duel{i}", "p1_id": str(2 * i), "p2_id": str(2 * i + 1),
+        "p1_name": "Первый", "p2_name": "Второй",
+        "p1": {"hp": 100, "max_hp": 100}, "p2": {"hp": 100, "max_hp": 100},
+        "turn": "p1", "log": [],
+        "messages": {
+            "from": {"chat_id": 2 * i, "message_id": 1},
+            "to": {"chat_id": 2 * i + 1, "message_id": 1},
+        },
+    }
+
+async def sequential_render(bot, duel):
+    text = format_pvp_battle_text(duel)
+    msgs = duel["messages"]
+    is_p1_turn = duel["turn"] == "p1"
+    await safe_edit_message_by_id(bot, msgs["from"]["chat_id"], msgs["from"]["message_id"], text, reply_markup=build_pvp_actions_kb(duel["id"], is_p1_turn))
+    await safe_edit_message_by_id(bot, msgs["to"]["chat_id"], msgs["to"]["message_id"], text, reply_markup=build_pvp_actions_kb(duel["id"], not is_p1_turn))
+
+async def play(duel, turns: int, click: float, bot, coalesced: bool, locks, turn_times: list):
+    for turn in range(turns):
+        clicked = time.perf_counter()
+        async with locks.get(duel["id"]):
+            duel["log"].append(f"Ход {turn}")
+            duel["turn"] = "p2" if duel["turn"] == "p1" else "p1"
+            bot.turn_of_text[format_pvp_battle_text(duel)] = turn
+            turn_times.append((duel, turn, clicked))
+            if coalesced:
+                render_duel(bot, duel)
+            else:
+                await sequential_render(bot, duel)
+        await asyncio.sleep(click)
+
+async def run(duels: int, turns: int, latency: float, click: float, coalesced: bool):
+    bot = FakeBot(latency, {})
+    locks = LockRegistry()
+    turn_times: list = []
+    states = [make_duel(i) for i in range(duels)]
+    start = time.perf_counter()
+    await asyncio.gather(*(play(d, turns, click, bot, coalesced, locks, turn_times) for d in states))
+    await flush_message_edits()
+    elapsed = time.perf_counter() - start
+
+    # Ход на экране, когда оба сообщения показывают его или более поздний
+    latencies = []
+    for duel, turn, clicked in turn_times:
+        shown_at = [
+            min((at for shown_turn, at in bot.shown[(m["chat_id"], m["message_id"])] if shown_turn >= turn), default=None)
+            for m in duel["messages"].values()
+        ]
+        if None not in shown_at:
+            latencies.append(max(shown_at) - clicked)
+    return elapsed, bot.calls, latencies
+
+def summary(latencies: list) -> str:
+    latencies = sorted(latencies)
+    if not latencies:
+        return "n/a"
+    p50 = latencies[len(latencies) // 2] * 1000
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000
+    return f"p50 {p50:7.1f} ms  p95 {p95:7.1f} ms"
+
+async def main() -> None:
+    duels = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    turns = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    latency = (float(sys.argv[3]) if len(sys.argv) > 3 else 80) / 1000
+    click = (float(sys.argv[4]) if len(sys.argv) > 4 else 30) / 1000
+
+    seq_time, seq_calls, seq_lat = await run(duels, turns, latency, click, coalesced=False)
+    par_time, par_calls, par_lat = await run(duels, turns, latency, click, coalesced=True)
+
+    print(f"duels:       {duels} x {turns} turns, edit latency {latency * 1000:.0f} ms, click every {click * 1000:.0f} ms")
+    print(f"sequential:  {seq_time:6.2f} s  {seq_calls:6d} edits  turn->screen {summary(seq_lat)}")
+    print(f"render_duel: {par_time:6.2f} s  {par_calls:6d} edits  turn->screen {summary(par_lat)}")
+    print(f"coalescing:  {get_coalesce_stats()}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
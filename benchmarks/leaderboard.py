@@ -0,0 +1,66 @@
+"""Рейтинг на миллионе игроков: Leaderboard (SortedList) против сортировки всех игроков.
+
+Меряем построение, поток обновлений (изменение золота), топ-10 и «моё место».
+Запуск из корня репозитория: python benchmarks/leaderboard.py [игроки] [обновления]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from gamecode_ru import Leaderboard  # noqa: E402
+
+def per_op_us(elapsed: float, count: int) -> str:
+    return f"{elapsed / count * 1e6:8.2f} us/op"
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    updates = int(sys.argv[2]) if len(sys.argv) > 2 else 200_000
+    rng = random.Random(1)
+    gold = {str(uid): rng.randint(0, 100_000) for uid in range(count)}
+    uids = list(gold)
+
+    board = Leaderboard()
+    started = time.perf_counter()
+    for uid, value in gold.items():
+        board.update(uid, value)
+    build = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _ in range(updates):
+        uid = rng.choice(uids)
+        gold[uid] += rng.randint(-50, 200)
+        board.update(uid, gold[uid])
+    update = time.perf_counter() - started
+
+    queries = 10_000
+    started = time.perf_counter()
+    for _ in range(queries):
+        board.top(10)
+    top = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _ in range(queries):
+        board.rank(rng.choice(uids))
+    rank = time.perf_counter() - started
+
+    # Наивный вариант: каждый запрос сортирует всех игроков
+    started = time.perf_counter()
+    ordered = sorted(gold, key=gold.get, reverse=True)
+    naive_top = time.perf_counter() - started
+    me = rng.choice(uids)
+    started = time.perf_counter()
+    ordered.index(me)
+    naive_rank = time.perf_counter() - started + naive_top
+
+    print(f"players:       {count}")
+    print(f"build:         {build:8.2f} s")
+    print(f"update:        {per_op_us(update, updates)}  ({updates} updates)")
+    print(f"top-10:        {per_op_us(top, queries)}   sorted(): {naive_top * 1e6:12.0f} us/op")
+    print(f"my rank:       {per_op_us(rank, queries)}   sorted()+index: {naive_rank * 1e6:6.0f} us/op")
+    assert board.top(1)[0][1] == gold[ordered[0]]
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Память и скорость доступа: 100 000 игроков словарями и объектами Player.
+
+Записи в текущей схеме: около 3,5 КБ на игрока словарями против 1,5 КБ объектами Player.
+
+Запуск из корня репозитория: python benchmarks/player_memory.py [количество]
+"""
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from gamecode_ru import ITEM_IDS, Player, SCHEMA_VERSION  # noqa: E402
+
+def sample_record(i: int) -> str:
+    # Запись в текущей схеме: инвентарь по ID предметов, время действий в timers
+    return json.dumps({
+        "uid": str(i), "v": SCHEMA_VERSION, "name": f"Игрок {i}", "class": "⚔️ Воин",
+        "level": 1 + i % 50, "xp": i % 100, "hp": 100, "max_hp": 120, "attack": 7, "defense": 4,
+        "gold": i % 5000, "inventory": {str(ITEM_IDS["Малое зелье лечения"]): 2}, "quests": {},
+        "achievements": {}, "pets": [], "clan": None, "equipment": {}, "luck": 0,
+        "daily_reward_claimed": False, "daily_streak": 0, "pvp_wins": 0, "pvp_losses": 0,
+        "businesses": {}, "timers": {"adventure": 1_760_000_000.0 + i}, "casino_history": [],
+        "counters": {}, "quest_archive": [],
+    }, ensure_ascii=False)
+
+def measure(build, count: int):
+    lines = [sample_record(i) for i in range(count)]
+    tracemalloc.start()
+    records = [build(json.loads(line)) for line in lines]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return records, size
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    dicts, dict_size = measure(lambda d: d, count)
+    objects, obj_size = measure(Player.from_dict, count)
+
+    start = time.perf_counter()
+    total = sum(p["attack"] + p["defense"] + p["hp"] for p in dicts)
+    dict_ms = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    total2 = sum(p.attack + p.defense + p.hp for p in objects)
+    obj_ms = (time.perf_counter() - start) * 1000
+    assert total == total2
+
+    print(f"players:          {count}")
+    print(f"dict records:     {dict_size / 2**20:8.1f} MiB  ({dict_size / count:.0f} B/player)")
+    print(f"Player records:   {obj_size / 2**20:8.1f} MiB  ({obj_size / count:.0f} B/player)")
+    print(f"saved:            {(1 - obj_size / dict_size) * 100:8.1f} %")
+    print(f"stat reads, dict: {dict_ms:8.1f} ms")
+    print(f"stat reads, slot: {obj_ms:8.1f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Брошенные вызовы на дуэль: растёт ли память, если на вызовы никто не отвечает.
+
+Каждую волну создаётся пачка вызовов, на которые никто не отвечает; колесо таймеров
+снимает их через ttl и правит оба сообщения. Без таймеров pvp_requests рос бы на
+каждый вызов, с таймерами число живых вызовов и память держатся на уровне «вызовы за ttl».
+Запуск: python benchmarks/pvp_expiry.py [вызовов_в_волне] [волн] [ttl_с] [пауза_мс]
+"""
+import asyncio
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import gamecode_ru as game  # noqa: E402
+
+class FakeBot:
+    """Вместо Bot API: правки считаются и сразу завершаются."""
+
+    def __init__(self):
+        self.edits = 0
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        self.edits += 1
+
+class FakeApp:
+    def __init__(self):
+        self.bot = FakeBot()
+
+def challenge(i: int, ttl: float) -> None:
+    # То же, что делает pvp_challenge_cmd после отправки обоих сообщений
+    duel_id = f"{2 * i}_{2 * i + 1}_0"
+    game.pvp_requests[duel_id] = {
+        "from_id": str(2 * i), "to_id": str(2 * i + 1), "status": "pending",
+        "messages": {"from": {"chat_id": 2 * i, "message_id": 1}, "to": {"chat_id": 2 * i + 1, "message_id": 1}},
+    }
+    game.timers.schedule(duel_id, ttl, game.expire_duel)
+
+def memory_kb() -> float:
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0] / 1024
+
+async def main() -> None:
+    per_wave = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    waves = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    ttl = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+    pause = (float(sys.argv[4]) if len(sys.argv) > 4 else 250) / 1000
+
+    game.timers.tick = 0.05
+    app = FakeApp()
+    tracemalloc.start()
+    baseline = memory_kb()
+    loop = asyncio.create_task(game.timer_loop(app))
+
+    print(f"{'wave':>5} {'created':>8} {'pending':>8} {'timers':>7} {'memory':>10}")
+    created = 0
+    peak = 0
+    started = time.perf_counter()
+    for wave in range(waves):
+        for _ in range(per_wave):
+            challenge(created, ttl)
+            created += 1
+        await asyncio.sleep(pause)
+        peak = max(peak, len(game.pvp_requests))
+        print(f"{wave:5d} {created:8d} {len(game.pvp_requests):8d} {len(game.timers):7d} {memory_kb() - baseline:8.0f} KB")
+
+    await asyncio.sleep(ttl + 2 * game.timers.tick)
+    await game.flush_message_edits()
+    loop.cancel()
+    elapsed = time.perf_counter() - started
+
+    print(f"created:     {created} challenges in {elapsed:.1f} s, peak pending {peak}")
+    print(f"after ttl:   {len(game.pvp_requests)} pending, {len(game.timers)} timers, {app.bot.edits} edits, "
+          f"{memory_kb() - baseline:.0f} KB above baseline")
+    print(f"timers:      {game.get_timer_stats()}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,22 +1,42 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import functools
+import heapq
+import itertools
 import json
-from datetime import datetime, timedelta
+import keyword
+import logging
+from datetime import datetime
 import os
+import queue
 import random
-from typing import Dict, Any, Optional, List
-
+import sqlite3
+import sys
+import threading
+import time
+import urllib.parse
+import weakref
+import zlib
+from collections import OrderedDict
+from typing import Dict, Any, Optional, List, Set
+
+from sortedcontainers import SortedList
 from telegram import (
     Update, ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton
 )
-from telegram.error import BadRequest
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, MessageHandler,
+    ApplicationBuilder, BaseRateLimiter, CommandHandler, MessageHandler,
     CallbackQueryHandler, ContextTypes, filters
 )
 
 DATA_FILE = "game_data.json"
+CLANS_FILE = "clans_data.json"
+
+logger = logging.getLogger(__name__)
 
 # Хранилище игроков: key = str(user_id), value = dict
+# После load_players() — PlayerRepository с загрузкой по требованию
 players: Dict[str, Dict[str, Any]] = {}
 
 # Хранилище кланов: key = str(clan_name), value = dict
@@ -41,34 +61,185 @@ MAIN_KB = ReplyKeyboardMarkup(
 
 # ----------------------------- Безопасные помощники редактирования сообщений -----------------------------
 
-async def safe_edit_message_text(query, text: str, parse_mode: Optional[str] = None, reply_markup: Optional[InlineKeyboardMarkup] = None):
-    """Безопасно редактирует текст сообщения. Игнорирует ошибку 'Message is not modified'."""
-    try:
-        await query.edit_message_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
-    except BadRequest as exc:
-        # Сообщение не менялось — просто игнорируем, чтобы не падать
-        if "Message is not modified" in str(exc):
+# Правки повторяются при RetryAfter (ждём столько, сколько просит Telegram) и при
+# TimedOut/NetworkError (экспоненциальная задержка со случайным разбросом). Правка
+# одного сообщения повторяется, только пока она последняя: если тем временем это
+# сообщение отредактировали снова, старая правка отбрасывается. После SEND_RETRIES
+# неудачных повторов ошибка пишется в лог, а обработчик продолжает работу.
+
+SEND_RETRIES = int(os.getenv("SEND_RETRIES", "4"))
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 10.0
+
+retry_stats = {"retries": 0, "retry_after": 0, "timeouts": 0, "network_errors": 0, "superseded": 0, "failed": 0}
+
+# Ключ сообщения -> номер последней правки
+_edit_generations: Dict[Any, int] = {}
+_edit_counter = itertools.count(1)
+
+# Последнее отправленное содержимое сообщений: ключ сообщения -> хеш текста и клавиатуры.
+# Повторная отрисовка того же экрана (обновить, назад) не идёт в Bot API вовсе.
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "10000"))
+_rendered: "OrderedDict[Any, int]" = OrderedDict()
+render_stats = {"hits": 0, "misses": 0}
+
+def _render_fingerprint(text: str, parse_mode: Optional[str], reply_markup: Optional[InlineKeyboardMarkup]) -> int:
+    return hash((text, parse_mode, reply_markup.to_json() if reply_markup is not None else None))
+
+def _remember_render(key: Any, fingerprint: int) -> None:
+    _rendered[key] = fingerprint
+    _rendered.move_to_end(key)
+    if len(_rendered) > RENDER_CACHE_SIZE:
+        _rendered.popitem(last=False)
+
+def get_render_stats() -> Dict[str, Any]:
+    stats = dict(render_stats)
+    total = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / total if total else 0.0
+    stats["size"] = len(_rendered)
+    return stats
+
+async def _edit_with_retry(key: Any, edit, fingerprint: Optional[int] = None) -> None:
+    """Выполняет edit() с повторами. Ошибки BadRequest (кроме 'not modified') пробрасываются.
+
+    fingerprint — хеш нового содержимого: если сообщение уже выглядит так, запрос не отправляется."""
+    if fingerprint is not None:
+        if _rendered.get(key) == fingerprint:
+            render_stats["hits"] += 1
+            _rendered.move_to_end(key)
             return
-        # Пробрасываем остальные ошибки
-        raise
+        render_stats["misses"] += 1
+        # Пока правка не подтверждена, содержимое сообщения неизвестно
+        _rendered.pop(key, None)
+    generation = next(_edit_counter)
+    _edit_generations[key] = generation
+    try:
+        for attempt in range(SEND_RETRIES + 1):
+            try:
+                await edit()
+                if fingerprint is not None and _edit_generations.get(key) == generation:
+                    _remember_render(key, fingerprint)
+                return
+            except BadRequest as exc:
+                # BadRequest — подкласс NetworkError, повторять его бессмысленно.
+                # Сообщение не менялось — просто игнорируем, чтобы не падать
+                if "Message is not modified" in str(exc):
+                    if fingerprint is not None and _edit_generations.get(key) == generation:
+                        _remember_render(key, fingerprint)
+                    return
+                raise
+            except RetryAfter as exc:
+                retry_stats["retry_after"] += 1
+                delay = float(exc.retry_after) + random.uniform(0, 0.5)
+            except TimedOut:
+                retry_stats["timeouts"] += 1
+                delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1.0)
+            except NetworkError:
+                retry_stats["network_errors"] += 1
+                delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1.0)
+            if attempt == SEND_RETRIES:
+                break
+            await asyncio.sleep(delay)
+            if _edit_generations.get(key) != generation:
+                # Сообщение уже отредактировано более новой правкой
+                retry_stats["superseded"] += 1
+                return
+            retry_stats["retries"] += 1
+        retry_stats["failed"] += 1
+        logger.warning("Не удалось отредактировать сообщение %s за %d попыток", key, SEND_RETRIES + 1)
+    finally:
+        if _edit_generations.get(key) == generation:
+            del _edit_generations[key]
+
+def _query_message_key(query) -> Any:
+    if query.message is not None:
+        return (query.message.chat_id, query.message.message_id)
+    return query.inline_message_id
+
+async def safe_edit_message_text(query, text: str, parse_mode: Optional[str] = None, reply_markup: Optional[InlineKeyboardMarkup] = None):
+    """Безопасно редактирует текст сообщения: повторяет при флуд-лимите и сетевых ошибках,
+    игнорирует ошибку 'Message is not modified'."""
+    await _edit_with_retry(
+        _query_message_key(query),
+        lambda: query.edit_message_text(text, parse_mode=parse_mode, reply_markup=reply_markup),
+        _render_fingerprint(text, parse_mode, reply_markup)
+    )
 
 async def safe_edit_message_reply_markup(query, reply_markup: Optional[InlineKeyboardMarkup] = None):
-    """Безопасно редактирует inline-клавиатуру сообщения. Игнорирует ошибку 'Message is not modified'."""
-    try:
-        await query.edit_message_reply_markup(reply_markup=reply_markup)
-    except BadRequest as exc:
-        if "Message is not modified" in str(exc):
-            return
-        raise
+    """Безопасно редактирует inline-клавиатуру сообщения (с повторами, как safe_edit_message_text)."""
+    # Запомненное содержимое сообщения больше не совпадает с тем, что видит игрок
+    _rendered.pop(_query_message_key(query), None)
+    await _edit_with_retry(
+        (_query_message_key(query), "markup"),
+        lambda: query.edit_message_reply_markup(reply_markup=reply_markup)
+    )
+
+async def safe_edit_message_by_id(bot, chat_id: int, message_id: int, text: str, parse_mode: Optional[str] = None, reply_markup: Optional[InlineKeyboardMarkup] = None, priority: Optional[int] = None):
+    """Безопасно редактирует сообщение по chat_id/message_id (с повторами, как safe_edit_message_text).
 
-async def safe_edit_message_by_id(bot, chat_id: int, message_id: int, text: str, parse_mode: Optional[str] = None, reply_markup: Optional[InlineKeyboardMarkup] = None):
-    """Безопасно редактирует сообщение по chat_id/message_id, игнорируя 'Message is not modified'."""
+    priority — приоритет в очереди исходящих запросов (PRIORITY_*), по умолчанию как у правок."""
+    await _edit_with_retry(
+        (chat_id, message_id),
+        lambda: bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, parse_mode=parse_mode, reply_markup=reply_markup, rate_limit_args=priority),
+        _render_fingerprint(text, parse_mode, reply_markup)
+    )
+
+# Склеивание правок одного сообщения. Пока правка сообщения в полёте (ждёт очереди
+# исходящих запросов или повтора после RetryAfter), новые правки не встают за ней в
+# очередь: запоминается только последняя, и после текущей уходит именно она.
+# Правки разных сообщений отправляются параллельно.
+
+# Ключ сообщения -> (chat_id, message_id, text, parse_mode, reply_markup, priority), время первой постановки
+_pending_edits: Dict[Any, tuple] = {}
+# Ключ сообщения -> задача, которая отправляет его правки
+_edit_drains: Dict[Any, asyncio.Task] = {}
+
+coalesce_stats = {"queued": 0, "coalesced": 0, "sent": 0, "latency_total_ms": 0.0, "latency_max_ms": 0.0}
+
+def queue_message_edit(bot, chat_id: int, message_id: int, text: str, parse_mode: Optional[str] = None, reply_markup: Optional[InlineKeyboardMarkup] = None, priority: Optional[int] = None) -> asyncio.Task:
+    """Ставит правку сообщения в очередь, заменяя ещё не отправленную. Возвращает задачу отправки."""
+    key = (chat_id, message_id)
+    coalesce_stats["queued"] += 1
+    pending = _pending_edits.get(key)
+    if pending is not None:
+        # Промежуточное состояние игрок так и не увидит — время считаем от первого клика
+        coalesce_stats["coalesced"] += 1
+        queued_at = pending[1]
+    else:
+        queued_at = time.perf_counter()
+    _pending_edits[key] = ((chat_id, message_id, text, parse_mode, reply_markup, priority), queued_at)
+    drain = _edit_drains.get(key)
+    if drain is None or drain.done():
+        drain = _edit_drains[key] = asyncio.create_task(_drain_message_edits(bot, key))
+    return drain
+
+async def _drain_message_edits(bot, key: Any) -> None:
     try:
-        await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, parse_mode=parse_mode, reply_markup=reply_markup)
-    except BadRequest as exc:
-        if "Message is not modified" in str(exc):
-            return
-        raise
+        while key in _pending_edits:
+            args, queued_at = _pending_edits.pop(key)
+            try:
+                await safe_edit_message_by_id(bot, *args)
+            except Exception:
+                logger.exception("Не удалось отредактировать сообщение %s", key)
+                continue
+            latency_ms = (time.perf_counter() - queued_at) * 1000
+            coalesce_stats["sent"] += 1
+            coalesce_stats["latency_total_ms"] += latency_ms
+            coalesce_stats["latency_max_ms"] = max(coalesce_stats["latency_max_ms"], latency_ms)
+    finally:
+        if _edit_drains.get(key) is asyncio.current_task():
+            del _edit_drains[key]
+
+async def flush_message_edits() -> None:
+    """Дожидается отправки всех поставленных в очередь правок."""
+    while _edit_drains:
+        await asyncio.gather(*list(_edit_drains.values()), return_exceptions=True)
+
+def get_coalesce_stats() -> Dict[str, Any]:
+    stats = dict(coalesce_stats)
+    stats["latency_avg_ms"] = stats["latency_total_ms"] / stats["sent"] if stats["sent"] else 0.0
+    stats["pending"] = len(_pending_edits)
+    return stats
 
 # Базовые параметры классов
 CLASS_STATS = {
@@ -79,23 +250,41 @@ CLASS_STATS = {
 
 # Расширенный магазин
 SHOP_ITEMS = {
-    "Малое зелье лечения": {"price": 15, "type": "consumable", "effect": {"heal": 35}, "emoji": "🧪"},
-    "Большое зелье лечения": {"price": 35, "type": "consumable", "effect": {"heal": 70}, "emoji": "🔮"},
-    "Руна силы": {"price": 30, "type": "consumable", "effect": {"attack_plus": 1}, "emoji": "⚡"},
-    "Кожаная броня": {"price": 30, "type": "consumable", "effect": {"defense_plus": 1}, "emoji": "🛡️"},
-    "Эликсир удачи": {"price": 50, "type": "consumable", "effect": {"luck_plus": 1}, "emoji": "🍀"},
-    "Свиток телепортации": {"price": 25, "type": "consumable", "effect": {"escape": True}, "emoji": "📜"},
-    "Амулет защиты": {"price": 100, "type": "equipment", "effect": {"defense_plus": 2}, "emoji": "🔮"},
-    "Меч дракона": {"price": 200, "type": "equipment", "effect": {"attack_plus": 3}, "emoji": "⚔️"},
+    "Малое зелье лечения": {"id": 1, "price": 15, "type": "consumable", "effect": {"heal": 35}, "emoji": "🧪"},
+    "Большое зелье лечения": {"id": 2, "price": 35, "type": "consumable", "effect": {"heal": 70}, "emoji": "🔮"},
+    "Руна силы": {"id": 3, "price": 30, "type": "consumable", "effect": {"attack_plus": 1}, "emoji": "⚡"},
+    "Кожаная броня": {"id": 4, "price": 30, "type": "consumable", "effect": {"defense_plus": 1}, "emoji": "🛡️"},
+    "Эликсир удачи": {"id": 5, "price": 50, "type": "consumable", "effect": {"luck_plus": 1}, "emoji": "🍀"},
+    "Свиток телепортации": {"id": 6, "price": 25, "type": "consumable", "effect": {"escape": True}, "emoji": "📜"},
+    "Амулет защиты": {"id": 7, "price": 100, "type": "equipment", "effect": {"defense_plus": 2}, "emoji": "🔮"},
+    "Меч дракона": {"id": 8, "price": 200, "type": "equipment", "effect": {"attack_plus": 3}, "emoji": "⚔️"},
     # Питомцы в магазине
-    "🐱 Кот": {"price": 150, "type": "pet", "pet_id": "cat", "emoji": "🐱"},
-    "🐰 Кролик": {"price": 200, "type": "pet", "pet_id": "rabbit", "emoji": "🐰"},
-    "🦉 Сова": {"price": 300, "type": "pet", "pet_id": "owl", "emoji": "🦉"},
-    "🐺 Волк": {"price": 400, "type": "pet", "pet_id": "wolf", "emoji": "🐺"},
-    "🦅 Феникс": {"price": 800, "type": "pet", "pet_id": "phoenix", "emoji": "🦅"},
-    "🐉 Дракон": {"price": 1000, "type": "pet", "pet_id": "dragon", "emoji": "🐉"},
+    "🐱 Кот": {"id": 9, "price": 150, "type": "pet", "pet_id": "cat", "emoji": "🐱"},
+    "🐰 Кролик": {"id": 10, "price": 200, "type": "pet", "pet_id": "rabbit", "emoji": "🐰"},
+    "🦉 Сова": {"id": 11, "price": 300, "type": "pet", "pet_id": "owl", "emoji": "🦉"},
+    "🐺 Волк": {"id": 12, "price": 400, "type": "pet", "pet_id": "wolf", "emoji": "🐺"},
+    "🦅 Феникс": {"id": 13, "price": 800, "type": "pet", "pet_id": "phoenix", "emoji": "🦅"},
+    "🐉 Дракон": {"id": 14, "price": 1000, "type": "pet", "pet_id": "dragon", "emoji": "🐉"},
 }
 
+# Реестр предметов: в инвентарях и callback_data хранится короткий числовой "id" из
+# SHOP_ITEMS, а название подставляется только при выводе. ID не переиспользуются:
+# новому предмету — следующий свободный номер.
+ITEM_NAMES: Dict[int, str] = {meta["id"]: name for name, meta in SHOP_ITEMS.items()}
+ITEM_IDS: Dict[str, int] = {name: item_id for item_id, name in ITEM_NAMES.items()}
+
+def item_id(item: Any) -> Optional[int]:
+    """ID предмета по ID, названию или строке из callback_data."""
+    if isinstance(item, int):
+        return item if item in ITEM_NAMES else None
+    if item.isdigit():
+        return item_id(int(item))
+    return ITEM_IDS.get(item)
+
+def item_name(item: Any) -> str:
+    """Название предмета для вывода."""
+    return ITEM_NAMES.get(item, str(item))
+
 # Расширенные игры казино
 CASINO_GAMES = {
     "double": {"name": "🎯 Удвоение", "multiplier": 2, "win_chance": 0.45, "min_bet": 5, "emoji": "🎯"},
@@ -241,72 +430,1473 @@ def generate_random_quest(player_level: int) -> Dict[str, Any]:
 
 def load_players() -> None:
     global players
-    if os.path.exists(DATA_FILE):
+    if storage.lazy:
+        # Игроки подгружаются при первом обращении, в памяти — только активные
+        storage.convert_legacy_players()
+        players = PlayerRepository(storage, PLAYER_CACHE_SIZE)
+    else:
+        players = PlayerRepository(storage, None, storage.load_players())
+    
+    # Доигрываем журнал изменений, не попавших в последний снимок.
+    # Старые записи игроков не переписываются при старте: в режиме json они обновляются
+    # до SCHEMA_VERSION в памяти при загрузке, в остальных — при первом обращении
+    # (см. upgrade_player), а на диск попадают с ближайшим изменением игрока
+    replay_journal(players)
+
+# ----------------------------- Модель игрока и клана -----------------------------
+#
+# Игроки и кланы хранятся в памяти не словарями, а объектами со __slots__: имена полей
+# не дублируются в каждой записи, а горячие пути (бой, характеристики) читают атрибуты
+# напрямую (player.attack). Для остального кода запись ведёт себя как словарь
+# (player["gold"], "pets" in player, player.get(...)), поэтому формат JSON не меняется.
+# Неизвестные поля (например, из более новой версии) сохраняются в record.extra.
+
+PLAYER_FIELDS = (
+    "uid", "v", "name", "class", "level", "xp", "hp", "max_hp", "attack", "defense", "gold",
+    "inventory", "quests", "achievements", "pets", "clan", "equipment", "luck",
+    "daily_reward_claimed", "daily_streak", "pvp_wins", "pvp_losses", "businesses", "timers",
+    "casino_history", "counters", "quest_archive",
+)
+CLAN_FIELDS = ("name", "leader", "members", "level", "xp", "created", "description", "color")
+
+def _slot_names(fields) -> tuple:
+    # "class" — ключевое слово, атрибут называется class_
+    return tuple(f + "_" if keyword.iskeyword(f) else f for f in fields)
+
+class Record:
+    """Запись со слотами и интерфейсом словаря. Отсутствующее поле — незаполненный слот."""
+
+    __slots__ = ("extra",)
+    FIELDS: tuple = ()
+    # Поле -> функция, восстанавливающая значение после JSON (например, числовые ключи)
+    DECODERS: Dict[str, Any] = {}
+    # Поле -> функция, превращающая значение обратно в JSON-совместимое
+    ENCODERS: Dict[str, Any] = {}
+    _slots: Dict[str, str] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._slots = dict(zip(cls.FIELDS, _slot_names(cls.FIELDS)))
+
+    def __init__(self, data: Optional[Dict[str, Any]] = None):
+        self.extra = None
+        if data:
+            self.update(data)
+
+    @classmethod
+    def decode(cls, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Поля записи, прочитанные из JSON, в том виде, в каком они живут в памяти."""
+        if not any(key in data for key in cls.DECODERS):
+            return data
+        return {key: cls.DECODERS[key](value) if key in cls.DECODERS else value for key, value in data.items()}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Record":
+        return data if isinstance(data, cls) else cls(cls.decode(data))
+
+    def to_dict(self) -> Dict[str, Any]:
+        if not self.ENCODERS:
+            return {key: self[key] for key in self}
+        return {key: self.ENCODERS[key](self[key]) if key in self.ENCODERS else self[key] for key in self}
+
+    def __getitem__(self, key: str) -> Any:
+        slot = self._slots.get(key)
+        if slot is not None:
+            try:
+                return getattr(self, slot)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        slot = self._slots.get(key)
+        if slot is not None:
+            setattr(self, slot, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        slot = self._slots.get(key)
+        if slot is not None:
+            try:
+                delattr(self, slot)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self.extra is None:
+            raise KeyError(key)
+        else:
+            del self.extra[key]
+
+    def __contains__(self, key: str) -> bool:
+        slot = self._slots.get(key)
+        if slot is not None:
+            return hasattr(self, slot)
+        return self.extra is not None and key in self.extra
+
+    def __iter__(self):
+        for key, slot in self._slots.items():
+            if hasattr(self, slot):
+                yield key
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+    def get(self, key: str, default: Any = None) -> Any:
         try:
-            with open(DATA_FILE, "r", encoding="utf-8") as f:
-                players = json.load(f)
-        except Exception:
-            players = {}
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            self[key] = default
+            return default
+
+    def pop(self, key: str, *default: Any) -> Any:
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def keys(self) -> List[str]:
+        return list(self)
+
+    def items(self) -> List[tuple]:
+        return [(key, self[key]) for key in self]
+
+    def update(self, data: Dict[str, Any]) -> None:
+        for key, value in data.items():
+            self[key] = value
+
+def _decode_inventory(inventory: Dict[Any, int]) -> Dict[Any, int]:
+    # JSON хранит ключи строками: "1" -> 1
+    return {int(k) if isinstance(k, str) and k.isdigit() else k: v for k, v in inventory.items()}
+
+class Player(Record):
+    # Кэши, которые на диск не пишутся: _stats — характеристики с бонусами
+    # (get_derived_stats), _quest_index — активные квесты по target_type (quest_index),
+    # _income — доход бизнесов (get_business_income_info).
+    # __weakref__ — для выгруженных, но ещё используемых игроков (PlayerRepository)
+    __slots__ = _slot_names(PLAYER_FIELDS) + ("_stats", "_quest_index", "_income", "__weakref__")
+    FIELDS = PLAYER_FIELDS
+    DECODERS = {"inventory": _decode_inventory}
+
+def _decode_members(members: List[str]) -> Dict[str, None]:
+    # Участники — упорядоченное множество: dict хранит порядок вступления,
+    # а проверка, добавление и удаление стоят O(1). На диск пишется списком.
+    return dict.fromkeys(members)
+
+class Clan(Record):
+    __slots__ = _slot_names(CLAN_FIELDS)
+    FIELDS = CLAN_FIELDS
+    DECODERS = {"members": _decode_members}
+    ENCODERS = {"members": list}
+
+# ----------------------------- Версии схемы игрока -----------------------------
+#
+# Каждая запись игрока хранит номер схемы в поле "v" (записи без него — версия 0).
+# MIGRATIONS[n] переводит запись из версии n в n + 1. Репозиторий игроков применяет
+# недостающие шаги, когда игрок загружается или впервые запрашивается, а обновлённая
+# запись попадает на диск вместе с ближайшим изменением этого игрока.
+# Для переписывания всего хранилища сразу: python gamecode_ru.py --migrate
+
+def _migrate_v0(player: Dict[str, Any]) -> None:
+    """Добавляет поля, появившиеся до введения версий схемы."""
+    if "pets" not in player:
+        player["pets"] = []
+    if "achievements" not in player:
+        player["achievements"] = {}
+    if "clan" not in player:
+        player["clan"] = None
+    if "daily_streak" not in player:
+        player["daily_streak"] = 0
+    if "last_daily_reward" not in player:
+        player["last_daily_reward"] = None
+    if "pvp_wins" not in player:
+        player["pvp_wins"] = 0
+    if "pvp_losses" not in player:
+        player["pvp_losses"] = 0
+    if "luck" not in player:
+        player["luck"] = 0
+    if "equipment" not in player:
+        player["equipment"] = {}
+    if "businesses" not in player:
+        player["businesses"] = {}
+    if "last_business_claim" not in player:
+        player["last_business_claim"] = None
+
+def _migrate_v1(player: Dict[str, Any]) -> None:
+    """Инвентарь: названия предметов заменяются их ID из реестра."""
+    inventory = {}
+    for item, count in player.get("inventory", {}).items():
+        key = item_id(item)
+        key = item if key is None else key
+        inventory[key] = inventory.get(key, 0) + count
+    player["inventory"] = inventory
+
+# Поля с датами ISO, заменённые таймерами в секундах эпохи
+_LEGACY_TIMERS = {"last_daily_reward": "daily", "last_casino_play": "casino", "last_business_claim": "biz_claim"}
+
+def _migrate_v2(player: Dict[str, Any]) -> None:
+    """Даты последних действий (строки ISO) переезжают в player["timers"]."""
+    timers = player.setdefault("timers", {})
+    for field, action in _LEGACY_TIMERS.items():
+        value = player.pop(field, None)
+        if value:
+            timers[action] = datetime.fromisoformat(value).timestamp()
+
+def _migrate_v3(player: Dict[str, Any]) -> None:
+    """Счётчики для достижений собираются в player["counters"]."""
+    # Оба старых счётчика считали победы в казино и переставали расти после своего достижения
+    wins = max(player.pop("casino_wins_streak", 0) or 0, player.pop("casino_total_wins", 0) or 0)
+    player["counters"] = {
+        "kills": 1 if "first_blood" in player.get("achievements", {}) else 0,
+        "casino_wins": wins,
+        "quests_completed": sum(1 for q in player.get("quests", {}).values() if q.get("status") == "completed"),
+    }
+
+# Сколько последних выполненных квестов хранить; общее число — в counters["quests_completed"]
+QUEST_ARCHIVE_SIZE = int(os.getenv("QUEST_ARCHIVE_SIZE", "50"))
+
+def _migrate_v4(player: Dict[str, Any]) -> None:
+    """Выполненные квесты переезжают из player["quests"] в компактный архив."""
+    quests = player.get("quests", {})
+    archive = player.setdefault("quest_archive", [])
+    for quest_id, quest in list(quests.items()):
+        if quest.get("status") == "completed":
+            archive.append({"id": quest_id, "title": quest.get("title", "Без названия"), "t": None})
+            del quests[quest_id]
+    del archive[:-QUEST_ARCHIVE_SIZE]
+
+MIGRATIONS = [_migrate_v0, _migrate_v1, _migrate_v2, _migrate_v3, _migrate_v4]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def upgrade_player(player_id: str, player: Dict[str, Any]) -> bool:
+    """Доводит запись игрока до SCHEMA_VERSION. Возвращает True, если запись изменилась."""
+    # Идентификатор нужен отложенному сохранению, чтобы помечать игрока изменённым
+    player["uid"] = player_id
+    version = player.get("v", 0)
+    if version >= SCHEMA_VERSION:
+        return False
+    for step in MIGRATIONS[version:]:
+        step(player)
+    player["v"] = SCHEMA_VERSION
+    return True
+
+def migrate_storage() -> int:
+    """Офлайн-миграция: обновляет и перезаписывает всех игроков хранилища.
+
+    Запускать при остановленном боте. Возвращает число обновлённых записей."""
+    if storage.lazy:
+        storage.convert_legacy_players()
+    records = storage.load_players()
+    upgraded = {uid: record for uid, record in records.items() if upgrade_player(uid, record)}
+    if storage.partial_writes:
+        storage.write_players(upgraded, list(upgraded))
+    elif upgraded:
+        storage.write_players(records, None)
+    return len(upgraded)
+
+# ----------------------------- Отложенное сохранение (write-behind) -----------------------------
+#
+# save_players()/save_clans() больше не пишут на диск сразу: они только помечают данные
+# изменёнными и планируют одну запись через SAVE_DELAY секунд. Все изменения, сделанные
+# за это окно (например, grant_rewards -> add_item -> check_level_up), уходят одним flush.
+#
+# Сам flush не блокирует цикл событий: в цикле снимается копия изменённых записей,
+# а сериализация и атомарная запись (временный файл + rename) выполняются в отдельном
+# потоке. Очередь к потоку ограничена PERSIST_QUEUE_SIZE пакетами: если диск не
+# успевает, следующий flush ждёт свободного места, не останавливая цикл.
+
+# Окно накопления изменений перед записью, в секундах
+SAVE_DELAY = float(os.getenv("SAVE_DELAY", "2.0"))
+PERSIST_QUEUE_SIZE = int(os.getenv("PERSIST_QUEUE_SIZE", "4"))
+
+# Изменённые игроки: key = str(user_id), value = запись игрока
+_dirty_players: Dict[str, Dict[str, Any]] = {}
+# Изменённые (или удалённые) кланы по названию
+_dirty_clans: Set[str] = set()
+_save_state: Dict[str, Any] = {
+    "all_players": False,   # Нужно переписать всех игроков (миграция, загрузка)
+    "clans": False,         # Нужно переписать все кланы
+    "handle": None,         # asyncio.TimerHandle запланированной записи
+    "queue": None,          # queue.Queue пакетов для потока записи
+    "worker": None,         # threading.Thread записи
+    "inflight": {},         # uid -> число пакетов в записи (такие игроки не выгружаются)
+    "taken": 0,             # Сколько пакетов снято (номер последнего пакета)
+}
+
+# Статистика сохранений
+save_stats: Dict[str, Any] = {
+    "requests": 0,          # Вызовов save_players()/save_clans()
+    "flushes": 0,           # Реальных записей на диск
+    "errors": 0,
+    "players_written": 0,   # Сколько изменённых игроков ушло в записи
+    "last_ms": 0.0,         # Время записи (в потоке записи)
+    "max_ms": 0.0,
+    "total_ms": 0.0,
+    "loop_last_ms": 0.0,    # Время снятия копии в цикле событий
+    "loop_max_ms": 0.0,
+    "backpressure_waits": 0,  # Сколько раз flush ждал места в очереди
+}
+
+def save_players(player: Optional[Dict[str, Any]] = None) -> None:
+    """Помечает игрока (или всех, если не указан) изменённым и планирует запись."""
+    save_stats["requests"] += 1
+    if player is None:
+        _save_state["all_players"] = True
+    else:
+        _dirty_players[player["uid"]] = player
+        players.adopt(player)
+        track_rankings(player)
+    _schedule_flush()
+
+def save_clans(clan_name: Optional[str] = None) -> None:
+    """Помечает клан (или все, если не указан) изменённым и планирует запись."""
+    save_stats["requests"] += 1
+    if clan_name is None:
+        _save_state["clans"] = True
     else:
-        players = {}
-    
-    # Миграция существующих данных игроков
-    migrate_player_data()
-
-def migrate_player_data() -> None:
-    """Мигрирует данные существующих игроков для совместимости с новыми полями"""
-    for player_id, player in players.items():
-        # Добавляем отсутствующие поля
-        if "pets" not in player:
-            player["pets"] = []
-        if "achievements" not in player:
-            player["achievements"] = {}
-        if "clan" not in player:
-            player["clan"] = None
-        if "daily_streak" not in player:
-            player["daily_streak"] = 0
-        if "last_daily_reward" not in player:
-            player["last_daily_reward"] = None
-        if "pvp_wins" not in player:
-            player["pvp_wins"] = 0
-        if "pvp_losses" not in player:
-            player["pvp_losses"] = 0
-        if "luck" not in player:
-            player["luck"] = 0
-        if "equipment" not in player:
-            player["equipment"] = {}
-        if "businesses" not in player:
-            player["businesses"] = {}
-        if "last_business_claim" not in player:
-            player["last_business_claim"] = None
-    
-    # Сохраняем обновленные данные
-    save_players()
-
-def save_players() -> None:
+        _dirty_clans.add(clan_name)
+        journal_clan(clan_name)
+    _schedule_flush()
+
+def _schedule_flush() -> None:
+    """Планирует flush_async() через SAVE_DELAY, если он ещё не запланирован."""
+    if _save_state["handle"] is not None:
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # Цикла ещё нет (загрузка при старте) — данные запишет ближайший flush_all()
+        return
+    _save_state["handle"] = loop.call_later(SAVE_DELAY, lambda: asyncio.ensure_future(flush_async()))
+
+def has_pending_saves() -> bool:
+    return bool(_dirty_players or _dirty_clans) or _save_state["all_players"] or _save_state["clans"]
+
+def _snapshot(value: Any) -> Any:
+    """Копия записи из словарей/списков/скаляров — дешевле copy.deepcopy."""
+    if isinstance(value, Record):
+        value = value.to_dict()
+    if isinstance(value, dict):
+        return {k: _snapshot(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_snapshot(v) for v in value]
+    return value
+
+def _take_batch() -> Optional[Dict[str, Any]]:
+    """Снимает согласованную копию изменённых записей и сбрасывает пометки."""
+    handle = _save_state["handle"]
+    if handle is not None:
+        handle.cancel()
+        _save_state["handle"] = None
+    if not has_pending_saves():
+        return None
+
+    batch: Dict[str, Any] = {"players": None, "clans": None}
+    _journal_hold(batch)
+    if _dirty_players or _save_state["all_players"]:
+        if _save_state["all_players"] or not storage.partial_writes:
+            uids = None
+            records = {uid: _snapshot(record) for uid, record in players.items()}
+        else:
+            uids = list(_dirty_players)
+            records = {uid: _snapshot(record) for uid, record in _dirty_players.items()}
+        batch["players"] = (records, uids)
+        inflight = _save_state["inflight"]
+        for uid in records:
+            inflight[uid] = inflight.get(uid, 0) + 1
+    if _dirty_clans or _save_state["clans"]:
+        if _save_state["clans"] or not storage.partial_writes:
+            names = None
+            records = {name: _snapshot(clan) for name, clan in clans.items()}
+        else:
+            names = list(_dirty_clans)
+            records = {name: _snapshot(clans[name]) for name in names if name in clans}
+        batch["clans"] = (records, names)
+
+    _dirty_players.clear()
+    _dirty_clans.clear()
+    _save_state["all_players"] = False
+    _save_state["clans"] = False
+    return batch
+
+def _write_batch(batch: Dict[str, Any]) -> bool:
+    """Сериализует и записывает пакет. Выполняется в потоке записи."""
+    started = time.perf_counter()
+    ok = True
+    if batch["players"] is not None:
+        try:
+            storage.write_players(*batch["players"])
+        except Exception:
+            logger.exception("Не удалось сохранить игроков")
+            ok = False
+    if batch["clans"] is not None:
+        try:
+            storage.write_clans(*batch["clans"])
+        except Exception:
+            logger.exception("Не удалось сохранить кланы")
+            ok = False
+    batch["elapsed_ms"] = (time.perf_counter() - started) * 1000
+    return ok
+
+def _finish_batch(batch: Dict[str, Any], ok: bool) -> None:
+    """Учитывает результат записи пакета (в цикле событий или при синхронном flush)."""
+    if batch["players"] is not None:
+        inflight = _save_state["inflight"]
+        for uid in batch["players"][0]:
+            if inflight.get(uid, 0) <= 1:
+                inflight.pop(uid, None)
+            else:
+                inflight[uid] -= 1
+    elapsed_ms = batch["elapsed_ms"]
+    save_stats["flushes"] += 1
+    save_stats["last_ms"] = elapsed_ms
+    save_stats["max_ms"] = max(save_stats["max_ms"], elapsed_ms)
+    save_stats["total_ms"] += elapsed_ms
+    if ok:
+        if batch["players"] is not None:
+            save_stats["players_written"] += len(batch["players"][0])
+        # Записи журнала до момента снимка больше не нужны
+        _journal_release(batch, True)
+        return
+
+    _journal_release(batch, False)
+
+    save_stats["errors"] += 1
+    # Возвращаем пометки, чтобы повторить запись позже
+    if batch["players"] is not None:
+        records, uids = batch["players"]
+        if uids is None:
+            _save_state["all_players"] = True
+        for uid in uids or ():
+            record = players.peek(uid)
+            if record is not None:
+                _dirty_players.setdefault(uid, record)
+    if batch["clans"] is not None:
+        records, names = batch["clans"]
+        if names is None:
+            _save_state["clans"] = True
+        _dirty_clans.update(names or ())
+    _schedule_flush()
+
+def _persist_worker(jobs: "queue.Queue") -> None:
+    while True:
+        job = jobs.get()
+        if job is None:
+            jobs.task_done()
+            return
+        batch, loop, future = job
+        ok = _write_batch(batch)
+        loop.call_soon_threadsafe(future.set_result, ok)
+        jobs.task_done()
+
+def _persist_queue() -> "queue.Queue":
+    if _save_state["worker"] is None:
+        _save_state["queue"] = queue.Queue(maxsize=PERSIST_QUEUE_SIZE)
+        _save_state["worker"] = threading.Thread(
+            target=_persist_worker, args=(_save_state["queue"],), name="persist-worker", daemon=True
+        )
+        _save_state["worker"].start()
+    return _save_state["queue"]
+
+async def flush_async() -> None:
+    """Снимает копию изменений в цикле и отдаёт запись потоку; ждёт её завершения."""
+    started = time.perf_counter()
+    batch = _take_batch()
+    loop_ms = (time.perf_counter() - started) * 1000
+    save_stats["loop_last_ms"] = loop_ms
+    save_stats["loop_max_ms"] = max(save_stats["loop_max_ms"], loop_ms)
+    if batch is None:
+        return
+
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    jobs = _persist_queue()
+    try:
+        jobs.put_nowait((batch, loop, future))
+    except queue.Full:
+        # Обратное давление: ждём места в очереди, не блокируя цикл
+        save_stats["backpressure_waits"] += 1
+        await asyncio.to_thread(jobs.put, (batch, loop, future))
+    ok = await future
+    _finish_batch(batch, ok)
+
+async def stop_persistence() -> None:
+    """Дописывает накопленное и останавливает поток записи."""
+    await flush_async()
+    worker = _save_state["worker"]
+    if worker is not None:
+        await asyncio.to_thread(_save_state["queue"].put, None)
+        await asyncio.to_thread(worker.join)
+        _save_state["worker"] = None
+        _save_state["queue"] = None
+
+def flush_all() -> None:
+    """Синхронно записывает все накопленные изменения (старт и офлайн-утилиты).
+
+    Пока работает поток записи, используйте flush_async(): иначе более старый пакет
+    из очереди может перезаписать более новые данные."""
+    batch = _take_batch()
+    if batch is None:
+        return
+    _finish_batch(batch, _write_batch(batch))
+
+def get_save_stats() -> Dict[str, Any]:
+    """Статистика отложенного сохранения: сколько вызовов схлопнулось в одну запись."""
+    stats = dict(save_stats)
+    stats["pending_players"] = len(_dirty_players)
+    stats["avg_ms"] = stats["total_ms"] / stats["flushes"] if stats["flushes"] else 0.0
+    stats["coalesced"] = max(0, stats["requests"] - stats["flushes"])
+    return stats
+
+def load_clans() -> None:
+    global clans
+    clans = {name: Clan.from_dict(record) for name, record in storage.load_clans().items()}
+    replay_clan_journal(clans)
+    joinable_clans.clear()
+    for name in clans:
+        update_joinable(name)
+    invalidate_clan_directory()
+
+# ----------------------------- Журнал изменений -----------------------------
+#
+# Каждое изменение игрока перед save_players() дописывает в JOURNAL_FILE короткую строку
+# с новыми значениями изменённых полей (journal_record), а save_clans(name) — клан целиком
+# (journal_clan). Запись в журнал стоит одинаково при любом числе игроков.
+#
+# Журнал состоит из сегментов JOURNAL_FILE.<номер>. Каждый снимок (_take_batch) закрывает
+# текущий сегмент, и следующие записи идут в новый. Когда снимок записан, сегменты до
+# его отметки удаляются целиком — файл журнала никогда не переписывается, поэтому
+# после flush в цикле событий нет тяжёлого ввода-вывода. Сегменты удаляются только до
+# первого сегмента пакетов, которые ещё пишутся или не записались: записи
+# неудачного пакета живут в журнале, пока их не сохранит повторная запись. Фоновый
+# компактор сохраняет снимок раз в JOURNAL_COMPACT_INTERVAL секунд. При старте все
+# сегменты по порядку доигрываются поверх снимка.
+
+JOURNAL_ENABLED = os.getenv("JOURNAL", "1") == "1"
+JOURNAL_FILE = os.getenv("JOURNAL_FILE", "game_journal.log")
+JOURNAL_COMPACT_INTERVAL = float(os.getenv("JOURNAL_COMPACT_INTERVAL", "300"))
+
+_journal: Dict[str, Any] = {
+    "file": None,       # Открытый текущий сегмент
+    "segment": None,    # Номер текущего сегмента (None — определить по файлам)
+    "last_mark": -1,    # Отметка предыдущего пакета
+    # Пакет отвечает за сегменты [отметка предыдущего пакета, своя отметка)
+    "held": {},         # Номер пакета -> первый его сегмент; пакеты, которые ещё пишутся
+    "failed": [],       # (первый сегмент, сколько пакетов было снято к моменту ошибки)
+}
+
+# Поля, которые меняют соответствующие действия
+# Достижение меняет счётчики и сразу выдаёт награду (см. emit_event)
+ACHIEVEMENT_FIELDS = ("achievements", "counters", "gold", "xp", "inventory")
+REWARD_FIELDS = ("xp", "gold", "level", "hp", "max_hp", "attack", "defense", "inventory", "achievements", "counters")
+CASINO_FIELDS = ("timers", "casino_history") + ACHIEVEMENT_FIELDS
+BUSINESS_FIELDS = ("businesses", "timers") + ACHIEVEMENT_FIELDS
+# Характеристики и золото: приключения, тренировки, повышение уровня
+STAT_FIELDS = ("gold", "xp", "level", "hp", "max_hp", "attack", "defense", "luck")
+PVP_FIELDS = ("pvp_wins", "pvp_losses") + STAT_FIELDS + ACHIEVEMENT_FIELDS
+SHOP_FIELDS = ("pets",) + STAT_FIELDS + ACHIEVEMENT_FIELDS
+
+def journal_segments() -> List[tuple]:
+    """[(номер, путь), ...] файлов журнала по порядку.
+
+    JOURNAL_FILE без номера — журнал прежнего формата, он доигрывается первым."""
+    directory = os.path.dirname(JOURNAL_FILE) or "."
+    prefix = os.path.basename(JOURNAL_FILE) + "."
+    found = [(-1, JOURNAL_FILE)] if os.path.exists(JOURNAL_FILE) else []
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            suffix = name[len(prefix):]
+            if name.startswith(prefix) and suffix.isdigit():
+                found.append((int(suffix), os.path.join(directory, name)))
+    return sorted(found)
+
+def _current_segment() -> int:
+    if _journal["segment"] is None:
+        segments = journal_segments()
+        _journal["segment"] = segments[-1][0] + 1 if segments else 0
+    return _journal["segment"]
+
+def _journal_file():
+    if _journal["file"] is None:
+        # Без буферизации: каждая запись сразу уходит в ОС одним write()
+        _journal["file"] = open(f"{JOURNAL_FILE}.{_current_segment()}", "ab", buffering=0)
+    return _journal["file"]
+
+def journal_record(player: Dict[str, Any], op: str, *fields: str) -> None:
+    """Дописывает в журнал текущие значения указанных полей игрока."""
+    if not JOURNAL_ENABLED:
+        return
+    _journal_write({
+        "t": round(time.time(), 3),
+        "u": player["uid"],
+        "op": op,
+        "set": {field: player.get(field) for field in fields},
+    })
+
+def journal_clan(clan_name: str) -> None:
+    """Дописывает в журнал клан целиком (кланы небольшие) или его удаление ("set": null)."""
+    if not JOURNAL_ENABLED:
+        return
+    clan = clans.get(clan_name)
+    _journal_write({
+        "t": round(time.time(), 3),
+        "c": clan_name,
+        "op": "clan",
+        "set": clan.to_dict() if clan is not None else None,
+    })
+
+def _journal_write(entry: Dict[str, Any]) -> None:
     try:
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(players, f, ensure_ascii=False, indent=2)
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n"
+        _journal_file().write(line.encode("utf-8"))
     except Exception:
-        pass
+        logger.exception("Не удалось записать в журнал %s", JOURNAL_FILE)
+
+def journal_mark() -> int:
+    """Закрывает текущий сегмент; все сегменты с меньшим номером войдут в снимаемую копию."""
+    segment = _current_segment()
+    if _journal["file"] is not None:
+        close_journal()
+        segment = _journal["segment"] = segment + 1
+    return segment
+
+def journal_discard_until(mark: int) -> None:
+    """Удаляет сегменты журнала с номером меньше mark — они уже есть в сохранённом снимке."""
+    for number, path in journal_segments():
+        if number >= mark:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
 
-def save_clans() -> None:
+def _journal_hold(batch: Dict[str, Any]) -> None:
+    _save_state["taken"] += 1
+    batch["take"] = _save_state["taken"]
+    batch["journal_from"] = _journal["last_mark"]
+    batch["journal_mark"] = _journal["last_mark"] = journal_mark()
+    _journal["held"][batch["take"]] = batch["journal_from"]
+
+def _journal_release(batch: Dict[str, Any], ok: bool) -> None:
+    """Учитывает записанный или неудачный пакет и удаляет ставшие ненужными сегменты."""
+    _journal["held"].pop(batch["take"], None)
+    if not ok:
+        # Пометки пакета уже возвращены; их запишет пакет, снятый после этого момента
+        _journal["failed"].append((batch["journal_from"], _save_state["taken"]))
+        return
+    _journal["failed"] = [(start, taken) for start, taken in _journal["failed"] if taken >= batch["take"]]
+    # Сегменты пакетов, ещё не попавших на диск, остаются
+    limits = [batch["journal_mark"], *_journal["held"].values(), *(start for start, _ in _journal["failed"])]
+    journal_discard_until(min(limits))
+
+def close_journal() -> None:
+    if _journal["file"] is not None:
+        _journal["file"].close()
+        _journal["file"] = None
+
+def _journal_entries():
+    if not JOURNAL_ENABLED:
+        return
+    for _, path in journal_segments():
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # Недописанная последняя строка после падения
+                    logger.warning("Пропущена повреждённая строка журнала %s", path)
+
+def replay_journal(target: Dict[str, Dict[str, Any]]) -> int:
+    """Применяет записи журнала к загруженным игрокам. Возвращает число применённых записей."""
+    applied = 0
+    for entry in _journal_entries():
+        if "u" not in entry:
+            continue
+        record = target.setdefault(entry["u"], {})
+        record.update(Player.decode(entry["set"]))
+        if "uid" not in record:
+            record["uid"] = entry["u"]
+        # Игрок сразу помечается изменённым: такие не выгружаются из кэша, поэтому
+        # доигранные изменения дождутся записи, даже если игроков больше PLAYER_CACHE_SIZE.
+        # На диск они попадут при ближайшем flush_all()
+        save_players(record)
+        applied += 1
+    if applied:
+        print(f"Journal: replayed {applied} player records from {JOURNAL_FILE}")
+    return applied
+
+def replay_clan_journal(target: Dict[str, Dict[str, Any]]) -> int:
+    """Применяет записи журнала о кланах к загруженным кланам."""
+    applied = 0
+    for entry in _journal_entries():
+        if "c" not in entry:
+            continue
+        if entry["set"] is None:
+            target.pop(entry["c"], None)
+        else:
+            target[entry["c"]] = Clan.from_dict(entry["set"])
+        applied += 1
+    if applied:
+        print(f"Journal: replayed {applied} clan records from {JOURNAL_FILE}")
+        save_clans()
+    return applied
+
+async def journal_compactor() -> None:
+    """Периодически сохраняет снимок состояния, после чего журнал обрезается."""
+    while True:
+        await asyncio.sleep(JOURNAL_COMPACT_INTERVAL)
+        await flush_async()
+
+# ----------------------------- Хранилища -----------------------------
+#
+# STORAGE_MODE=json    — исходный формат: все игроки в game_data.json, кланы в clans_data.json.
+#                        Любая запись переписывает файл целиком.
+# STORAGE_MODE=sharded — каждый игрок и каждый клан в своём файле внутри DATA_DIR,
+#                        файлы разложены по SHARD_COUNT подкаталогам. Запись переписывает
+#                        только изменённые записи. Старые файлы конвертируются при первом запуске.
+# STORAGE_MODE=sqlite  — игроки и кланы строками в SQLITE_FILE (WAL). Горячие поля лежат
+#                        в отдельных колонках, остальное — JSON. Запись = upsert изменённых строк.
+
+STORAGE_MODE = os.getenv("STORAGE_MODE", "json")
+DATA_DIR = os.getenv("DATA_DIR", "game_data")
+SQLITE_FILE = os.getenv("SQLITE_FILE", "game_data.sqlite3")
+SHARD_COUNT = 64
+
+def _read_json_file(path: str, default: Any) -> Any:
+    if not os.path.exists(path):
+        return default
     try:
-        with open("clans_data.json", "w", encoding="utf-8") as f:
-            json.dump(clans, f, ensure_ascii=False, indent=2)
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
     except Exception:
+        logger.exception("Не удалось прочитать %s", path)
+        return default
+
+def _atomic_write_json(path: str, data: Any, indent: Optional[int] = None) -> None:
+    """Пишет JSON во временный файл и атомарно подменяет им path."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent)
+    os.replace(tmp_path, path)
+
+class JsonStorage:
+    """Исходный формат: один JSON-файл на всех игроков и один на все кланы."""
+
+    # Формат не позволяет переписать часть файла — каждый flush пишет всех
+    partial_writes = False
+    # ...и прочитать одного игрока — все игроки загружаются при старте
+    lazy = False
+
+    def __init__(self, players_file: str = DATA_FILE, clans_file: str = CLANS_FILE):
+        self.players_file = players_file
+        self.clans_file = clans_file
+
+    def close(self) -> None:
         pass
 
-def load_clans() -> None:
-    global clans
-    if os.path.exists("clans_data.json"):
+    def load_players(self) -> Dict[str, Dict[str, Any]]:
+        return _read_json_file(self.players_file, {})
+
+    def write_players(self, all_players: Dict[str, Dict[str, Any]], uids: Optional[List[str]]) -> None:
+        _atomic_write_json(self.players_file, all_players, indent=2)
+
+    def load_clans(self) -> Dict[str, Dict[str, Any]]:
+        return _read_json_file(self.clans_file, {})
+
+    def write_clans(self, all_clans: Dict[str, Dict[str, Any]], names: Optional[List[str]]) -> None:
+        _atomic_write_json(self.clans_file, all_clans, indent=2)
+
+class ShardedStorage:
+    """Файл на каждого игрока/клан: DATA_DIR/players/<shard>/<uid>.json.
+
+    Для рейтингов на каждый шард ведётся компактный индекс DATA_DIR/rank/<shard>.json:
+    {uid: [level, gold, pvp_wins, clan]}. Старт читает SHARD_COUNT индексов вместо
+    файлов всех игроков. Индекс пишется после файлов игроков того же пакета; если шард
+    менялся позже индекса (или индекса нет), индекс шарда строится заново по файлам."""
+
+    partial_writes = True
+    lazy = True
+
+    def __init__(self, data_dir: str = DATA_DIR, legacy: Optional[JsonStorage] = None):
+        self.players_dir = os.path.join(data_dir, "players")
+        self.clans_dir = os.path.join(data_dir, "clans")
+        self.rank_dir = os.path.join(data_dir, "rank")
+        self.legacy = legacy or JsonStorage()
+        # Шард -> загруженный индекс рейтинга
+        self._rank: Dict[str, Dict[str, list]] = {}
+
+    def close(self) -> None:
+        pass
+
+    @staticmethod
+    def _shard(key: str) -> str:
+        return f"{zlib.crc32(key.encode('utf-8')) % SHARD_COUNT:02x}"
+
+    def _path(self, base_dir: str, key: str) -> str:
+        # Названия кланов могут содержать пробелы и кириллицу — кодируем в безопасное имя файла
+        filename = urllib.parse.quote(key, safe="") + ".json"
+        return os.path.join(base_dir, self._shard(key), filename)
+
+    def _load_shard(self, shard_dir: str) -> Dict[str, Dict[str, Any]]:
+        records: Dict[str, Dict[str, Any]] = {}
+        if not os.path.isdir(shard_dir):
+            return records
+        for filename in os.listdir(shard_dir):
+            # *.json.tmp — недописанный файл после падения, исходный файл цел
+            if not filename.endswith(".json"):
+                continue
+            key = urllib.parse.unquote(filename[:-len(".json")])
+            record = _read_json_file(os.path.join(shard_dir, filename), None)
+            if record is not None:
+                records[key] = record
+        return records
+
+    def _load_dir(self, base_dir: str) -> Dict[str, Dict[str, Any]]:
+        records: Dict[str, Dict[str, Any]] = {}
+        if not os.path.isdir(base_dir):
+            return records
+        for shard in sorted(os.listdir(base_dir)):
+            records.update(self._load_shard(os.path.join(base_dir, shard)))
+        return records
+
+    @staticmethod
+    def _rank_row(record: Dict[str, Any]) -> list:
+        return [record.get("level", 1), record.get("gold", 0), record.get("pvp_wins", 0), record.get("clan")]
+
+    def _rank_index(self, shard: str) -> Dict[str, list]:
+        """Индекс рейтинга шарда; устаревший или отсутствующий строится по файлам игроков."""
+        index = self._rank.get(shard)
+        if index is not None:
+            return index
+        path = os.path.join(self.rank_dir, f"{shard}.json")
+        shard_dir = os.path.join(self.players_dir, shard)
         try:
-            with open("clans_data.json", "r", encoding="utf-8") as f:
-                clans = json.load(f)
-        except Exception:
-            clans = {}
+            fresh = os.path.getmtime(path) >= os.path.getmtime(shard_dir)
+        except OSError:
+            # Нет индекса — строим; нет шарда — индекс пустой
+            fresh = not os.path.isdir(shard_dir)
+        index = _read_json_file(path, None) if fresh else None
+        if index is None:
+            index = {uid: self._rank_row(record) for uid, record in self._load_shard(shard_dir).items()}
+            if index:
+                os.makedirs(self.rank_dir, exist_ok=True)
+                _atomic_write_json(path, index)
+        self._rank[shard] = index
+        return index
+
+    def _write_records(self, base_dir: str, records: Dict[str, Dict[str, Any]], keys: Optional[List[str]]) -> None:
+        for key in (records if keys is None else keys):
+            path = self._path(base_dir, key)
+            record = records.get(key)
+            if record is None:
+                # Запись удалена (например, распущенный клан)
+                if os.path.exists(path):
+                    os.remove(path)
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _atomic_write_json(path, record)
+
+    def _convert_legacy(self, base_dir: str, legacy_file: str, records: Dict[str, Dict[str, Any]]) -> None:
+        """Раскладывает старый общий файл по отдельным файлам и переименовывает его."""
+        self._write_records(base_dir, records, None)
+        os.replace(legacy_file, legacy_file + ".migrated")
+        print(f"Converted {legacy_file}: {len(records)} records -> {base_dir}")
+
+    def convert_legacy_players(self) -> None:
+        if not os.path.isdir(self.players_dir) and os.path.exists(self.legacy.players_file):
+            self._convert_legacy(self.players_dir, self.legacy.players_file, self.legacy.load_players())
+
+    def load_players(self) -> Dict[str, Dict[str, Any]]:
+        self.convert_legacy_players()
+        if not os.path.isdir(self.players_dir):
+            return {}
+        return self._load_dir(self.players_dir)
+
+    def load_player(self, uid: str) -> Optional[Dict[str, Any]]:
+        return _read_json_file(self._path(self.players_dir, uid), None)
+
+    def ranked_rows(self):
+        """(uid, level, gold, pvp_wins, clan) всех игроков по индексам рейтинга, только при старте.
+
+        Обычно это SHARD_COUNT небольших файлов. Шард с устаревшим индексом (падение между
+        записью игроков и индекса) читается целиком — это O(игроков шарда)."""
+        if not os.path.isdir(self.players_dir):
+            return
+        for shard in sorted(os.listdir(self.players_dir)):
+            for uid, row in self._rank_index(shard).items():
+                yield (uid, *row)
+
+    def write_players(self, all_players: Dict[str, Dict[str, Any]], uids: Optional[List[str]]) -> None:
+        self._write_records(self.players_dir, all_players, uids)
+        touched: Dict[str, Dict[str, list]] = {}
+        for uid in (all_players if uids is None else uids):
+            record = all_players.get(uid)
+            if record is not None:
+                shard = self._shard(uid)
+                touched.setdefault(shard, self._rank_index(shard))[uid] = self._rank_row(record)
+        if touched:
+            os.makedirs(self.rank_dir, exist_ok=True)
+        for shard, index in touched.items():
+            _atomic_write_json(os.path.join(self.rank_dir, f"{shard}.json"), index)
+
+    def load_clans(self) -> Dict[str, Dict[str, Any]]:
+        if os.path.isdir(self.clans_dir):
+            return self._load_dir(self.clans_dir)
+        records = self.legacy.load_clans()
+        if os.path.exists(self.legacy.clans_file):
+            self._convert_legacy(self.clans_dir, self.legacy.clans_file, records)
+        return records
+
+    def write_clans(self, all_clans: Dict[str, Dict[str, Any]], names: Optional[List[str]]) -> None:
+        self._write_records(self.clans_dir, all_clans, names)
+
+class SqliteStorage:
+    """Игроки и кланы в SQLite: горячие поля в колонках, остальное в JSON."""
+
+    # Поля игрока, вынесенные в отдельные колонки (рейтинги строятся по ним без разбора JSON)
+    PLAYER_COLUMNS = ("name", "level", "gold", "clan", "pvp_wins")
+    CLAN_COLUMNS = ("leader", "level")
+    # Колонки, где NULL — обычное значение поля (игрок без клана), а не его отсутствие
+    NULLABLE_COLUMNS = ("clan", "leader")
+    partial_writes = True
+    lazy = True
+
+    def __init__(self, path: str = SQLITE_FILE, legacy: Optional[JsonStorage] = None):
+        self.legacy = legacy or JsonStorage()
+        # Соединение общее для цикла событий и потока записи — доступ под блокировкой
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS players ("
+                "uid TEXT PRIMARY KEY, name TEXT, level INTEGER, gold INTEGER, "
+                "clan TEXT, pvp_wins INTEGER, data TEXT NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS clans ("
+                "name TEXT PRIMARY KEY, leader TEXT, level INTEGER, members INTEGER, data TEXT NOT NULL)"
+            )
+            # Топ и состав клана берутся из памяти (рейтинги, Clan.members), выборки по этим
+            # колонкам не нужны — индексы только замедляли каждый upsert. Убираем их из старых баз
+            for column in ("level", "gold", "pvp_wins", "clan"):
+                self.conn.execute(f"DROP INDEX IF EXISTS idx_players_{column}")
+
+    def close(self) -> None:
+        self.conn.close()
+
+    @staticmethod
+    def _split(record: Dict[str, Any], columns) -> tuple:
+        """Делит запись на значения колонок и JSON с остальными полями."""
+        rest = {k: v for k, v in record.items() if k not in columns}
+        return tuple(record.get(c) for c in columns) + (json.dumps(rest, ensure_ascii=False),)
+
+    @classmethod
+    def _join(cls, row, columns) -> Dict[str, Any]:
+        record = json.loads(row[-1])
+        for column, value in zip(columns, row[1:-1]):
+            # NULL в остальных колонках — поля не было в записи (старый формат);
+            # его заполнит миграция, поэтому ключ не создаём
+            if value is not None or column in cls.NULLABLE_COLUMNS:
+                record[column] = value
+        return record
+
+    def _is_empty(self, table: str) -> bool:
+        return self.conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() is None
+
+    def convert_legacy_players(self) -> None:
+        if self._is_empty("players") and os.path.exists(self.legacy.players_file):
+            records = self.legacy.load_players()
+            self.write_players(records, None)
+            os.replace(self.legacy.players_file, self.legacy.players_file + ".migrated")
+            print(f"Converted {self.legacy.players_file}: {len(records)} players -> {SQLITE_FILE}")
+
+    def load_player(self, uid: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT uid, name, level, gold, clan, pvp_wins, data FROM players WHERE uid = ?", (uid,)
+            ).fetchone()
+        return self._join(row, self.PLAYER_COLUMNS) if row else None
+
+    def load_players(self) -> Dict[str, Dict[str, Any]]:
+        self.convert_legacy_players()
+        with self.lock:
+            rows = self.conn.execute("SELECT uid, name, level, gold, clan, pvp_wins, data FROM players").fetchall()
+        return {row[0]: self._join(row, self.PLAYER_COLUMNS) for row in rows}
+
+    def write_players(self, all_players: Dict[str, Dict[str, Any]], uids: Optional[List[str]]) -> None:
+        keys = list(all_players) if uids is None else uids
+        upserts = [(uid,) + self._split(all_players[uid], self.PLAYER_COLUMNS) for uid in keys if uid in all_players]
+        deletes = [(uid,) for uid in keys if uid not in all_players]
+        # Одна транзакция на весь flush
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO players (uid, name, level, gold, clan, pvp_wins, data) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(uid) DO UPDATE SET name=excluded.name, level=excluded.level, gold=excluded.gold, "
+                "clan=excluded.clan, pvp_wins=excluded.pvp_wins, data=excluded.data",
+                upserts
+            )
+            if deletes:
+                self.conn.executemany("DELETE FROM players WHERE uid = ?", deletes)
+
+    def load_clans(self) -> Dict[str, Dict[str, Any]]:
+        if self._is_empty("clans") and os.path.exists(self.legacy.clans_file):
+            records = self.legacy.load_clans()
+            self.write_clans(records, None)
+            os.replace(self.legacy.clans_file, self.legacy.clans_file + ".migrated")
+        with self.lock:
+            rows = self.conn.execute("SELECT name, leader, level, data FROM clans").fetchall()
+        return {row[0]: self._join(row, self.CLAN_COLUMNS) for row in rows}
+
+    def write_clans(self, all_clans: Dict[str, Dict[str, Any]], names: Optional[List[str]]) -> None:
+        keys = list(all_clans) if names is None else names
+        upserts = []
+        for name in keys:
+            if name in all_clans:
+                clan = all_clans[name]
+                leader, level, data = self._split(clan, self.CLAN_COLUMNS)
+                upserts.append((name, leader, level, len(clan.get("members", [])), data))
+        deletes = [(name,) for name in keys if name not in all_clans]
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO clans (name, leader, level, members, data) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET leader=excluded.leader, level=excluded.level, "
+                "members=excluded.members, data=excluded.data",
+                upserts
+            )
+            if deletes:
+                self.conn.executemany("DELETE FROM clans WHERE name = ?", deletes)
+
+    def ranked_rows(self):
+        """(uid, level, gold, pvp_wins, clan) всех игроков из колонок, без разбора JSON."""
+        with self.lock:
+            rows = self.conn.execute("SELECT uid, level, gold, pvp_wins, clan FROM players").fetchall()
+        return rows
+
+def create_storage(mode: str = STORAGE_MODE):
+    if mode == "json":
+        return JsonStorage()
+    if mode == "sharded":
+        return ShardedStorage()
+    if mode == "sqlite":
+        return SqliteStorage()
+    raise ValueError(f"Неизвестный STORAGE_MODE: {mode}")
+
+storage = create_storage()
+
+# ----------------------------- Кэш игроков -----------------------------
+#
+# players — это PlayerRepository: игрок загружается из хранилища при первом обращении
+# (`uid in players`, `players[uid]`) и держится в LRU-кэше. Когда игроков в памяти больше
+# PLAYER_CACHE_SIZE, самые давно неактивные выгружаются. Изменённые и ещё не записанные
+# игроки не выгружаются, пока flush не сохранит их. Хранилище json не умеет читать
+# одного игрока, поэтому в этом режиме все игроки загружаются при старте без вытеснения.
+
+PLAYER_CACHE_SIZE = int(os.getenv("PLAYER_CACHE_SIZE", "10000"))
+
+class PlayerRepository:
+    """Словарь игроков с загрузкой по требованию и LRU-вытеснением."""
+
+    def __init__(self, backend, capacity: Optional[int], preloaded: Optional[Dict[str, Dict[str, Any]]] = None):
+        self._backend = backend
+        self.capacity = capacity
+        self._cache: "OrderedDict[str, Player]" = OrderedDict()
+        for uid, record in (preloaded or {}).items():
+            # Предзагруженные записи (режим json) обновляются сразу: рейтинги и сводки
+            # при старте обходят всех игроков, минуя _get
+            record = Player.from_dict(record)
+            upgrade_player(uid, record)
+            self._cache[uid] = record
+        # Выгруженные игроки, на которых ещё ссылается код (обработчик держит запись
+        # через await). Повторное обращение возвращает тот же объект, а не читает игрока
+        # из хранилища второй раз, поэтому у одного uid всегда один живой объект.
+        self._evicted: "weakref.WeakValueDictionary[str, Player]" = weakref.WeakValueDictionary()
+        self.stats = {"hits": 0, "misses": 0, "loads": 0, "evictions": 0, "revived": 0}
+
+    def _get(self, uid: str) -> Optional[Player]:
+        record = self._cache.get(uid)
+        if record is not None:
+            self._cache.move_to_end(uid)
+            self.stats["hits"] += 1
+            return record
+        self.stats["misses"] += 1
+        record = self._evicted.pop(uid, None)
+        if record is not None:
+            self.stats["revived"] += 1
+            self._cache[uid] = record
+            self._evict()
+            return record
+        if not self._backend.lazy:
+            return None
+        record = self._backend.load_player(uid)
+        if record is None:
+            return None
+        self.stats["loads"] += 1
+        record = Player.from_dict(record)
+        upgrade_player(uid, record)
+        self._cache[uid] = record
+        self._evict()
+        return record
+
+    def _evict(self) -> None:
+        if self.capacity is None:
+            return
+        # Каждого кандидата проверяем не больше одного раза за вызов;
+        # только что запрошенного игрока не выгружаем никогда
+        newest = next(reversed(self._cache), None)
+        attempts = len(self._cache) - 1
+        while len(self._cache) > self.capacity and attempts > 0:
+            attempts -= 1
+            uid, record = self._cache.popitem(last=False)
+            if uid == newest or uid in _dirty_players or uid in _save_state["inflight"]:
+                # Ещё не записан — возвращаем в конец очереди
+                self._cache[uid] = record
+                continue
+            self.stats["evictions"] += 1
+            self._evicted[uid] = record
+
+    def __contains__(self, uid: str) -> bool:
+        return self._get(uid) is not None
+
+    def __getitem__(self, uid: str) -> Player:
+        record = self._get(uid)
+        if record is None:
+            raise KeyError(uid)
+        return record
+
+    def __setitem__(self, uid: str, record: Dict[str, Any]) -> None:
+        self._evicted.pop(uid, None)
+        self._cache[uid] = Player.from_dict(record)
+        self._cache.move_to_end(uid)
+        self._evict()
+
+    def get(self, uid: str, default: Any = None) -> Any:
+        record = self._get(uid)
+        return default if record is None else record
+
+    def setdefault(self, uid: str, default: Dict[str, Any]) -> Dict[str, Any]:
+        record = self._get(uid)
+        if record is None:
+            self[uid] = default
+            record = self._cache[uid]
+        return record
+
+    def peek(self, uid: str) -> Optional[Player]:
+        """Игрок из памяти без загрузки и без обновления LRU."""
+        return self._cache.get(uid)
+
+    def adopt(self, record: Dict[str, Any]) -> None:
+        """Возвращает в кэш уже выгруженного игрока, если его снова изменили.
+
+        Если в кэше оказался другой объект того же игрока, остаётся сохраняемый:
+        именно он уйдёт на диск, и следующие обработчики должны видеть его."""
+        uid = record["uid"]
+        cached = self._cache.get(uid)
+        if cached is record:
+            return
+        if cached is not None:
+            logger.warning("Две копии игрока %s в памяти, оставлена сохраняемая", uid)
+        self._evicted.pop(uid, None)
+        self._cache[uid] = record
+
+    def items(self):
+        """Игроки, находящиеся в памяти."""
+        return self._cache.items()
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+def get_player_cache_stats() -> Dict[str, Any]:
+    stats = dict(players.stats)
+    stats["resident"] = len(players)
+    stats["capacity"] = players.capacity
+    return stats
+
+# ----------------------------- Рейтинги -----------------------------
+#
+# Рейтинги по уровню, золоту, победам в PvP и кланам хранятся в упорядоченных списках
+# (SortedList) и обновляются по одному игроку: save_players() вызывает track_rankings(),
+# поэтому любое изменение рейтингового поля (check_level_up, grant_rewards, conclude_duel,
+# вступление в клан и выход) сразу попадает в рейтинг за O(log n). Топ-N и «моё место»
+# тоже стоят O(log n), без сортировки всех игроков. Рейтинг клана — сумма уровней его
+# участников. При старте рейтинги строятся один раз: из колонок SQLite, из индексов
+# рейтинга шардов (sharded) или из уже загруженных игроков (json).
+
+class Leaderboard:
+    """Рейтинг по одному полю: ключи (-значение, id) в SortedList и id -> значение."""
+
+    def __init__(self):
+        self._keys = SortedList()
+        self._values: Dict[str, int] = {}
+
+    def update(self, key: str, value: int) -> None:
+        old = self._values.get(key)
+        if old == value:
+            return
+        if old is not None:
+            self._keys.remove((-old, key))
+        self._keys.add((-value, key))
+        self._values[key] = value
+
+    def remove(self, key: str) -> None:
+        old = self._values.pop(key, None)
+        if old is not None:
+            self._keys.remove((-old, key))
+
+    def value(self, key: str) -> Optional[int]:
+        return self._values.get(key)
+
+    def top(self, limit: int = 10) -> List[tuple]:
+        """[(id, значение), ...] по убыванию значения."""
+        return [(key, -neg) for neg, key in self._keys.islice(0, limit)]
+
+    def rank(self, key: str) -> Optional[int]:
+        """Место (с 1) или None, если id нет в рейтинге."""
+        value = self._values.get(key)
+        if value is None:
+            return None
+        return self._keys.index((-value, key)) + 1
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+# Рейтинг -> название; "clans" ведётся по кланам, остальные — по игрокам
+LEADERBOARDS = {
+    "level": "⭐ Уровень",
+    "gold": "💰 Золото",
+    "pvp": "⚔️ Победы в PvP",
+    "clans": "🏰 Кланы",
+}
+
+leaderboards: Dict[str, Leaderboard] = {name: Leaderboard() for name in LEADERBOARDS}
+# uid -> (клан, уровень), учтённые в рейтинге кланов
+_clan_contrib: Dict[str, tuple] = {}
+
+def _track_row(uid: str, level: Optional[int], gold: Optional[int], pvp_wins: Optional[int], clan: Optional[str]) -> None:
+    # Пустое значение (NULL в sqlite, поле старой записи) — значение по умолчанию,
+    # иначе такой игрок не попал бы в рейтинг
+    level, gold, pvp_wins = level or 1, gold or 0, pvp_wins or 0
+    leaderboards["level"].update(uid, level)
+    leaderboards["gold"].update(uid, gold)
+    leaderboards["pvp"].update(uid, pvp_wins)
+    contrib = (clan, level) if clan else None
+    old = _clan_contrib.get(uid)
+    if old == contrib:
+        return
+    board = leaderboards["clans"]
+    if old is not None:
+        total = board.value(old[0]) - old[1]
+        if total > 0:
+            board.update(old[0], total)
+        else:
+            board.remove(old[0])
+    if contrib is not None:
+        board.update(clan, (board.value(clan) or 0) + level)
+        _clan_contrib[uid] = contrib
     else:
-        clans = {}
+        _clan_contrib.pop(uid, None)
+
+def track_rankings(player: Dict[str, Any]) -> None:
+    """Переносит рейтинговые поля игрока в рейтинги (O(log n), если что-то изменилось)."""
+    _track_player(player["uid"], player)
+
+def _track_player(uid: str, player: Dict[str, Any]) -> None:
+    _track_row(uid, player.get("level"), player.get("gold"), player.get("pvp_wins"), player.get("clan"))
+
+def build_leaderboards() -> None:
+    """Строит рейтинги заново по всем игрокам хранилища."""
+    for name in leaderboards:
+        leaderboards[name] = Leaderboard()
+    _clan_contrib.clear()
+    if storage.lazy:
+        for row in storage.ranked_rows():
+            _track_row(*row)
+    # Игроки в памяти могут быть новее хранилища (доигранный журнал)
+    for uid, player in players.items():
+        _track_player(uid, player)
+
+# ----------------------------- Кулдауны и таймеры -----------------------------
+#
+# Время последнего действия хранится в записи игрока как число секунд эпохи:
+# player["timers"][action]. Проверка кулдауна — одно вычитание без разбора строк,
+# а таймеры сохраняются и переживают перезапуск вместе с игроком.
+
+COOLDOWNS = {
+    "adventure": 6,
+    "casino": 30,
+    "daily": 86400,
+}
+
+def last_used(player: Dict[str, Any], action: str) -> Optional[float]:
+    """Когда действие выполнялось в последний раз (эпоха) или None."""
+    return player["timers"].get(action)
+
+def cooldown_remaining(player: Dict[str, Any], action: str, now: Optional[float] = None) -> float:
+    """Сколько секунд осталось до готовности действия (0 — готово)."""
+    last = player["timers"].get(action)
+    if last is None:
+        return 0.0
+    if now is None:
+        now = time.time()
+    return max(0.0, last + COOLDOWNS[action] - now)
+
+def cooldown_ready(player: Dict[str, Any], action: str, now: Optional[float] = None) -> bool:
+    return cooldown_remaining(player, action, now) <= 0
+
+def mark_used(player: Dict[str, Any], action: str, now: Optional[float] = None) -> float:
+    """Запоминает время действия; изменение сохраняется вместе с игроком."""
+    if now is None:
+        now = time.time()
+    player["timers"][action] = now
+    return now
+
+# ----------------------------- Блокировки обновлений -----------------------------
+#
+# Приложение обрабатывает обновления параллельно (concurrent_updates). Чтобы два
+# обновления одного игрока не перемешивались на await, каждый обработчик выполняется
+# под блокировкой этого пользователя (per_user), а ходы дуэли — ещё и под блокировкой
+# дуэли. Порядок захвата всегда «пользователь -> дуэль», поэтому взаимных блокировок нет.
+# Реестр держит блокировки по слабым ссылкам: блокировка живёт, пока её держат или
+# ждут, и удаляется сборщиком мусора, когда пользователь неактивен.
+
+class LockRegistry:
+    """asyncio.Lock по ключу; неиспользуемые блокировки освобождаются автоматически."""
+
+    def __init__(self):
+        self._locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+    def get(self, key: str) -> asyncio.Lock:
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+        return lock
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+user_locks = LockRegistry()
+duel_locks = LockRegistry()
+
+def per_user(handler):
+    """Оборачивает обработчик: обновления одного пользователя выполняются по очереди."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        if user is None:
+            return await handler(update, context)
+        async with user_locks.get(str(user.id)):
+            return await handler(update, context)
+    return wrapper
+
+# ----------------------------- Колесо таймеров -----------------------------
+#
+# Отложенные события (истечение вызова на дуэль, таймаут хода) лежат в хэшированном
+# колесе: слот = номер тика дедлайна по модулю числа слотов. Постановка, перенос и
+# отмена таймера — O(1) по ключу, а фоновая задача timer_loop раз в тик просматривает
+# только слоты, до которых дошло время. Таймер дальше одного оборота колеса ждёт в своём
+# слоте, пока не наступит его дедлайн. Память — по записи на живой таймер.
+
+TIMER_TICK = float(os.getenv("TIMER_TICK", "1"))
+TIMER_SLOTS = 512
+
+class TimerWheel:
+    """Таймеры по ключу: у ключа не больше одного таймера, повторная постановка переносит его."""
+
+    def __init__(self, tick: float = TIMER_TICK, slots: int = TIMER_SLOTS):
+        self.tick = tick
+        self._slots: List[Dict[str, tuple]] = [{} for _ in range(slots)]
+        self._where: Dict[str, int] = {}
+        self._cursor: Optional[int] = None  # первый ещё не просмотренный тик
+        self.stats = {"scheduled": 0, "cancelled": 0, "fired": 0}
+
+    def schedule(self, key: str, delay: float, callback, now: Optional[float] = None) -> None:
+        """Через delay секунд advance() вернёт (key, callback)."""
+        if now is None:
+            now = time.monotonic()
+        slot = self._where.pop(key, None)
+        if slot is not None:
+            del self._slots[slot][key]
+        deadline = now + delay
+        tick_no = int(deadline // self.tick)
+        if self._cursor is not None and tick_no < self._cursor:
+            tick_no = self._cursor
+        slot = tick_no % len(self._slots)
+        self._slots[slot][key] = (deadline, callback)
+        self._where[key] = slot
+        self.stats["scheduled"] += 1
+
+    def cancel(self, key: str) -> bool:
+        slot = self._where.pop(key, None)
+        if slot is None:
+            return False
+        del self._slots[slot][key]
+        self.stats["cancelled"] += 1
+        return True
+
+    def advance(self, now: Optional[float] = None) -> List[tuple]:
+        """Снимает и возвращает [(key, callback), ...] с наступившим дедлайном."""
+        if now is None:
+            now = time.monotonic()
+        target = int(now // self.tick)
+        if self._cursor is None:
+            self._cursor = target
+        expired = []
+        # После долгой паузы достаточно одного оборота: дальше слоты повторяются
+        last = min(target, self._cursor + len(self._slots) - 1)
+        for tick_no in range(self._cursor, last + 1):
+            bucket = self._slots[tick_no % len(self._slots)]
+            for key in [key for key, (deadline, _) in bucket.items() if deadline <= now]:
+                expired.append((key, bucket.pop(key)[1]))
+                del self._where[key]
+        # Текущий тик ещё не закончился — в следующий раз просматриваем его снова
+        self._cursor = target
+        self.stats["fired"] += len(expired)
+        return expired
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._where
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+timers = TimerWheel()
+
+async def timer_loop(app) -> None:
+    """Раз в тик запускает обработчики истёкших таймеров: callback(app, key)."""
+    while True:
+        await asyncio.sleep(timers.tick)
+        expired = timers.advance()
+        if not expired:
+            continue
+        results = await asyncio.gather(*(callback(app, key) for key, callback in expired), return_exceptions=True)
+        for (key, _), result in zip(expired, results):
+            if isinstance(result, Exception):
+                logger.error("Ошибка в таймере %s", key, exc_info=result)
+
+def get_timer_stats() -> Dict[str, Any]:
+    stats = dict(timers.stats)
+    stats["pending"] = len(timers)
+    return stats
 
 # ----------------------------- Игровая логика --------------------------------
 
@@ -318,6 +1908,8 @@ def ensure_player(user_id: int, name: str) -> Dict[str, Any]:
     uid = str(user_id)
     if uid not in players:
         players[uid] = {
+            "uid": uid,
+            "v": SCHEMA_VERSION,
             "name": name,
             "class": None,
             "level": 1,
@@ -327,119 +1919,150 @@ def ensure_player(user_id: int, name: str) -> Dict[str, Any]:
             "attack": 5,
             "defense": 2,
             "gold": 50,  # Увеличим стартовое золото
-            "inventory": {"Малое зелье лечения": 2},
+            "inventory": {ITEM_IDS["Малое зелье лечения"]: 2},
             "quests": {},
-            "last_casino_play": None,
             "achievements": {},
             "pets": [],
             "clan": None,
             "daily_reward_claimed": False,
-            "last_daily_reward": None,
             "pvp_wins": 0,
             "pvp_losses": 0,
             "luck": 0,
             "equipment": {},
+            "daily_streak": 0,
+            "businesses": {},
+            "timers": {},
+            "counters": {},
+            "quest_archive": [],
         }
-        save_players()
+        journal_record(players[uid], "create", *players[uid].keys())
+        save_players(players[uid])
     return players[uid]
 
-def check_achievements(player: Dict[str, Any], action: str, value: Any = None) -> List[str]:
-    """Проверяет и выдает достижения"""
-    earned = []
-    
-    if action == "first_kill" and "first_blood" not in player["achievements"]:
-        player["achievements"]["first_blood"] = {"earned": True, "date": datetime.now().isoformat()}
-        earned.append("first_blood")
-    
-    elif action == "casino_win" and "casino_king" not in player["achievements"]:
-        # Проверяем 5 побед подряд
-        wins = player.get("casino_wins_streak", 0) + 1
-        player["casino_wins_streak"] = wins
-        if wins >= 5:
-            player["achievements"]["casino_king"] = {"earned": True, "date": datetime.now().isoformat()}
-            earned.append("casino_king")
-    
-    elif action == "gold_check" and "rich_player" not in player["achievements"]:
-        if player["gold"] >= 1000:
-            player["achievements"]["rich_player"] = {"earned": True, "date": datetime.now().isoformat()}
-            earned.append("rich_player")
-    
-    elif action == "level_check" and "level_master" not in player["achievements"]:
-        if player["level"] >= 10:
-            player["achievements"]["level_master"] = {"earned": True, "date": datetime.now().isoformat()}
-            earned.append("level_master")
-    
-    elif action == "quest_complete" and "quest_hunter" not in player["achievements"]:
-        completed_quests = sum(1 for q in player["quests"].values() if q.get("status") == "completed")
-        if completed_quests >= 10:
-            player["achievements"]["quest_hunter"] = {"earned": True, "date": datetime.now().isoformat()}
-            earned.append("quest_hunter")
-    
-    elif action == "pvp_win" and "pvp_champion" not in player["achievements"]:
-        if player["pvp_wins"] >= 20:
-            player["achievements"]["pvp_champion"] = {"earned": True, "date": datetime.now().isoformat()}
-            earned.append("pvp_champion")
-    
-    elif action == "pet_obtained" and "pet_lover" not in player["achievements"]:
-        if len(player["pets"]) >= 3:
-            player["achievements"]["pet_lover"] = {"earned": True, "date": datetime.now().isoformat()}
-            earned.append("pet_lover")
-    
-    elif action == "pet_check" and "pet_lover" not in player["achievements"]:
-        if len(player["pets"]) >= 3:
-            player["achievements"]["pet_lover"] = {"earned": True, "date": datetime.now().isoformat()}
-            earned.append("pet_lover")
-    
-    elif action == "clan_created" and "clan_leader" not in player["achievements"]:
-        player["achievements"]["clan_leader"] = {"earned": True, "date": datetime.now().isoformat()}
-        earned.append("clan_leader")
-    
-    # Новые достижения
-    elif action == "business_check" and "business_tycoon" not in player["achievements"]:
-        if len(player.get("businesses", {})) >= 3:
-            player["achievements"]["business_tycoon"] = {"earned": True, "date": datetime.now().isoformat()}
-            earned.append("business_tycoon")
-    
-    elif action == "daily_check" and "daily_master" not in player["achievements"]:
-        if player.get("daily_streak", 0) >= 7:
-            player["achievements"]["daily_master"] = {"earned": True, "date": datetime.now().isoformat()}
-            earned.append("daily_master")
-    
-    elif action == "casino_total_wins" and "casino_professional" not in player["achievements"]:
-        total_wins = player.get("casino_total_wins", 0) + 1
-        player["casino_total_wins"] = total_wins
-        if total_wins >= 50:
-            player["achievements"]["casino_professional"] = {"earned": True, "date": datetime.now().isoformat()}
-            earned.append("casino_professional")
-    
-    elif action == "inventory_check" and "inventory_collector" not in player["achievements"]:
-        unique_items = len(player.get("inventory", {}))
-        if unique_items >= 10:
-            player["achievements"]["inventory_collector"] = {"earned": True, "date": datetime.now().isoformat()}
-            earned.append("inventory_collector")
-    
-    if earned:
-        save_players()
-    
-    return earned
+# ----------------------------- Достижения -----------------------------
+#
+# Достижение — правило, подписанное на игровые события. emit_event() увеличивает счётчик
+# события в player["counters"] (убийства, победы в казино, выполненные квесты) и
+# проверяет только подписанные на него правила ещё не полученных достижений. Полученное
+# достижение сразу выдаёт награду в ту же запись игрока; сохраняет и пишет в журнал
+# (ACHIEVEMENT_FIELDS) вызывающий код вместе со своим изменением.
+
+# Событие -> [(ID достижения, условие)]
+ACHIEVEMENT_RULES: Dict[str, List[tuple]] = {}
+# Событие -> счётчик в player["counters"]
+EVENT_COUNTERS = {"enemy_killed": "kills", "casino_win": "casino_wins", "quest_completed": "quests_completed"}
+
+def achievement_rule(achievement_id: str, *events: str):
+    """Регистрирует условие достижения для перечисленных событий."""
+    def register(condition):
+        for event in events:
+            ACHIEVEMENT_RULES.setdefault(event, []).append((achievement_id, condition))
+        return condition
+    return register
+
+def get_counter(player: Dict[str, Any], name: str) -> int:
+    return player.get("counters", {}).get(name, 0)
+
+@achievement_rule("first_blood", "enemy_killed")
+def _first_blood(player):
+    return True
+
+@achievement_rule("casino_king", "casino_win")
+def _casino_king(player):
+    return get_counter(player, "casino_wins") >= 5
+
+@achievement_rule("casino_professional", "casino_win")
+def _casino_professional(player):
+    return get_counter(player, "casino_wins") >= 50
+
+@achievement_rule("rich_player", "gold_changed", "casino_win", "pvp_win")
+def _rich_player(player):
+    return player["gold"] >= 1000
+
+@achievement_rule("level_master", "level_up")
+def _level_master(player):
+    return player["level"] >= 10
+
+@achievement_rule("quest_hunter", "quest_completed")
+def _quest_hunter(player):
+    return get_counter(player, "quests_completed") >= 10
 
-def grant_achievement_rewards(player: Dict[str, Any], achievement_id: str) -> str:
-    """Выдает награды за достижение"""
-    if achievement_id in ACHIEVEMENTS:
+@achievement_rule("pvp_champion", "pvp_win")
+def _pvp_champion(player):
+    return player["pvp_wins"] >= 20
+
+@achievement_rule("pet_lover", "pet_obtained")
+def _pet_lover(player):
+    return len(player["pets"]) >= 3
+
+@achievement_rule("clan_leader", "clan_created")
+def _clan_leader(player):
+    return True
+
+@achievement_rule("business_tycoon", "business_bought")
+def _business_tycoon(player):
+    return len(player.get("businesses", {})) >= 3
+
+@achievement_rule("daily_master", "daily_claimed")
+def _daily_master(player):
+    return player.get("daily_streak", 0) >= 7
+
+@achievement_rule("inventory_collector", "item_added")
+def _inventory_collector(player):
+    return len(player.get("inventory", {})) >= 10
+
+def emit_event(player: Dict[str, Any], event: str) -> List[str]:
+    """Обрабатывает игровое событие: счётчик, подписанные правила и награды. Не сохраняет.
+
+    Возвращает ID полученных достижений."""
+    counter = EVENT_COUNTERS.get(event)
+    if counter is not None:
+        counters = player.setdefault("counters", {})
+        counters[counter] = counters.get(counter, 0) + 1
+    rules = ACHIEVEMENT_RULES.get(event)
+    if not rules:
+        return []
+    achievements = player["achievements"]
+    earned = [
+        achievement_id for achievement_id, condition in rules
+        if achievement_id not in achievements and condition(player)
+    ]
+    if not earned:
+        return []
+    date = datetime.now().isoformat()
+    got_item = False
+    for achievement_id in earned:
+        achievements[achievement_id] = {"earned": True, "date": date}
         reward = ACHIEVEMENTS[achievement_id]["reward"]
         player["gold"] += reward.get("gold", 0)
         player["xp"] += reward.get("xp", 0)
         if "item" in reward:
-            add_item(player, reward["item"], 1)
-        save_players()
-        return f"🏆 +{reward.get('gold', 0)}💰 +{reward.get('xp', 0)}XP"
-    return ""
+            _put_item(player, reward["item"], 1)
+            got_item = True
+    # Награда сама может принести достижение (например, «Богач»)
+    if event != "gold_changed":
+        earned += emit_event(player, "gold_changed")
+    if got_item and event != "item_added":
+        earned += emit_event(player, "item_added")
+    return earned
+
+def format_achievements(earned: List[str]) -> str:
+    """Строки о полученных достижениях и их наградах."""
+    text = ""
+    for achievement_id in earned:
+        reward = ACHIEVEMENTS[achievement_id]["reward"]
+        text += f"\n🏆 {ACHIEVEMENTS[achievement_id]['name']}: 🏆 +{reward.get('gold', 0)}💰 +{reward.get('xp', 0)}XP"
+    return text
+
+# Характеристики с бонусами питомцев читаются на каждом ходу боя, в каждом battle_text
+# и в статусе. Они кэшируются в самой записи игрока вместе с ключом из полей, от которых
+# зависят: базовые атака, защита, максимум HP, удача и список питомцев. Экипировка при
+# покупке прибавляется к базовым характеристикам, поэтому тоже меняет ключ. Пока ключ
+# совпадает, бонусы питомцев не пересчитываются.
 
-def get_pet_bonuses(player: Dict[str, Any]) -> Dict[str, int]:
-    """Получает бонусы от питомцев"""
+def _compute_pet_bonuses(pets) -> Dict[str, int]:
     bonuses = {"attack": 0, "defense": 0, "hp": 0, "luck": 0, "gold": 0, "xp": 0}
     
-    pets = player.get("pets", [])
     for pet_id in pets:
         if pet_id in PETS:
             pet = PETS[pet_id]
@@ -448,30 +2071,35 @@ def get_pet_bonuses(player: Dict[str, Any]) -> Dict[str, int]:
     
     return bonuses
 
-def get_player_stats_with_pets(player: Dict[str, Any]) -> Dict[str, int]:
-    """Получает характеристики игрока с учетом бонусов питомцев"""
-    bonuses = get_pet_bonuses(player)
-    
-    stats = {
-        "attack": player["attack"] + bonuses["attack"],
-        "defense": player["defense"] + bonuses["defense"],
-        "hp": player["hp"],
-        "max_hp": player["max_hp"] + bonuses["hp"],
-        "luck": player.get("luck", 0) + bonuses["luck"]
-    }
-    
-    return stats
+def _derived_entry(player: Player) -> tuple:
+    key = (player.attack, player.defense, player.max_hp, player.luck, tuple(player.pets))
+    entry = getattr(player, "_stats", None)
+    if entry is None or entry[0] != key:
+        bonuses = _compute_pet_bonuses(player.pets)
+        stats = {
+            "attack": player.attack + bonuses["attack"],
+            "defense": player.defense + bonuses["defense"],
+            "max_hp": player.max_hp + bonuses["hp"],
+            "luck": player.luck + bonuses["luck"],
+        }
+        entry = player._stats = (key, stats, bonuses)
+    return entry
+
+def get_pet_bonuses(player: Player) -> Dict[str, int]:
+    """Получает бонусы от питомцев (из кэша, см. get_derived_stats). Словарь не изменять."""
+    return _derived_entry(player)[2]
+
+def get_derived_stats(player: Player) -> Dict[str, int]:
+    """Атака, защита, максимум HP и удача с бонусами питомцев и экипировки.
+
+    Пересчитываются, только когда меняются базовые характеристики или питомцы.
+    Текущее HP не кэшируется — его читают из player.hp. Словарь не изменять."""
+    return _derived_entry(player)[1]
 
 def can_claim_daily_reward(player: Dict[str, Any]) -> bool:
     """Проверяет, может ли игрок получить ежедневную награду"""
-    if not player.get("last_daily_reward"):
-        return True
-    
-    last_claim = datetime.fromisoformat(player["last_daily_reward"])
-    now = datetime.now()
-    
     # Проверяем, прошло ли 24 часа
-    return (now - last_claim).total_seconds() >= 86400
+    return cooldown_ready(player, "daily")
 
 def get_daily_streak(player: Dict[str, Any]) -> int:
     """Получает текущую серию ежедневных наград"""
@@ -491,16 +2119,17 @@ def claim_daily_reward(player: Dict[str, Any]) -> Dict[str, Any]:
     player["gold"] += reward["gold"]
     player["xp"] += reward["xp"]
     player["daily_streak"] = streak
-    player["last_daily_reward"] = datetime.now().isoformat()
+    mark_used(player, "daily")
     
     if "item" in reward:
         add_item(player, reward["item"], 1)
     
     # Проверяем достижения
-    check_achievements(player, "daily_check")
-    check_achievements(player, "inventory_check")
+    emit_event(player, "daily_claimed")
+    emit_event(player, "gold_changed")
     
-    save_players()
+    journal_record(player, "daily", "daily_streak", "timers", *STAT_FIELDS, *ACHIEVEMENT_FIELDS)
+    save_players(player)
     
     return {
         "success": True,
@@ -509,27 +2138,45 @@ def claim_daily_reward(player: Dict[str, Any]) -> Dict[str, Any]:
         "reward": reward
     }
 
+# Максимум участников клана
+CLAN_MAX_MEMBERS = 20
+
+# Кланы, в которых есть места, в порядке создания (упорядоченное множество названий).
+# Обновляется при каждом изменении состава, поэтому экран кланов не перебирает все кланы.
+joinable_clans: Dict[str, None] = {}
+
+def update_joinable(clan_name: str) -> None:
+    clan = clans.get(clan_name)
+    if clan is not None and len(clan["members"]) < CLAN_MAX_MEMBERS:
+        joinable_clans[clan_name] = None
+    else:
+        joinable_clans.pop(clan_name, None)
+
 def create_clan(clan_name: str, leader_id: str, leader_name: str) -> bool:
     """Создает новый клан"""
     if clan_name in clans:
         return False
     
-    clans[clan_name] = {
+    clans[clan_name] = Clan({
         "name": clan_name,
         "leader": leader_id,
-        "members": [leader_id],
+        "members": {leader_id: None},
         "level": 1,
         "xp": 0,
         "created": datetime.now().isoformat(),
         "description": f"Клан {clan_name}",
         "color": random.choice(["🔴", "🔵", "🟢", "🟡", "🟣", "🟠"])
-    }
+    })
+    update_joinable(clan_name)
+    invalidate_clan_directory()
     
     # Добавляем игрока в клан
     players[leader_id]["clan"] = clan_name
+    emit_event(players[leader_id], "clan_created")
     
-    save_players()
-    save_clans()
+    journal_record(players[leader_id], "clan_create", "clan", *ACHIEVEMENT_FIELDS)
+    save_players(players[leader_id])
+    save_clans(clan_name)
     return True
 
 def join_clan(clan_name: str, player_id: str) -> bool:
@@ -541,14 +2188,17 @@ def join_clan(clan_name: str, player_id: str) -> bool:
     if player_id in clan["members"]:
         return False
     
-    if len(clan["members"]) >= 20:  # Максимум 20 участников
+    if len(clan["members"]) >= CLAN_MAX_MEMBERS:
         return False
     
-    clan["members"].append(player_id)
+    clan["members"][player_id] = None
+    update_joinable(clan_name)
+    invalidate_clan_directory()
     players[player_id]["clan"] = clan_name
     
-    save_players()
-    save_clans()
+    journal_record(players[player_id], "clan_join", "clan")
+    save_players(players[player_id])
+    save_clans(clan_name)
     return True
 
 def leave_clan(player_id: str) -> bool:
@@ -564,18 +2214,21 @@ def leave_clan(player_id: str) -> bool:
     if clan_name in clans:
         clan = clans[clan_name]
         if player_id in clan["members"]:
-            clan["members"].remove(player_id)
+            del clan["members"][player_id]
             
             # Если лидер покидает клан, назначаем нового лидера
             if clan["leader"] == player_id and clan["members"]:
-                clan["leader"] = clan["members"][0]
+                clan["leader"] = next(iter(clan["members"]))
             elif not clan["members"]:
                 # Удаляем пустой клан
                 del clans[clan_name]
+            update_joinable(clan_name)
+            invalidate_clan_directory()
     
     player["clan"] = None
-    save_players()
-    save_clans()
+    journal_record(player, "clan_leave", "clan")
+    save_players(player)
+    save_clans(clan_name)
     return True
 
 def send_pvp_request(from_id: str, to_id: str) -> bool:
@@ -630,8 +2283,8 @@ def set_class(player: Dict[str, Any], class_name: str) -> None:
     # Бонусы питомцев будут применяться при отображении статуса
     
     # Выдать стартовый квест
-    if "rat_hunter" not in player["quests"]:
-        player["quests"]["rat_hunter"] = {
+    if "rat_hunter" not in player["quests"] and not any(entry["id"] == "rat_hunter" for entry in player.get("quest_archive", [])):
+        add_quest(player, "rat_hunter", {
             "title": "Крысолов",
             "desc": "Убей 3 крыс в окрестностях.",
             "target_type": "rat",
@@ -639,100 +2292,163 @@ def set_class(player: Dict[str, Any], class_name: str) -> None:
             "progress": 0,
             "status": "active",
             "reward": {"xp": 100, "gold": 30, "item": "Малое зелье лечения"},
-        }
+        })
     
     # Проверяем достижения
-    check_achievements(player, "level_check")
-    check_achievements(player, "gold_check")
+    emit_event(player, "level_up")
+    emit_event(player, "gold_changed")
     
-    save_players()
+    journal_record(player, "set_class", "class", "quests", *STAT_FIELDS, *ACHIEVEMENT_FIELDS)
+    save_players(player)
 
-def add_item(player: Dict[str, Any], item_name: str, count: int = 1) -> None:
+def _put_item(player: Dict[str, Any], item: Any, count: int) -> None:
+    key = item_id(item)
+    if key is None:
+        key = item
     inv = player["inventory"]
-    inv[item_name] = inv.get(item_name, 0) + count
-    save_players()
+    inv[key] = inv.get(key, 0) + count
+
+def add_item(player: Dict[str, Any], item: Any, count: int = 1) -> None:
+    """Кладёт предмет (ID или название) в инвентарь; ключ инвентаря — ID предмета."""
+    _put_item(player, item, count)
+    if emit_event(player, "item_added"):
+        journal_record(player, "add_item", *ACHIEVEMENT_FIELDS)
+    else:
+        journal_record(player, "add_item", "inventory")
+    save_players(player)
 
-def consume_item(player: Dict[str, Any], item_name: str, count: int = 1) -> bool:
+def consume_item(player: Dict[str, Any], item: Any, count: int = 1) -> bool:
+    key = item_id(item)
+    if key is None:
+        key = item
     inv = player["inventory"]
-    if inv.get(item_name, 0) >= count:
-        inv[item_name] -= count
-        if inv[item_name] <= 0:
-            del inv[item_name]
-        save_players()
+    if inv.get(key, 0) >= count:
+        inv[key] -= count
+        if inv[key] <= 0:
+            del inv[key]
+        journal_record(player, "consume_item", "inventory")
+        save_players(player)
         return True
     return False
 
-def heal_player(player: Dict[str, Any], amount: int) -> int:
-    before = player["hp"]
-    player["hp"] = min(player["max_hp"], player["hp"] + amount)
-    save_players()
-    return player["hp"] - before
+def heal_player(player: Player, amount: int) -> int:
+    before = player.hp
+    player.hp = min(player.max_hp, player.hp + amount)
+    journal_record(player, "heal", "hp")
+    save_players(player)
+    return player.hp - before
 
-def grant_rewards(player: Dict[str, Any], xp: int, gold: int, loot: Optional[str] = None) -> str:
+def grant_rewards(player: Dict[str, Any], xp: int, gold: int, loot: Optional[str] = None, event: Optional[str] = None) -> str:
+    """Выдаёт опыт, золото и добычу. event — событие, за которое награда ("enemy_killed", ...)."""
     player["xp"] += xp
     player["gold"] += gold
     loot_text = ""
+    earned_achievements = []
     if loot:
-        add_item(player, loot, 1)
+        _put_item(player, loot, 1)
+        earned_achievements.extend(emit_event(player, "item_added"))
         loot_text = f"\nДобыча: {loot}"
     
     # Проверяем достижения
-    earned_achievements = []
-    earned_achievements.extend(check_achievements(player, "first_kill"))
-    earned_achievements.extend(check_achievements(player, "gold_check"))
-    earned_achievements.extend(check_achievements(player, "level_check"))
+    if event:
+        earned_achievements.extend(emit_event(player, event))
+    earned_achievements.extend(emit_event(player, "gold_changed"))
     
     level_up_text = check_level_up(player)
+    if level_up_text:
+        earned_achievements.extend(emit_event(player, "level_up"))
     
-    # Выдаем награды за достижения
-    achievement_text = ""
-    for achievement_id in earned_achievements:
-        reward_text = grant_achievement_rewards(player, achievement_id)
-        achievement_text += f"\n🏆 {ACHIEVEMENTS[achievement_id]['name']}: {reward_text}"
+    # Награды за достижения уже выданы в emit_event
+    achievement_text = format_achievements(earned_achievements)
     
-    save_players()
+    journal_record(player, "grant_rewards", *REWARD_FIELDS)
+    save_players(player)
     return f"+{xp} XP, +{gold} золота.{loot_text}{level_up_text}{achievement_text}"
 
+# ----------------------------- Квесты -----------------------------
+#
+# В player["quests"] лежат только активные квесты. Выполненный квест уходит в
+# player["quest_archive"] (ID, название, время; не больше QUEST_ARCHIVE_SIZE последних),
+# а общее число выполненных — в counters["quests_completed"]. Для убийств в записи игрока
+# держится индекс target_type -> ID активных квестов, поэтому убийство трогает только
+# подходящие квесты. Индекс строится при первом обращении и обновляется add_quest и
+# complete_quest — квесты нужно менять только через них.
+
+def quest_index(player: Player) -> Dict[str, List[str]]:
+    index = getattr(player, "_quest_index", None)
+    if index is None:
+        index = {}
+        for quest_id, quest in player["quests"].items():
+            if quest.get("status") == "active":
+                index.setdefault(quest.get("target_type"), []).append(quest_id)
+        player._quest_index = index
+    return index
+
+def add_quest(player: Player, quest_id: str, quest: Dict[str, Any]) -> None:
+    if quest_id in player["quests"]:
+        # Квест заменяется — индекс проще построить заново
+        player._quest_index = None
+    player["quests"][quest_id] = quest
+    index = getattr(player, "_quest_index", None)
+    if index is not None:
+        index.setdefault(quest.get("target_type"), []).append(quest_id)
+
+def complete_quest(player: Player, quest_id: str) -> Dict[str, Any]:
+    """Убирает квест из активных в архив и возвращает его."""
+    quest = player["quests"].pop(quest_id)
+    quest["status"] = "completed"
+    index = getattr(player, "_quest_index", None)
+    if index is not None:
+        ids = index.get(quest.get("target_type"), [])
+        if quest_id in ids:
+            ids.remove(quest_id)
+    archive = player.setdefault("quest_archive", [])
+    archive.append({"id": quest_id, "title": quest.get("title", "Без названия"), "t": round(time.time())})
+    del archive[:-QUEST_ARCHIVE_SIZE]
+    return quest
+
+def count_active_quests(player: Player) -> int:
+    return len(player["quests"])
+
 def update_quests_on_enemy_kill(player: Dict[str, Any], enemy_type: str) -> str:
     """Обновляет прогресс всех подходящих активных квестов при убийстве врага.
     Возвращает текст с сообщениями о прогрессе/выполнении."""
     if not player or "quests" not in player:
         return ""
 
-    updates: List[str] = []
-    changed: bool = False
+    index = quest_index(player)
+    matching = index.get(enemy_type, []) + (index.get("enemies_killed", []) if enemy_type != "enemies_killed" else [])
+    if not matching:
+        return ""
 
-    for quest in player["quests"].values():
-        if quest.get("status") != "active":
-            continue
+    updates: List[str] = []
 
-        target_type = quest.get("target_type")
-        if target_type in (enemy_type, "enemies_killed"):
-            # Инкремент прогресса
-            quest["progress"] = int(quest.get("progress", 0)) + 1
-            changed = True
-
-            # Проверяем завершение
-            required = int(quest.get("required", 0))
-            if required and quest["progress"] >= required:
-                quest["status"] = "completed"
-                rew = quest.get("reward", {})
-                add_text = grant_rewards(
-                    player,
-                    int(rew.get("xp", 0)),
-                    int(rew.get("gold", 0)),
-                    rew.get("item")
-                )
-                # Достижение за квесты
-                check_achievements(player, "quest_complete")
-                updates.append(f"\n✅ Квест '{quest.get('title', 'Без названия')}' выполнен! {add_text}")
-            else:
-                updates.append(
-                    f"\nКвест '{quest.get('title', 'Без названия')}': прогресс {quest.get('progress', 0)}/{quest.get('required', 0)}."
-                )
+    for quest_id in matching:
+        quest = player["quests"][quest_id]
+        # Инкремент прогресса
+        quest["progress"] = int(quest.get("progress", 0)) + 1
+
+        # Проверяем завершение
+        required = int(quest.get("required", 0))
+        if required and quest["progress"] >= required:
+            complete_quest(player, quest_id)
+            rew = quest.get("reward", {})
+            # Достижение за квесты проверяется вместе с наградой
+            add_text = grant_rewards(
+                player,
+                int(rew.get("xp", 0)),
+                int(rew.get("gold", 0)),
+                rew.get("item"),
+                event="quest_completed"
+            )
+            updates.append(f"\n✅ Квест '{quest.get('title', 'Без названия')}' выполнен! {add_text}")
+        else:
+            updates.append(
+                f"\nКвест '{quest.get('title', 'Без названия')}': прогресс {quest.get('progress', 0)}/{quest.get('required', 0)}."
+            )
 
-    if changed:
-        save_players()
+    journal_record(player, "quest_progress", "quests", "quest_archive")
+    save_players(player)
 
     return "".join(updates)
 
@@ -749,7 +2465,8 @@ def check_level_up(player: Dict[str, Any]) -> str:
         player["hp"] = player["max_hp"]
         text += f"\n🔺 Уровень повышен! Теперь {player['level']} уровень. HP восстановлено."
     if text:
-        save_players()
+        journal_record(player, "level_up", *STAT_FIELDS)
+        save_players(player)
     return text
 
 def generate_enemy(level: int) -> Dict[str, Any]:
@@ -789,16 +2506,59 @@ def ability_description(class_name: str) -> str:
         return "Теневая атака: удар, игнорирующий защиту, один раз за бой."
     return ""
 
+# ----------------------------- Кэш клавиатур -----------------------------
+#
+# Постоянные клавиатуры (бой, список игр казино) строятся один раз при импорте.
+# Клавиатуры, зависящие от игрока, кэшируются по ключу из тех полей, которые они
+# читают: количества предметов магазина и купленные питомцы, уровни бизнесов, баланс.
+# Изменение любого из этих полей даёт новый ключ, поэтому отдельная инвалидация не нужна.
+# Разметка PTB неизменяема, одну и ту же клавиатуру можно отдавать разным игрокам.
+
+KEYBOARD_CACHE_SIZE = int(os.getenv("KEYBOARD_CACHE_SIZE", "4096"))
+_keyboards: "OrderedDict[tuple, InlineKeyboardMarkup]" = OrderedDict()
+keyboard_stats = {"hits": 0, "misses": 0}
+
+def _cached_keyboard(key: tuple, build) -> InlineKeyboardMarkup:
+    markup = _keyboards.get(key)
+    if markup is not None:
+        keyboard_stats["hits"] += 1
+        _keyboards.move_to_end(key)
+        return markup
+    keyboard_stats["misses"] += 1
+    markup = _keyboards[key] = build()
+    if len(_keyboards) > KEYBOARD_CACHE_SIZE:
+        _keyboards.popitem(last=False)
+    return markup
+
+def get_keyboard_stats() -> Dict[str, Any]:
+    stats = dict(keyboard_stats)
+    total = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / total if total else 0.0
+    stats["size"] = len(_keyboards)
+    return stats
+
+BATTLE_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🗡️ Атака", callback_data="battle:attack"),
+     InlineKeyboardButton("✨ Способность", callback_data="battle:ability")],
+    [InlineKeyboardButton("🧪 Зелье", callback_data="battle:potion"),
+     InlineKeyboardButton("🏃 Бег", callback_data="battle:run")],
+])
+
 def build_battle_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🗡️ Атака", callback_data="battle:attack"),
-         InlineKeyboardButton("✨ Способность", callback_data="battle:ability")],
-        [InlineKeyboardButton("🧪 Зелье", callback_data="battle:potion"),
-         InlineKeyboardButton("🏃 Бег", callback_data="battle:run")],
-    ])
+    return BATTLE_KB
 
 def build_shop_kb(player: Dict[str, Any] = None) -> InlineKeyboardMarkup:
     """Улучшенная клавиатура магазина с массовой покупкой"""
+    if player:
+        counts = tuple(player["inventory"].get(meta["id"], 0) for meta in SHOP_ITEMS.values())
+        owned_pets = player.get("pets", [])
+        pets = tuple(meta["pet_id"] in owned_pets for meta in SHOP_ITEMS.values() if meta["type"] == "pet")
+    else:
+        counts = (0,) * len(SHOP_ITEMS)
+        pets = (False,) * sum(1 for meta in SHOP_ITEMS.values() if meta["type"] == "pet")
+    return _cached_keyboard(("shop", counts, pets), lambda: _build_shop_kb(counts, pets))
+
+def _build_shop_kb(counts: tuple, pets_owned: tuple) -> InlineKeyboardMarkup:
     buttons = []
     
     # Группируем предметы по типам
@@ -806,16 +2566,9 @@ def build_shop_kb(player: Dict[str, Any] = None) -> InlineKeyboardMarkup:
     equipment = []
     pets = []
     
-    for item_name, meta in SHOP_ITEMS.items():
-        emoji = meta.get("emoji", "📦")
-        price = meta['price']
+    for (item_name, meta), inventory_count in zip(SHOP_ITEMS.items(), counts):
         item_type = meta["type"]
         
-        # Показываем количество в инвентаре
-        inventory_count = 0
-        if player:
-            inventory_count = player["inventory"].get(item_name, 0)
-        
         if item_type == "consumable":
             consumables.append((item_name, meta, inventory_count))
         elif item_type == "equipment":
@@ -831,7 +2584,7 @@ def build_shop_kb(player: Dict[str, Any] = None) -> InlineKeyboardMarkup:
             price = meta['price']
             buttons.append([InlineKeyboardButton(
                 f"{emoji} {item_name} ({price}💰) x{count}",
-                callback_data=f"shop:buy:{item_name}"
+                callback_data=f"shop:buy:{meta['id']}"
             )])
     
     # Экипировка
@@ -842,21 +2595,20 @@ def build_shop_kb(player: Dict[str, Any] = None) -> InlineKeyboardMarkup:
             price = meta['price']
             buttons.append([InlineKeyboardButton(
                 f"{emoji} {item_name} ({price}💰) x{count}",
-                callback_data=f"shop:buy:{item_name}"
+                callback_data=f"shop:buy:{meta['id']}"
             )])
     
     # Питомцы
     if pets:
         buttons.append([InlineKeyboardButton("🐾 Питомцы", callback_data="shop:category:pet")])
-        for item_name, meta, count in pets:
+        for (item_name, meta, count), owned in zip(pets, pets_owned):
             emoji = meta.get("emoji", "📦")
             price = meta['price']
-            pet_id = meta["pet_id"]
             
-            if player and pet_id in player.get("pets", []):
+            if owned:
                 buttons.append([InlineKeyboardButton(f"{emoji} {item_name} ✅ (Уже есть)", callback_data="shop:already_owned")])
             else:
-                buttons.append([InlineKeyboardButton(f"{emoji} {item_name} ({price}💰)", callback_data=f"shop:buy:{item_name}")])
+                buttons.append([InlineKeyboardButton(f"{emoji} {item_name} ({price}💰)", callback_data=f"shop:buy:{meta['id']}")])
     
     # Кнопки массовой покупки
     buttons.append([InlineKeyboardButton("🛒 Массовая покупка", callback_data="shop:bulk")])
@@ -874,21 +2626,31 @@ def build_bulk_shop_kb(player: Dict[str, Any]) -> InlineKeyboardMarkup:
         if meta["type"] == "consumable":
             emoji = meta.get("emoji", "📦")
             price = meta['price']
-            inventory_count = player["inventory"].get(item_name, 0)
+            inventory_count = player["inventory"].get(meta["id"], 0)
             
             buttons.append([InlineKeyboardButton(
                 f"{emoji} {item_name} x{inventory_count}",
-                callback_data=f"shop:bulk:{item_name}"
+                callback_data=f"shop:bulk:{meta['id']}"
             )])
     
     buttons.append([InlineKeyboardButton("🔙 Назад", callback_data="shop:back")])
     return InlineKeyboardMarkup(buttons)
 
+# Доход бизнесов за минуту кэшируется в записи игрока (player._income) и сбрасывается
+# при покупке и улучшении (invalidate_business_income). Накопленный доход считается
+# в закрытой форме: ставка * целые минуты с последнего сбора, без обхода бизнесов.
+# BUSINESS_OFFLINE_CAP_MIN ограничивает, за сколько минут копится доход (0 — без лимита).
+
+BUSINESS_OFFLINE_CAP_MIN = int(os.getenv("BUSINESS_OFFLINE_CAP_MIN", "0"))
+BUSINESS_AGGREGATE_INTERVAL = float(os.getenv("BUSINESS_AGGREGATE_INTERVAL", "60"))
+
 def get_business_income_info(player: Dict[str, Any]) -> Dict[str, Any]:
-    """Получает информацию о доходе от бизнесов"""
+    """Получает информацию о доходе от бизнесов (из кэша). Словарь не изменять."""
+    info = getattr(player, "_income", None)
+    if info is not None:
+        return info
     owned = player.get("businesses", {})
     total_income_per_min = 0
-    total_income_per_hour = 0
     business_details = []
     
     for biz_id, meta in owned.items():
@@ -896,40 +2658,104 @@ def get_business_income_info(player: Dict[str, Any]) -> Dict[str, Any]:
             base_income = BUSINESSES[biz_id]["income_per_min"]
             level = meta.get("level", 1)
             income_per_min = base_income * level
-            income_per_hour = income_per_min * 60
-            
             total_income_per_min += income_per_min
-            total_income_per_hour += income_per_hour
             
             business_details.append({
                 "id": biz_id,
                 "name": BUSINESSES[biz_id]["name"],
                 "level": level,
                 "income_per_min": income_per_min,
-                "income_per_hour": income_per_hour,
+                "income_per_hour": income_per_min * 60,
                 "upgrade_cost": int(BUSINESSES[biz_id]["price"] * 0.5)
             })
     
-    return {
+    info = {
         "total_per_min": total_income_per_min,
-        "total_per_hour": total_income_per_hour,
-        "businesses": business_details
+        "total_per_hour": total_income_per_min * 60,
+        "businesses": business_details,
+        # Уровни в порядке BUSINESSES (0 — не куплен) — ключ клавиатуры бизнесов
+        "levels": tuple(owned[biz_id].get("level", 1) if biz_id in owned else 0 for biz_id in BUSINESSES),
     }
+    if isinstance(player, Player):
+        player._income = info
+    return info
+
+def invalidate_business_income(player: Dict[str, Any]) -> None:
+    """Сбрасывает кэш дохода; вызывать после любого изменения player["businesses"]."""
+    if isinstance(player, Player):
+        player._income = None
+
+def accrued_business_income(player: Dict[str, Any], now: Optional[float] = None) -> tuple:
+    """(доход, минуты), накопленные с последнего сбора, с учётом BUSINESS_OFFLINE_CAP_MIN."""
+    last = last_used(player, "biz_claim")
+    if last is None:
+        return 0, 0
+    if now is None:
+        now = time.time()
+    minutes = max(0, int((now - last) // 60))
+    if BUSINESS_OFFLINE_CAP_MIN > 0:
+        minutes = min(minutes, BUSINESS_OFFLINE_CAP_MIN)
+    return get_business_income_info(player)["total_per_min"] * minutes, minutes
+
+def claim_business_income(player: Dict[str, Any], now: Optional[float] = None) -> tuple:
+    """Зачисляет накопленный доход и возвращает (доход, минуты). Сохраняет вызывающий."""
+    if now is None:
+        now = time.time()
+    income, minutes = accrued_business_income(player, now)
+    last = last_used(player, "biz_claim")
+    if last is None or (BUSINESS_OFFLINE_CAP_MIN > 0 and now - last >= (BUSINESS_OFFLINE_CAP_MIN + 1) * 60):
+        # Сверх лимита доход не копится — отсчёт начинается заново
+        mark_used(player, "biz_claim", now)
+    else:
+        # Неполная минута не сгорает: отметка сдвигается ровно на зачтённые минуты
+        mark_used(player, "biz_claim", last + minutes * 60)
+    player["gold"] += income
+    return income, minutes
+
+# Сводка по доходу бизнесов для /metrics. Её раз в BUSINESS_AGGREGATE_INTERVAL секунд
+# пересчитывает фоновая задача по игрокам в памяти, обработчики её не трогают.
+# В ленивых хранилищах (sharded, sqlite) в памяти только кэш PLAYER_CACHE_SIZE недавно
+# активных игроков — сводка по ним, scope="cached" и players — сколько игроков учтено.
+# Читать ради неё всё хранилище каждые несколько секунд слишком дорого.
+# /status её не читает: накопленный доход одного игрока считается за O(1) на месте
+# и, в отличие от сводки, не отстаёт на интервал пересчёта.
+business_totals: Dict[str, Any] = {"owners": 0, "per_min": 0, "pending": 0, "updated": None,
+                                   "scope": "cached" if storage.lazy else "all", "players": 0}
+
+def aggregate_business_income(now: Optional[float] = None) -> Dict[str, Any]:
+    """Пересчитывает business_totals по игрокам в памяти (в ленивых хранилищах — по кэшу)."""
+    if now is None:
+        now = time.time()
+    owners = per_min = pending = counted = 0
+    for _, player in players.items():
+        counted += 1
+        rate = get_business_income_info(player)["total_per_min"]
+        if rate:
+            owners += 1
+            per_min += rate
+            pending += accrued_business_income(player, now)[0]
+    business_totals.update(owners=owners, per_min=per_min, pending=pending, updated=now,
+                           scope="cached" if storage.lazy else "all", players=counted)
+    return business_totals
+
+async def business_income_aggregator() -> None:
+    """Периодически обновляет business_totals."""
+    while True:
+        await asyncio.sleep(BUSINESS_AGGREGATE_INTERVAL)
+        try:
+            aggregate_business_income()
+        except Exception:
+            # Ошибка одного прохода не должна навсегда останавливать сводку
+            logger.exception("Не удалось пересчитать доход бизнесов")
 
 def get_time_until_next_daily(player: Dict[str, Any]) -> str:
     """Возвращает время до следующей ежедневной награды"""
-    if not player.get("last_daily_reward"):
+    remaining = cooldown_remaining(player, "daily")
+    if remaining <= 0:
         return "Доступно сейчас!"
     
-    last_claim = datetime.fromisoformat(player["last_daily_reward"])
-    now = datetime.now()
-    time_diff = timedelta(hours=24) - (now - last_claim)
-    
-    if time_diff.total_seconds() <= 0:
-        return "Доступно сейчас!"
-    
-    hours = int(time_diff.total_seconds() // 3600)
-    minutes = int((time_diff.total_seconds() % 3600) // 60)
+    hours = int(remaining // 3600)
+    minutes = int((remaining % 3600) // 60)
     
     if hours > 0:
         return f"{hours}ч {minutes}м"
@@ -938,25 +2764,26 @@ def get_time_until_next_daily(player: Dict[str, Any]) -> str:
 
 def build_businesses_kb(player: Dict[str, Any]) -> InlineKeyboardMarkup:
     """Улучшенная клавиатура бизнесов с детальной информацией"""
+    levels = get_business_income_info(player)["levels"]
+    return _cached_keyboard(("biz", levels), lambda: _build_businesses_kb(levels))
+
+def _build_businesses_kb(levels: tuple) -> InlineKeyboardMarkup:
     buttons = []
-    owned = player.get("businesses", {})
-    income_info = get_business_income_info(player)
     
     # Заголовок с общей информацией
-    total_income = income_info["total_per_min"]
+    total_income = sum(meta["income_per_min"] * level for meta, level in zip(BUSINESSES.values(), levels))
     buttons.append([InlineKeyboardButton(
-        f"💰 Общий доход: {total_income}/мин ({income_info['total_per_hour']}/час)",
+        f"💰 Общий доход: {total_income}/мин ({total_income * 60}/час)",
         callback_data="biz:info"
     )])
     
     # Доступные для покупки бизнесы
-    for biz_id, meta in BUSINESSES.items():
+    for (biz_id, meta), level in zip(BUSINESSES.items(), levels):
         name = meta["name"]
         price = meta["price"]
         income = meta["income_per_min"]
         
-        if biz_id in owned:
-            level = owned[biz_id].get("level", 1)
+        if level:
             current_income = income * level
             upgrade_cost = int(price * 0.5)
             buttons.append([InlineKeyboardButton(
@@ -977,14 +2804,14 @@ def build_businesses_kb(player: Dict[str, Any]) -> InlineKeyboardMarkup:
     
     return InlineKeyboardMarkup(buttons)
 
-def battle_text(player: Dict[str, Any], enemy: Dict[str, Any], log: str = "") -> str:
+def battle_text(player: Player, enemy: Dict[str, Any], log: str = "") -> str:
     # Получаем характеристики с учетом бонусов питомцев
-    stats_with_pets = get_player_stats_with_pets(player)
+    stats_with_pets = get_derived_stats(player)
     
     return (
         f"⚔️ Бой: {enemy['name']}\n"
         f"Враг HP: {enemy['hp']}/{enemy['max_hp']}\n"
-        f"Ты HP: {stats_with_pets['hp']}/{stats_with_pets['max_hp']}\n"
+        f"Ты HP: {player.hp}/{stats_with_pets['max_hp']}\n"
         f"Атака/Защита: {stats_with_pets['attack']}/{stats_with_pets['defense']}\n\n"
         f"{log}"
     )
@@ -1000,8 +2827,7 @@ def build_casino_kb(player: Dict[str, Any]) -> InlineKeyboardMarkup:
     buttons.append([InlineKeyboardButton("🚪 Выход", callback_data="casino:exit")])
     return InlineKeyboardMarkup(buttons)
 
-def build_casino_games_kb() -> InlineKeyboardMarkup:
-    """Улучшенная клавиатура с играми казино и быстрыми ставками"""
+def _build_casino_games_kb() -> InlineKeyboardMarkup:
     keyboard = []
     
     # Быстрые ставки
@@ -1026,30 +2852,37 @@ def build_casino_games_kb() -> InlineKeyboardMarkup:
     
     return InlineKeyboardMarkup(keyboard)
 
-def build_quick_bets_kb(player: Dict[str, Any]) -> InlineKeyboardMarkup:
-    """Клавиатура быстрых ставок"""
-    balance = player["gold"]
-    keyboard = []
-    
+CASINO_GAMES_KB = _build_casino_games_kb()
+
+def build_casino_games_kb() -> InlineKeyboardMarkup:
+    """Улучшенная клавиатура с играми казино и быстрыми ставками"""
+    return CASINO_GAMES_KB
+
+QUICK_BET_PERCENTAGES = (10, 25, 50, 75, 100)
+QUICK_BET_FIXED = (10, 25, 50, 100, 250, 500)
+
+def quick_bets(balance: int) -> tuple:
+    """Кнопки быстрых ставок при данном балансе: ((подпись, ставка), ...)."""
+    bets = []
     # Процентные ставки
-    percentages = [10, 25, 50, 75, 100]
-    for percent in percentages:
+    for percent in QUICK_BET_PERCENTAGES:
         bet_amount = int(balance * percent / 100)
         if bet_amount >= 5:  # Минимальная ставка
-            keyboard.append([InlineKeyboardButton(
-                f"{percent}% = {bet_amount}💰",
-                callback_data=f"casino:quick_bet:{bet_amount}"
-            )])
-    
+            bets.append((f"{percent}% = {bet_amount}💰", bet_amount))
     # Фиксированные ставки
-    fixed_bets = [10, 25, 50, 100, 250, 500]
-    for bet in fixed_bets:
+    for bet in QUICK_BET_FIXED:
         if bet <= balance:
-            keyboard.append([InlineKeyboardButton(
-                f"{bet}💰",
-                callback_data=f"casino:quick_bet:{bet}"
-            )])
-    
+            bets.append((f"{bet}💰", bet))
+    return tuple(bets)
+
+def build_quick_bets_kb(player: Dict[str, Any]) -> InlineKeyboardMarkup:
+    """Клавиатура быстрых ставок"""
+    # Ключ — сами показанные кнопки: балансы с одинаковыми ставками делят одну клавиатуру
+    bets = quick_bets(player["gold"])
+    return _cached_keyboard(("bets", bets), lambda: _build_quick_bets_kb(bets))
+
+def _build_quick_bets_kb(bets: tuple) -> InlineKeyboardMarkup:
+    keyboard = [[InlineKeyboardButton(label, callback_data=f"casino:quick_bet:{bet}")] for label, bet in bets]
     keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="casino:back")])
     return InlineKeyboardMarkup(keyboard)
 
@@ -1072,7 +2905,8 @@ def add_casino_history(player: Dict[str, Any], game_type: str, bet: int, result:
     if len(player["casino_history"]) > 20:
         player["casino_history"] = player["casino_history"][-20:]
     
-    save_players()
+    journal_record(player, "casino_history", "casino_history")
+    save_players(player)
 
 def get_casino_stats(player: Dict[str, Any]) -> Dict[str, Any]:
     """Получает статистику казино"""
@@ -1105,15 +2939,12 @@ def play_casino_game(player: Dict[str, Any], game_type: str, bet: int) -> Dict[s
         return {"success": False, "message": "❌ Недостаточно золота!"}
     
     # Проверка кулдауна (раз в 30 секунд)
-    last_play = player.get("last_casino_play")
-    if last_play:
-        last_play = datetime.fromisoformat(last_play)
-        elapsed = (datetime.now() - last_play).total_seconds()
-        if elapsed < 30:
-            return {"success": False, "message": f"⏳ Подождите {int(30 - elapsed)} секунд перед следующей игрой"}
+    remaining = cooldown_remaining(player, "casino")
+    if remaining > 0:
+        return {"success": False, "message": f"⏳ Подождите {int(remaining)} секунд перед следующей игрой"}
     
     player["gold"] -= bet
-    player["last_casino_play"] = datetime.now().isoformat()
+    mark_used(player, "casino")
     
     # Логика игр
     if game_type == "double":
@@ -1121,8 +2952,7 @@ def play_casino_game(player: Dict[str, Any], game_type: str, bet: int) -> Dict[s
             prize = bet * game["multiplier"]
             player["gold"] += prize
             # Проверяем достижения
-            check_achievements(player, "casino_win")
-            check_achievements(player, "casino_total_wins")
+            emit_event(player, "casino_win")
             return {"success": True, "message": f"🎉 Победа! Выиграли {prize} золота!", "prize": prize}
         return {"success": False, "message": f"💸 Проигрыш! Потеряли {bet} золота."}
     
@@ -1133,8 +2963,7 @@ def play_casino_game(player: Dict[str, Any], game_type: str, bet: int) -> Dict[s
             prize = int(bet * game["multiplier"])
             player["gold"] += prize
             # Проверяем достижения
-            check_achievements(player, "casino_win")
-            check_achievements(player, "casino_total_wins")
+            emit_event(player, "casino_win")
             return {"success": True, "message": f"🎲 Вы: {player_roll} | Казино: {casino_roll}\n🏆 Выиграли {prize} золота!"}
         elif player_roll == casino_roll:
             player["gold"] += bet
@@ -1151,8 +2980,7 @@ def play_casino_game(player: Dict[str, Any], game_type: str, bet: int) -> Dict[s
             prize = bet * game["multiplier"]
             player["gold"] += prize
             # Проверяем достижения
-            check_achievements(player, "casino_win")
-            check_achievements(player, "casino_total_wins")
+            emit_event(player, "casino_win")
             return {"success": True, "message": f"🎡 Выпало: {color}{number}\n🎉 Выиграли {prize} золота!"}
         else:
             return {"success": False, "message": f"🎡 Выпало: {color}{number}\n💸 Проиграли {bet} золота."}
@@ -1163,8 +2991,7 @@ def play_casino_game(player: Dict[str, Any], game_type: str, bet: int) -> Dict[s
         if len(set(result)) == 1:  # Все символы одинаковые
             prize = bet * game["multiplier"]
             player["gold"] += prize
-            check_achievements(player, "casino_win")
-            check_achievements(player, "casino_total_wins")
+            emit_event(player, "casino_win")
             return {"success": True, "message": f"🎰 {' '.join(result)}\n🎉 ДЖЕКПОТ! Выиграли {prize} золота!"}
         else:
             return {"success": False, "message": f"🎰 {' '.join(result)}\n💸 Проиграли {bet} золота."}
@@ -1179,21 +3006,19 @@ def play_casino_game(player: Dict[str, Any], game_type: str, bet: int) -> Dict[s
         if player_sum == 21:
             prize = bet * game["multiplier"]
             player["gold"] += prize
-            check_achievements(player, "casino_win")
-            check_achievements(player, "casino_total_wins")
+            emit_event(player, "casino_win")
             return {"success": True, "message": f"🃏 Блэкджек! Выиграли {prize} золота!"}
         elif player_sum > 21:
             return {"success": False, "message": f"🃏 Перебор! Проиграли {bet} золота."}
         elif dealer_sum > 21 or player_sum > dealer_sum:
             prize = int(bet * game["multiplier"])
             player["gold"] += prize
-            check_achievements(player, "casino_win")
-            check_achievements(player, "casino_total_wins")
+            emit_event(player, "casino_win")
             return {"success": True, "message": f"🃏 Победа! Выиграли {prize} золота!"}
         else:
             return {"success": False, "message": f"🃏 Проиграли {bet} золота."}
     
-    save_players()
+    save_players(player)
     return {"success": False, "message": "⚠️ Ошибка в игре"}
 
 # ----------------------------- Хендлеры команд -------------------------------
@@ -1246,7 +3071,8 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/daily - Ежедневные награды\n"
         "/pets - Питомцы\n"
         "/clans - Кланы\n"
-        "/pvp - PvP бои\n\n"
+        "/pvp - PvP бои\n"
+        "/top - Рейтинги\n\n"
         "🧪 <b>Предметы:</b>\n"
         "/use_potion - Использовать зелье\n\n"
         "🛠️ <b>Прочее:</b>\n"
@@ -1263,7 +3089,7 @@ async def status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     p = players[uid]
     
     # Получаем характеристики с учетом бонусов питомцев
-    stats_with_pets = get_player_stats_with_pets(p)
+    stats_with_pets = get_derived_stats(p)
     pet_bonuses = get_pet_bonuses(p)
     
     # Информация о бизнесах
@@ -1275,7 +3101,7 @@ async def status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = (
         f"📊 <b>Статус {p['name']} ({p['class'] or 'Без класса'})</b>\n\n"
         f"⚔️ Уровень: <b>{p['level']}</b> ({p['xp']}/{get_xp_to_next(p['level'])} XP)\n"
-        f"❤️ HP: <b>{stats_with_pets['hp']}/{stats_with_pets['max_hp']}</b>\n"
+        f"❤️ HP: <b>{p.hp}/{stats_with_pets['max_hp']}</b>\n"
         f"🗡️ Атака: <b>{stats_with_pets['attack']}</b> 🛡️ Защита: <b>{stats_with_pets['defense']}</b>\n"
         f"💰 Золото: <b>{p['gold']}</b>\n"
         f"🍀 Удача: <b>{stats_with_pets['luck']}</b>\n\n"
@@ -1284,7 +3110,8 @@ async def status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Информация о бизнесах
     if business_info["total_per_min"] > 0:
         text += f"💼 <b>Бизнесы:</b> {business_info['total_per_min']}/мин ({business_info['total_per_hour']}/час)\n"
-        text += f"📦 Владений: {len(p.get('businesses', {}))}\n\n"
+        text += f"📦 Владений: {len(p.get('businesses', {}))}\n"
+        text += f"📥 Накоплено: {accrued_business_income(p)[0]}💰\n\n"
     
     # Ежедневные награды
     text += f"🎁 <b>Ежедневная награда:</b> {daily_timer}\n\n"
@@ -1329,7 +3156,7 @@ async def achievements_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     p = players[uid]
     earned = p.get("achievements", {})
     
-    # Поля уже инициализированы в migrate_player_data()
+    # Поля уже инициализированы при загрузке игрока (upgrade_player)
     
     if not earned:
         await update.message.reply_text(
@@ -1425,7 +3252,7 @@ async def pets_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     p = players[uid]
     pets = p.get("pets", [])
     
-    # Поля уже инициализированы в migrate_player_data()
+    # Поля уже инициализированы при загрузке игрока (upgrade_player)
     
     if not pets:
         await update.message.reply_text(
@@ -1469,47 +3296,8 @@ async def clans_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     p = players[uid]
     
-    # Поля уже инициализированы в migrate_player_data()
-    
-    if p.get("clan"):
-        # Показать информацию о клане
-        clan_name = p["clan"]
-        if clan_name in clans:
-            clan = clans[clan_name]
-            text = (
-                f"🏰 <b>Клан: {clan['name']}</b>\n\n"
-                f"👑 Лидер: {players[clan['leader']]['name']}\n"
-                f"👥 Участников: {len(clan['members'])}/20\n"
-                f"📊 Уровень: {clan['level']}\n"
-                f"⭐ XP: {clan['xp']}\n"
-                f"📝 Описание: {clan['description']}\n\n"
-            )
-            
-            if clan["leader"] == uid:
-                text += "👑 Вы лидер клана"
-            else:
-                text += "👤 Вы участник клана"
-        else:
-            text = "❌ Ошибка: клан не найден"
-            p.pop("clan", None)  # Удаляем несуществующий клан
-            save_players()
-    else:
-        # Показать список кланов
-        if not clans:
-            text = (
-                "🏰 <b>Кланы:</b>\n\n"
-                "Пока нет созданных кланов.\n"
-                "Создайте свой клан!"
-            )
-        else:
-            text = "🏰 <b>Доступные кланы:</b>\n\n"
-            for clan_name, clan in clans.items():
-                text += f"{clan['color']} <b>{clan['name']}</b>\n"
-                text += f"👥 Участников: {len(clan['members'])}/20\n"
-                text += f"👑 Лидер: {players[clan['leader']]['name']}\n\n"
-    
-    # Создаем клавиатуру с кнопками
-    keyboard = build_clans_keyboard(p)
+    # Поля уже инициализированы при загрузке игрока (upgrade_player)
+    text, keyboard = render_clan_screen(p)
     
     await update.message.reply_text(text, parse_mode="HTML", reply_markup=keyboard)
 
@@ -1522,7 +3310,7 @@ async def pvp_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     p = players[uid]
     
-    # Поля уже инициализированы в migrate_player_data()
+    # Поля уже инициализированы при загрузке игрока (upgrade_player)
     
     wins = p["pvp_wins"]
     losses = p["pvp_losses"]
@@ -1626,6 +3414,7 @@ async def pvp_challenge_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "status": "pending",
         "messages": {}
     }
+    timers.schedule(duel_id, PVP_REQUEST_TTL, expire_duel)
 
     # Отправляем сообщения
     try:
@@ -1641,6 +3430,7 @@ async def pvp_challenge_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception:
         await update.message.reply_text("Не удалось доставить вызов. Вероятно, игрок не писал боту.")
         pvp_requests.pop(duel_id, None)
+        timers.cancel(duel_id)
         return
 
     from_msg = await update.message.reply_text(
@@ -1659,8 +3449,8 @@ async def start_duel(context: ContextTypes.DEFAULT_TYPE, duel_id: str):
     p2 = players[uid2]
 
     # Инициализируем боевые статы
-    s1 = get_player_stats_with_pets(p1)
-    s2 = get_player_stats_with_pets(p2)
+    s1 = get_derived_stats(p1)
+    s2 = get_derived_stats(p2)
     duel_state = {
         "id": duel_id,
         "p1_id": uid1,
@@ -1677,14 +3467,12 @@ async def start_duel(context: ContextTypes.DEFAULT_TYPE, duel_id: str):
     user_to_duel[uid1] = duel_id
     user_to_duel[uid2] = duel_id
 
-    text = format_pvp_battle_text(duel_state)
-    msgs = duel_state["messages"]
-    is_p1_turn = duel_state["turn"] == "p1"
     # Обновляем оба сообщения в боевой экран
-    await safe_edit_message_by_id(context.bot, msgs["from"]["chat_id"], msgs["from"]["message_id"], text, reply_markup=build_pvp_actions_kb(duel_id, is_p1_turn))
-    await safe_edit_message_by_id(context.bot, msgs["to"]["chat_id"], msgs["to"]["message_id"], text, reply_markup=build_pvp_actions_kb(duel_id, not is_p1_turn))
+    schedule_turn_timeout(duel_state)
+    render_duel(context.bot, duel_state)
 
 def end_duel(duel_id: str):
+    timers.cancel(duel_id)
     duel = active_duels.pop(duel_id, None)
     if not duel:
         return None
@@ -1693,12 +3481,59 @@ def end_duel(duel_id: str):
     pvp_requests.pop(duel_id, None)
     return duel
 
-async def update_duel_messages(context: ContextTypes.DEFAULT_TYPE, duel_state: Dict[str, Any]):
-    text = format_pvp_battle_text(duel_state)
+# Брошенные вызовы и дуэли снимаются по таймеру (ключ — duel_id): вызов без ответа
+# истекает через PVP_REQUEST_TTL, а игрок, не сходивший за PVP_TURN_TIMEOUT, проигрывает.
+
+PVP_REQUEST_TTL = float(os.getenv("PVP_REQUEST_TTL", "120"))
+PVP_TURN_TIMEOUT = float(os.getenv("PVP_TURN_TIMEOUT", "60"))
+
+def schedule_turn_timeout(duel_state: Dict[str, Any]) -> None:
+    """Перезапускает отсчёт хода; вызывать после каждой смены хода."""
+    duel_state["turn_deadline"] = time.monotonic() + PVP_TURN_TIMEOUT
+    timers.schedule(duel_state["id"], PVP_TURN_TIMEOUT, expire_duel)
+
+async def expire_duel(app, duel_id: str) -> None:
+    """Обработчик таймера: снимает вызов без ответа или завершает дуэль по таймауту хода."""
+    async with duel_locks.get(duel_id):
+        duel = active_duels.get(duel_id)
+        if duel is not None:
+            # Пока таймер ждал блокировку, ход мог быть сделан и отсчёт перезапущен
+            if time.monotonic() < duel.get("turn_deadline", 0):
+                return
+            loser = duel["p1_id"] if duel["turn"] == "p1" else duel["p2_id"]
+            winner = duel["p2_id"] if loser == duel["p1_id"] else duel["p1_id"]
+            # conclude_duel берёт из контекста только bot, он есть и у Application
+            await conclude_duel(app, duel, winner, loser, reason="время хода истекло")
+            return
+        req = pvp_requests.get(duel_id)
+        if req is None or req.get("status") != "pending":
+            return
+        pvp_requests.pop(duel_id, None)
+        msgs = req.get("messages", {})
+        for side in ("from", "to"):
+            if side in msgs:
+                queue_message_edit(app.bot, msgs[side]["chat_id"], msgs[side]["message_id"], "⌛ Вызов истёк без ответа", priority=PRIORITY_BULK)
+
+def render_duel(bot, duel_state: Dict[str, Any], text: Optional[str] = None) -> List[asyncio.Task]:
+    """Ставит в очередь правки сообщений обоих участников; они уходят параллельно.
+
+    Без text рисует боевой экран с кнопками, с text — итоговое сообщение без кнопок.
+    Правки склеиваются (queue_message_edit), поэтому обработчик не ждёт их под
+    блокировкой дуэли, а игроки видят последнее состояние боя."""
     msgs = duel_state["messages"]
-    is_p1_turn = duel_state["turn"] == "p1"
-    await safe_edit_message_by_id(context.bot, msgs["from"]["chat_id"], msgs["from"]["message_id"], text, reply_markup=build_pvp_actions_kb(duel_state["id"], is_p1_turn))
-    await safe_edit_message_by_id(context.bot, msgs["to"]["chat_id"], msgs["to"]["message_id"], text, reply_markup=build_pvp_actions_kb(duel_state["id"], not is_p1_turn))
+    if text is None:
+        text = format_pvp_battle_text(duel_state)
+        is_p1_turn = duel_state["turn"] == "p1"
+        markups = (build_pvp_actions_kb(duel_state["id"], is_p1_turn), build_pvp_actions_kb(duel_state["id"], not is_p1_turn))
+    else:
+        markups = (None, None)
+    return [
+        queue_message_edit(bot, msgs[side]["chat_id"], msgs[side]["message_id"], text, reply_markup=markup)
+        for side, markup in zip(("from", "to"), markups)
+    ]
+
+async def update_duel_messages(context: ContextTypes.DEFAULT_TYPE, duel_state: Dict[str, Any]):
+    render_duel(context.bot, duel_state)
 
 async def conclude_duel(context: ContextTypes.DEFAULT_TYPE, duel_state: Dict[str, Any], winner: str, loser: str, reason: str = ""):
     p_win = players[winner]
@@ -1710,8 +3545,11 @@ async def conclude_duel(context: ContextTypes.DEFAULT_TYPE, duel_state: Dict[str
     p_win["xp"] += 100
     p_lose["xp"] += 20
     # Достижение
-    check_achievements(p_win, "pvp_win")
-    save_players()
+    emit_event(p_win, "pvp_win")
+    journal_record(p_win, "pvp_win", *PVP_FIELDS)
+    journal_record(p_lose, "pvp_loss", *PVP_FIELDS)
+    save_players(p_win)
+    save_players(p_lose)
 
     text = (
         f"🏁 Дуэль завершена!\n\n"
@@ -1721,19 +3559,23 @@ async def conclude_duel(context: ContextTypes.DEFAULT_TYPE, duel_state: Dict[str
         + f"Награда победителю: +50💰, +100XP\n"
         + f"Проигравшему: +20XP"
     )
-    msgs = duel_state["messages"]
     # Завершаем: убираем кнопки
-    await safe_edit_message_by_id(context.bot, msgs["from"]["chat_id"], msgs["from"]["message_id"], text)
-    await safe_edit_message_by_id(context.bot, msgs["to"]["chat_id"], msgs["to"]["message_id"], text)
+    render_duel(context.bot, duel_state, text)
     end_duel(duel_state["id"]) 
 
 async def pvp_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    uid = str(query.from_user.id)
     parts = query.data.split(":")
-    if len(parts) < 2:
+    if len(parts) < 3:
         return
+    # Оба участника нажимают кнопки одновременно: состояние дуэли меняется под её блокировкой
+    async with duel_locks.get(parts[2]):
+        await handle_pvp_action(update, context, parts)
+
+async def handle_pvp_action(update: Update, context: ContextTypes.DEFAULT_TYPE, parts: List[str]):
+    query = update.callback_query
+    uid = str(query.from_user.id)
     action = parts[1]
 
     # Обработка отмены вызова до начала дуэли
@@ -1752,11 +3594,12 @@ async def pvp_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         msgs = req.get("messages", {})
         try:
             if "to" in msgs:
-                await safe_edit_message_by_id(context.bot, msgs["to"]["chat_id"], msgs["to"]["message_id"], "Вызов отменён")
+                await safe_edit_message_by_id(context.bot, msgs["to"]["chat_id"], msgs["to"]["message_id"], "Вызов отменён", priority=PRIORITY_BULK)
         except Exception:
             pass
         await safe_edit_message_text(query, "Вы отменили вызов")
         pvp_requests.pop(duel_id, None)
+        timers.cancel(duel_id)
         return
 
     # Принятие/отклонение вызова
@@ -1776,8 +3619,9 @@ async def pvp_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             msgs = req.get("messages", {})
             await safe_edit_message_text(query, "Вы отклонили вызов")
             if "from" in msgs:
-                await safe_edit_message_by_id(context.bot, msgs["from"]["chat_id"], msgs["from"]["message_id"], "Ваш вызов отклонён")
+                await safe_edit_message_by_id(context.bot, msgs["from"]["chat_id"], msgs["from"]["message_id"], "Ваш вызов отклонён", priority=PRIORITY_BULK)
             pvp_requests.pop(duel_id, None)
+            timers.cancel(duel_id)
             return
         # accept
         if is_in_duel(req["from_id"]) or is_in_duel(req["to_id"]):
@@ -1866,6 +3710,7 @@ async def pvp_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # Переход хода, если действие было не лечением? В любом случае меняем ход.
         duel["turn"] = defender_key
+        schedule_turn_timeout(duel)
         await update_duel_messages(context, duel)
         return
 
@@ -1879,7 +3724,7 @@ async def inventory_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("🎒 <b>Твой инвентарь пуст.</b>", parse_mode="HTML", reply_markup=MAIN_KB)
         return
     
-    items = "\n".join(f"▪️ {item} ×{count}" for item, count in p["inventory"].items())
+    items = "\n".join(f"▪️ {item_name(item)} ×{count}" for item, count in p["inventory"].items())
     await update.message.reply_text(
         f"🎒 <b>Инвентарь:</b>\n\n{items}\n\n"
         "ℹ️ Используй /use_potion для лечения",
@@ -1903,7 +3748,10 @@ async def use_potion_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text("❌ Нет Малых зелий лечения в инвентаре.")
 
-async def quests_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# Выполненных квестов на странице /quests
+QUESTS_PAGE_SIZE = 5
+
+async def quests_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = 0):
     uid = str(update.effective_user.id)
     query = getattr(update, "callback_query", None)
 
@@ -1917,35 +3765,39 @@ async def quests_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     p = players[uid]
     q = p["quests"]
 
-    if not q:
+    if not q and not get_counter(p, "quests_completed"):
         # Генерируем первый квест
         new_quest = generate_random_quest(p["level"])
         quest_id = f"random_quest_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        p["quests"][quest_id] = {
+        add_quest(p, quest_id, {
             **new_quest,
             "progress": 0,
             "status": "active"
-        }
-        save_players()
-        q = p["quests"]
+        })
+        journal_record(p, "quest_new", "quests")
+        save_players(p)
 
     quests_text: List[str] = []
-    active_count = 0
-    completed_count = 0
-
-    for quest_id, quest in q.items():
-        status = "✅" if quest.get("status") == "completed" else "⌛"
-        if quest.get("status") == "active":
-            active_count += 1
-        else:
-            completed_count += 1
+    active_count = count_active_quests(p)
+    completed_count = get_counter(p, "quests_completed")
 
+    for quest in q.values():
         quests_text.append(
-            f"{status} <b>{quest.get('title', 'Без названия')}</b>\n"
+            f"⌛ <b>{quest.get('title', 'Без названия')}</b>\n"
             f"📝 {quest.get('desc', '')}\n"
             f"📊 Прогресс: {quest.get('progress', 0)}/{quest.get('required', 0)}\n"
         )
 
+    # Выполненные квесты — постранично, новые сверху
+    archive = p.get("quest_archive", [])
+    pages = max(1, -(-len(archive) // QUESTS_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    end = len(archive) - page * QUESTS_PAGE_SIZE
+    done = archive[max(0, end - QUESTS_PAGE_SIZE):end]
+    if done:
+        quests_text.append(f"✅ <b>Выполненные</b> ({page + 1}/{pages}):")
+        quests_text.extend(f"✅ {entry['title']}" for entry in reversed(done))
+
     # Показываем статистику квестов
     stats_text = (
         f"📊 <b>Статистика квестов:</b>\n"
@@ -1957,6 +3809,13 @@ async def quests_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard: List[List[InlineKeyboardButton]] = []
     if active_count < 3:  # Максимум 3 активных квеста
         keyboard.append([InlineKeyboardButton("🎯 Новый квест", callback_data="quest:new")])
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("⬅️", callback_data=f"quest:page:{page - 1}"))
+        if page < pages - 1:
+            nav.append(InlineKeyboardButton("➡️", callback_data=f"quest:page:{page + 1}"))
+        keyboard.append(nav)
     keyboard.append([InlineKeyboardButton("🔄 Обновить", callback_data="quest:refresh")])
     keyboard.append([InlineKeyboardButton("🚪 Закрыть", callback_data="quest:close")])
 
@@ -1981,21 +3840,20 @@ async def adventure_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
+    p = players[uid]
+    
     # Проверка кулдауна
-    last_adventure = context.user_data.get("last_adventure")
-    if last_adventure:
-        cooldown = 6
-        elapsed = (datetime.now() - last_adventure).total_seconds()
-        if elapsed < cooldown:
-            remaining = int(cooldown - elapsed)
-            await update.message.reply_text(
-                f"Ты устал. Отдохни ещё {remaining} секунд.",
-                reply_markup=MAIN_KB
-            )
-            return
+    remaining = cooldown_remaining(p, "adventure")
+    if remaining > 0:
+        await update.message.reply_text(
+            f"Ты устал. Отдохни ещё {int(remaining)} секунд.",
+            reply_markup=MAIN_KB
+        )
+        return
     
-    p = players[uid]
-    context.user_data["last_adventure"] = datetime.now()
+    mark_used(p, "adventure")
+    journal_record(p, "adventure", "timers")
+    save_players(p)
     
     event = random.choice(["fight", "gold", "item", "merchant", "pet", "treasure", "mystery"])
     if event == "fight":
@@ -2014,7 +3872,8 @@ async def adventure_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif event == "gold":
         gain = random.randint(10, 25)
         p["gold"] += gain
-        save_players()
+        journal_record(p, "adventure_gold", "gold")
+        save_players(p)
         await update.message.reply_text(f"💰 Ты нашёл мешочек золота: +{gain} 💰. Теперь у тебя {p['gold']} золота.")
     elif event == "item":
         item = random.choice(list(SHOP_ITEMS.keys()))
@@ -2034,8 +3893,9 @@ async def adventure_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 pet_id = random.choice(available_pets)
                 p["pets"].append(pet_id)
                 pet = PETS[pet_id]
-                check_achievements(p, "pet_obtained")
-                save_players()
+                emit_event(p, "pet_obtained")
+                journal_record(p, "adventure_pet", "pets", *ACHIEVEMENT_FIELDS)
+                save_players(p)
                 await update.message.reply_text(
                     f"🐾 Поздравляем! Вы нашли питомца: {pet['emoji']} {pet['name']}!\n"
                     f"📊 Редкость: {pet['rarity'].title()}\n"
@@ -2051,7 +3911,8 @@ async def adventure_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         xp_gain = random.randint(20, 40)
         p["gold"] += gold_gain
         p["xp"] += xp_gain
-        save_players()
+        journal_record(p, "adventure_treasure", "gold", "xp")
+        save_players(p)
         await update.message.reply_text(
             f"💎 Сокровище! Вы нашли:\n"
             f"💰 Золото: +{gold_gain}\n"
@@ -2084,7 +3945,8 @@ async def adventure_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             elif stat == "item":
                 add_item(p, bonus, 1)
         
-        save_players()
+        journal_record(p, "adventure_mystery", *STAT_FIELDS)
+        save_players(p)
         await update.message.reply_text(
             f"🔮 {event_name}!\n"
             f"Вы получили бонусы к характеристикам!"
@@ -2121,7 +3983,7 @@ async def shop_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     p = players[uid]
-    data = query.data # shop:buy:ITEM, shop:bulk:ITEM, shop:close, shop:already_owned, shop:balance, shop:back
+    data = query.data # shop:buy:ITEM_ID, shop:bulk:ITEM_ID, shop:close, shop:already_owned, shop:balance, shop:back
 
     if data == "shop:close":
         context.user_data.pop("merchant_active", None)
@@ -2155,13 +4017,16 @@ async def shop_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     if data.startswith("shop:bulk:"):
-        _, _, item_name = data.split(":", 2)
-        if item_name not in SHOP_ITEMS:
+        _, _, item_key = data.split(":", 2)
+        # Старые сообщения могут содержать название вместо ID
+        iid = item_id(item_key)
+        if iid is None:
             await safe_edit_message_text(query, "Такого товара нет.")
             return
+        item_name = ITEM_NAMES[iid]
         
         # Начинаем процесс массовой покупки
-        context.user_data["bulk_buy_item"] = item_name
+        context.user_data["bulk_buy_item"] = iid
         context.user_data["awaiting_bulk_amount"] = True
         
         price = SHOP_ITEMS[item_name]["price"]
@@ -2194,16 +4059,16 @@ async def shop_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         for item_name, meta in category_items:
             emoji = meta.get("emoji", "📦")
             price = meta['price']
-            inventory_count = p["inventory"].get(item_name, 0)
+            inventory_count = p["inventory"].get(meta["id"], 0)
             
             if category == "pet":
                 pet_id = meta["pet_id"]
                 if pet_id in p.get("pets", []):
                     buttons.append([InlineKeyboardButton(f"{emoji} {item_name} ✅ (Уже есть)", callback_data="shop:already_owned")])
                 else:
-                    buttons.append([InlineKeyboardButton(f"{emoji} {item_name} ({price}💰)", callback_data=f"shop:buy:{item_name}")])
+                    buttons.append([InlineKeyboardButton(f"{emoji} {item_name} ({price}💰)", callback_data=f"shop:buy:{meta['id']}")])
             else:
-                buttons.append([InlineKeyboardButton(f"{emoji} {item_name} ({price}💰) x{inventory_count}", callback_data=f"shop:buy:{item_name}")])
+                buttons.append([InlineKeyboardButton(f"{emoji} {item_name} ({price}💰) x{inventory_count}", callback_data=f"shop:buy:{meta['id']}")])
         
         buttons.append([InlineKeyboardButton("🔙 Назад", callback_data="shop:back")])
         
@@ -2219,11 +4084,13 @@ async def shop_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    _, action, item_name = data.split(":", 2)
+    _, action, item_key = data.split(":", 2)
     if action == "buy":
-        if item_name not in SHOP_ITEMS:
+        iid = item_id(item_key)
+        if iid is None:
             await safe_edit_message_text(query, "Такого товара нет.")
             return
+        item_name = ITEM_NAMES[iid]
         
         price = SHOP_ITEMS[item_name]["price"]
         if p["gold"] < price:
@@ -2239,7 +4106,8 @@ async def shop_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         emoji = SHOP_ITEMS[item_name].get("emoji", "📦")
         
         if SHOP_ITEMS[item_name]["type"] == "consumable":
-            add_item(p, item_name, 1)
+            add_item(p, iid, 1)
+            journal_record(p, "shop_buy", "gold")
             await safe_edit_message_text(
                 query,
                 f"{emoji} Ты купил: {item_name}. В инвентаре пополнение!\n"
@@ -2255,7 +4123,8 @@ async def shop_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 p["defense"] += effect["defense_plus"]
             if "luck_plus" in effect:
                 p["luck"] = p.get("luck", 0) + effect["luck_plus"]
-            save_players()
+            journal_record(p, "shop_buy", *SHOP_FIELDS)
+            save_players(p)
             await safe_edit_message_text(
                 query,
                 f"{emoji} Ты купил и экипировал: {item_name}. Твоя сила растёт!\n"
@@ -2267,9 +4136,10 @@ async def shop_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pet_id = SHOP_ITEMS[item_name]["pet_id"]
             if pet_id not in p.get("pets", []):
                 p.setdefault("pets", []).append(pet_id)
-                save_players()
                 # Проверяем достижения
-                check_achievements(p, "pet_check", len(p["pets"]))
+                emit_event(p, "pet_obtained")
+                journal_record(p, "shop_buy", *SHOP_FIELDS)
+                save_players(p)
                 await safe_edit_message_text(
                     query,
                     f"{emoji} Ты купил питомца: {item_name}! Теперь у тебя {len(p['pets'])} питомцев.\n"
@@ -2336,26 +4206,9 @@ async def businesses_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
     
     if data == "biz:claim":
-        last = p.get("last_business_claim")
-        now = datetime.now()
-        if last:
-            last_dt = datetime.fromisoformat(last)
-        else:
-            last_dt = now
-            p["last_business_claim"] = now.isoformat()
-        
-        minutes = max(0, int((now - last_dt).total_seconds() // 60))
-        owned = p.get("businesses", {})
-        total_income = 0
-        
-        for biz_id, meta in owned.items():
-            base = BUSINESSES.get(biz_id, {}).get("income_per_min", 0)
-            level = meta.get("level", 1)
-            total_income += base * level * minutes
-        
-        p["gold"] += total_income
-        p["last_business_claim"] = now.isoformat()
-        save_players()
+        total_income, minutes = claim_business_income(p)
+        journal_record(p, "biz_claim", *BUSINESS_FIELDS)
+        save_players(p)
         
         await safe_edit_message_text(
             query,
@@ -2387,8 +4240,10 @@ async def businesses_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
         p["gold"] -= cost
         for biz_id in owned.keys():
             owned[biz_id]["level"] = owned[biz_id].get("level", 1) + 1
+        invalidate_business_income(p)
         
-        save_players()
+        journal_record(p, "biz_upgrade_all", *BUSINESS_FIELDS)
+        save_players(p)
         await safe_edit_message_text(
             query,
             f"✅ Все бизнесы улучшены!\n"
@@ -2420,7 +4275,9 @@ async def businesses_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
         
         p["gold"] -= upgrade_cost
         p["businesses"][biz_id]["level"] = p["businesses"][biz_id].get("level", 1) + 1
-        save_players()
+        invalidate_business_income(p)
+        journal_record(p, "biz_upgrade", *BUSINESS_FIELDS)
+        save_players(p)
         
         await safe_edit_message_text(
             query,
@@ -2453,13 +4310,15 @@ async def businesses_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
         
         p["gold"] -= price
         p.setdefault("businesses", {})[biz_id] = {"level": 1, "bought_at": datetime.now().isoformat()}
-        if not p.get("last_business_claim"):
-            p["last_business_claim"] = datetime.now().isoformat()
+        invalidate_business_income(p)
+        if last_used(p, "biz_claim") is None:
+            mark_used(p, "biz_claim")
         
         # Проверяем достижения
-        check_achievements(p, "business_check")
+        emit_event(p, "business_bought")
         
-        save_players()
+        journal_record(p, "biz_buy", *BUSINESS_FIELDS)
+        save_players(p)
         await safe_edit_message_text(
             query,
             f"💼 Куплен бизнес: {BUSINESSES[biz_id]['name']} за {price}💰.\n"
@@ -2673,7 +4532,8 @@ async def casino_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if result["success"] is not None:  # Не добавляем кулдауны
         add_casino_history(p, game_type, bet, result["success"], result.get("prize", 0))
     
-    save_players()
+    journal_record(p, "casino", *CASINO_FIELDS)
+    save_players(p)
     
     # Формируем полное сообщение
     message = (
@@ -2749,8 +4609,6 @@ async def clan_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         if join_clan(clan_name, uid):
-            save_players()
-            save_clans()
             await query.answer(f"✅ Вы присоединились к клану {clan_name}!", show_alert=True)
         else:
             await query.answer("❌ Не удалось присоединиться к клану", show_alert=True)
@@ -2766,8 +4624,6 @@ async def clan_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         clan_name = p["clan"]
         if leave_clan(uid):
-            save_players()
-            save_clans()
             await query.answer(f"✅ Вы покинули клан {clan_name}", show_alert=True)
         else:
             await query.answer("❌ Не удалось покинуть клан", show_alert=True)
@@ -2781,6 +4637,12 @@ async def clan_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await refresh_clan_message(query, p)
         return
     
+    elif action == "page":
+        if len(data) < 4 or data[2] not in CLAN_SORTS or not data[3].isdigit():
+            return
+        await refresh_clan_message(query, p, data[2], int(data[3]))
+        return
+    
     elif action == "main_menu":
         # Возвращаемся в главное меню
         await query.message.reply_text(
@@ -2839,15 +4701,13 @@ async def handle_clan_creation(update: Update, context: ContextTypes.DEFAULT_TYP
     
     # Создаем клан
     if create_clan(clan_name, uid, p["name"]):
-        save_players()
-        save_clans()
         context.user_data.pop("clan_creation", None)
         
         await msg.reply_text(
             f"🎉 <b>Клан создан!</b>\n\n"
             f"🏰 Название: {clan_name}\n"
             f"👑 Лидер: {p['name']}\n"
-            f"👥 Участников: 1/20\n\n"
+            f"👥 Участников: 1/{CLAN_MAX_MEMBERS}\n\n"
             f"Теперь другие игроки могут присоединиться к вашему клану!",
             parse_mode="HTML",
             reply_markup=MAIN_KB
@@ -2858,8 +4718,67 @@ async def handle_clan_creation(update: Update, context: ContextTypes.DEFAULT_TYP
             parse_mode="HTML"
         )
 
-async def refresh_clan_message(query, player):
+async def refresh_clan_message(query, player, sort: str = "members", page: int = 0):
     """Обновляет сообщение с информацией о кланах"""
+    text, keyboard = render_clan_screen(player, sort, page)
+    
+    await safe_edit_message_text(query, text, parse_mode="HTML", reply_markup=keyboard)
+
+# ----------------------------- Каталог кланов -----------------------------
+#
+# Список кланов показывается постранично (CLANS_PAGE_SIZE) с сортировкой по числу
+# участников или уровню. Порядок кланов для каждой сортировки и готовый текст страниц
+# кэшируются и сбрасываются invalidate_clan_directory() при создании клана, вступлении
+# и выходе. Отрисовка страницы читает только кланы этой страницы.
+
+CLANS_PAGE_SIZE = 10
+CLAN_SORTS = {
+    "members": ("👥 По участникам", lambda clan: len(clan["members"])),
+    "level": ("📊 По уровню", lambda clan: clan["level"]),
+}
+
+_clan_directory: Dict[str, Dict[Any, Any]] = {"order": {}, "pages": {}}
+
+def invalidate_clan_directory() -> None:
+    _clan_directory["order"].clear()
+    _clan_directory["pages"].clear()
+
+def _clan_order(sort: str) -> List[str]:
+    order = _clan_directory["order"].get(sort)
+    if order is None:
+        key = CLAN_SORTS[sort][1]
+        # sorted устойчив: при равенстве кланы идут в порядке создания
+        order = _clan_directory["order"][sort] = sorted(clans, key=lambda name: key(clans[name]), reverse=True)
+    return order
+
+def render_clan_directory(sort: str, page: int) -> tuple:
+    """Текст страницы каталога кланов. Возвращает (текст, номер страницы, число страниц)."""
+    order = _clan_order(sort)
+    pages = max(1, -(-len(order) // CLANS_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    text = _clan_directory["pages"].get((sort, page))
+    if text is None:
+        if not order:
+            text = (
+                "🏰 <b>Кланы:</b>\n\n"
+                "Пока нет созданных кланов.\n"
+                "Создайте свой клан!"
+            )
+        else:
+            text = f"🏰 <b>Доступные кланы</b> ({page + 1}/{pages}, {CLAN_SORTS[sort][0].lower()}):\n\n"
+            for clan_name in order[page * CLANS_PAGE_SIZE:(page + 1) * CLANS_PAGE_SIZE]:
+                clan = clans[clan_name]
+                text += f"{clan['color']} <b>{clan['name']}</b>\n"
+                text += f"👥 Участников: {len(clan['members'])}/{CLAN_MAX_MEMBERS}\n"
+                text += f"👑 Лидер: {players[clan['leader']]['name']}\n\n"
+        _clan_directory["pages"][(sort, page)] = text
+    return text, page, pages
+
+def render_clan_screen(player: Dict[str, Any], sort: str = "members", page: int = 0) -> tuple:
+    """Экран кланов: сведения о своём клане или страница каталога. Возвращает (текст, клавиатура)."""
+    if sort not in CLAN_SORTS:
+        sort = "members"
+    pages = 1
     if player.get("clan"):
         # Показать информацию о клане
         clan_name = player["clan"]
@@ -2868,38 +4787,76 @@ async def refresh_clan_message(query, player):
             text = (
                 f"🏰 <b>Клан: {clan['name']}</b>\n\n"
                 f"👑 Лидер: {players[clan['leader']]['name']}\n"
-                f"👥 Участников: {len(clan['members'])}/20\n"
+                f"👥 Участников: {len(clan['members'])}/{CLAN_MAX_MEMBERS}\n"
                 f"📊 Уровень: {clan['level']}\n"
                 f"⭐ XP: {clan['xp']}\n"
                 f"📝 Описание: {clan['description']}\n\n"
             )
             
-            if clan["leader"] == str(query.from_user.id):
+            if clan["leader"] == player["uid"]:
                 text += "👑 Вы лидер клана"
             else:
                 text += "👤 Вы участник клана"
         else:
             text = "❌ Ошибка: клан не найден"
             player.pop("clan", None)  # Удаляем несуществующий клан
-            save_players()
+            journal_record(player, "clan_missing", "clan")
+            save_players(player)
     else:
-        # Показать список кланов
-        if not clans:
-            text = (
-                "🏰 <b>Кланы:</b>\n\n"
-                "Пока нет созданных кланов.\n"
-                "Создайте свой клан!"
-            )
-        else:
-            text = "🏰 <b>Доступные кланы:</b>\n\n"
-            for clan_name, clan in clans.items():
-                text += f"{clan['color']} <b>{clan['name']}</b>\n"
-                text += f"👥 Участников: {len(clan['members'])}/20\n"
-                text += f"👑 Лидер: {players[clan['leader']]['name']}\n\n"
-    
-    # Создаем клавиатуру с кнопками
-    keyboard = build_clans_keyboard(player)
-    
+        # Показать страницу каталога кланов
+        text, page, pages = render_clan_directory(sort, page)
+    
+    return text, build_clans_keyboard(player, sort, page, pages)
+
+# ----------------------------- Рейтинги: /top -----------------------------
+
+TOP_SIZE = 10
+
+def render_top(board_name: str, player: Dict[str, Any]) -> tuple:
+    """Текст и клавиатура рейтинга: топ-TOP_SIZE и место игрока (или его клана)."""
+    board = leaderboards[board_name]
+    text = f"🏆 <b>Рейтинг: {LEADERBOARDS[board_name]}</b>\n\n"
+    top = board.top(TOP_SIZE)
+    if not top:
+        text += "Пока пусто.\n"
+    for place, (key, value) in enumerate(top, 1):
+        title = key if board_name == "clans" else players[key]["name"]
+        text += f"{place}. {title} — <b>{value}</b>\n"
+    
+    key = player.get("clan") if board_name == "clans" else player["uid"]
+    rank = board.rank(key) if key else None
+    if rank is not None:
+        text += f"\n📍 {'Ваш клан' if board_name == 'clans' else 'Вы'}: #{rank} из {len(board)} ({board.value(key)})"
+    elif board_name == "clans":
+        text += "\n📍 Вы не состоите в клане"
+    
+    keyboard = InlineKeyboardMarkup([[
+        InlineKeyboardButton(("• " if name == board_name else "") + label, callback_data=f"top:{name}")
+        for name, label in LEADERBOARDS.items()
+    ]])
+    return text, keyboard
+
+async def top_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Рейтинги игроков: /top [level|gold|pvp|clans]"""
+    uid = str(update.effective_user.id)
+    if uid not in players:
+        await update.message.reply_text("Сначала нажми /start")
+        return
+    board_name = context.args[0] if context.args and context.args[0] in LEADERBOARDS else "level"
+    text, keyboard = render_top(board_name, players[uid])
+    await update.message.reply_text(text, parse_mode="HTML", reply_markup=keyboard)
+
+async def top_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    uid = str(query.from_user.id)
+    if uid not in players:
+        await safe_edit_message_text(query, "Сначала нажми /start")
+        return
+    board_name = query.data.split(":")[1]
+    if board_name not in LEADERBOARDS:
+        return
+    text, keyboard = render_top(board_name, players[uid])
     await safe_edit_message_text(query, text, parse_mode="HTML", reply_markup=keyboard)
 
 # ----------------------------- Бой: callback-и -------------------------------
@@ -2922,7 +4879,7 @@ async def battle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     action = query.data # battle:attack | battle:ability | battle:potion | battle:run
 
     # Получаем характеристики с учетом бонусов питомцев
-    stats_with_pets = get_player_stats_with_pets(p)
+    stats_with_pets = get_derived_stats(p)
 
     log = ""
     if action == "battle:attack":
@@ -2933,7 +4890,7 @@ async def battle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if state.get("ability_used"):
             log += "Способность уже использована в этом бою!\n"
         else:
-            cls = p["class"]
+            cls = p.class_
             if cls == "⚔️ Воин":
                 dmg = dmg_roll(stats_with_pets["attack"], enemy["defense"]) * 2
                 enemy["hp"] -= dmg
@@ -2965,7 +4922,7 @@ async def battle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Проверка смерти врага
     if enemy["hp"] <= 0:
-        loot_text = grant_rewards(p, enemy["xp"], enemy["gold"], enemy.get("loot"))
+        loot_text = grant_rewards(p, enemy["xp"], enemy["gold"], enemy.get("loot"), event="enemy_killed")
         quest_text = update_quests_on_enemy_kill(p, enemy.get("type", ""))
 
         await safe_edit_message_text(query, f"Ты победил {enemy['name']}! {loot_text}{quest_text}")
@@ -2975,20 +4932,22 @@ async def battle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Ход врага (если жив)
     if enemy["hp"] > 0 and action != "battle:run":
         edmg = dmg_roll(enemy["attack"], stats_with_pets["defense"])
-        p["hp"] -= edmg
-        save_players()
+        p.hp -= edmg
+        journal_record(p, "battle_hit", "hp")
+        save_players(p)
         log += f"{enemy['name']} атакует и наносит {edmg} урона.\n"
 
     # Проверка смерти игрока
-    if p["hp"] <= 0:
-        loss_gold = min(10, p["gold"])
-        p["gold"] -= loss_gold
-        p["hp"] = max(1, p["max_hp"] // 2)
-        save_players()
+    if p.hp <= 0:
+        loss_gold = min(10, p.gold)
+        p.gold -= loss_gold
+        p.hp = max(1, p.max_hp // 2)
+        journal_record(p, "battle_lost", "gold", "hp")
+        save_players(p)
         await safe_edit_message_text(
             query,
             f"Ты пал в бою... Потеряно {loss_gold} золота. "
-            f"Ты приходишь в себя с {p['hp']}/{p['max_hp']} HP."
+            f"Ты приходишь в себя с {p.hp}/{p.max_hp} HP."
         )
         context.user_data.pop("battle", None)
         return
@@ -3101,9 +5060,9 @@ async def handle_bulk_purchase(update: Update, context: ContextTypes.DEFAULT_TYP
         return
     
     p = players[uid]
-    item_name = context.user_data.get("bulk_buy_item")
+    iid = item_id(context.user_data.get("bulk_buy_item") or "")
     
-    if not item_name or item_name not in SHOP_ITEMS:
+    if iid is None:
         context.user_data.pop("bulk_buy_item", None)
         context.user_data.pop("awaiting_bulk_amount", None)
         await update.message.reply_text("❌ Ошибка: товар не найден", reply_markup=MAIN_KB)
@@ -3117,6 +5076,7 @@ async def handle_bulk_purchase(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("❌ Введите корректное количество (число больше 0)")
         return
     
+    item_name = ITEM_NAMES[iid]
     price = SHOP_ITEMS[item_name]["price"]
     total_cost = price * amount
     
@@ -3131,7 +5091,8 @@ async def handle_bulk_purchase(update: Update, context: ContextTypes.DEFAULT_TYP
     
     # Выполняем покупку
     p["gold"] -= total_cost
-    add_item(p, item_name, amount)
+    add_item(p, iid, amount)
+    journal_record(p, "shop_buy", "gold")
     
     emoji = SHOP_ITEMS[item_name].get("emoji", "📦")
     
@@ -3148,7 +5109,7 @@ async def handle_bulk_purchase(update: Update, context: ContextTypes.DEFAULT_TYP
     context.user_data.pop("bulk_buy_item", None)
     context.user_data.pop("awaiting_bulk_amount", None)
 
-def build_clans_keyboard(player: Dict[str, Any]) -> InlineKeyboardMarkup:
+def build_clans_keyboard(player: Dict[str, Any], sort: str = "members", page: int = 0, pages: int = 1) -> InlineKeyboardMarkup:
     """Клавиатура для управления кланами"""
     keyboard = []
     
@@ -3159,20 +5120,34 @@ def build_clans_keyboard(player: Dict[str, Any]) -> InlineKeyboardMarkup:
         # Игрок не в клане
         keyboard.append([InlineKeyboardButton("🏗️ Создать клан", callback_data="clan:create")])
         
-        # Кнопки для присоединения к существующим кланам
-        available_clans = []
-        player_id = str(next((k for k, v in players.items() if v is player), None) or "")
-        for clan_name, clan in clans.items():
-            if len(clan['members']) < 20 and player_id not in clan['members']:
-                available_clans.append(clan_name)
+        # Кнопки для присоединения к существующим кланам: берём первые из индекса
+        # кланов со свободными местами, не перебирая ни игроков, ни все кланы
+        player_id = player["uid"]
+        available_clans = list(itertools.islice(
+            (name for name in joinable_clans if player_id not in clans[name]["members"]), 5
+        ))
         
         if available_clans:
-            for clan_name in available_clans[:5]:  # Максимум 5 кнопок
+            for clan_name in available_clans:  # Максимум 5 кнопок
                 clan = clans[clan_name]
                 keyboard.append([InlineKeyboardButton(
                     f"➕ Присоединиться к {clan['name']}",
                     callback_data=f"clan:join:{clan_name}"
                 )])
+        
+        # Листание и сортировка каталога
+        if pages > 1:
+            nav = []
+            if page > 0:
+                nav.append(InlineKeyboardButton("⬅️", callback_data=f"clan:page:{sort}:{page - 1}"))
+            if page < pages - 1:
+                nav.append(InlineKeyboardButton("➡️", callback_data=f"clan:page:{sort}:{page + 1}"))
+            keyboard.append(nav)
+        if clans:
+            keyboard.append([
+                InlineKeyboardButton(("• " if key == sort else "") + label, callback_data=f"clan:page:{key}:0")
+                for key, (label, _) in CLAN_SORTS.items()
+            ])
     
     keyboard.append([InlineKeyboardButton("🔄 Обновить", callback_data="clan:refresh")])
     keyboard.append([InlineKeyboardButton("🏠 Главное меню", callback_data="clan:main_menu")])
@@ -3233,7 +5208,8 @@ async def spend_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         p["gold"] -= cost
         p["xp"] += xp_gain
-        save_players()
+        journal_record(p, "spend_training", "gold", "xp")
+        save_players(p)
         await safe_edit_message_text(
             query,
             f"📘 Тренировка завершена: +{xp_gain} XP. Баланс: {p['gold']}💰",
@@ -3248,7 +5224,8 @@ async def spend_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         p["gold"] -= cost
         p["attack"] += 1
-        save_players()
+        journal_record(p, "spend_attack", "gold", "attack")
+        save_players(p)
         await safe_edit_message_text(
             query,
             f"⚒ Атака увеличена на 1. Баланс: {p['gold']}💰",
@@ -3263,7 +5240,8 @@ async def spend_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         p["gold"] -= cost
         p["defense"] += 1
-        save_players()
+        journal_record(p, "spend_defense", "gold", "defense")
+        save_players(p)
         await safe_edit_message_text(
             query,
             f"🛡 Защита увеличена на 1. Баланс: {p['gold']}💰",
@@ -3296,7 +5274,8 @@ async def spend_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 gold_gain = random.randint(50, 200)
                 p["gold"] += gold_gain
                 reward_text = f"💰 Возврат: +{gold_gain} золота"
-        save_players()
+        journal_record(p, "spend_lootbox", "gold", "pets")
+        save_players(p)
         await safe_edit_message_text(
             query,
             f"🎁 Кейс открыт! {reward_text}\nТекущий баланс: {p['gold']}💰",
@@ -3315,7 +5294,8 @@ async def spend_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         p["gold"] -= amount
         xp_gain = amount // 2
         p["xp"] += xp_gain
-        save_players()
+        journal_record(p, "spend_donate", "gold", "xp")
+        save_players(p)
         await safe_edit_message_text(
             query,
             f"🎗 Спасибо за щедрость! Потрачено {amount}💰, получено +{xp_gain} XP.\nБаланс: {p['gold']}💰",
@@ -3344,69 +5324,408 @@ async def quest_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await quests_cmd(update, context)
         return
     
+    elif data[1] == "page" and len(data) > 2 and data[2].isdigit():
+        await quests_cmd(update, context, int(data[2]))
+        return
+    
     elif data[1] == "new":
         # Проверяем количество активных квестов
-        active_quests = sum(1 for q in p["quests"].values() if q.get("status") == "active")
-        if active_quests >= 3:
+        if count_active_quests(p) >= 3:
             await query.answer("❌ У вас уже максимальное количество активных квестов (3)", show_alert=True)
             return
         
         # Генерируем новый квест
         new_quest = generate_random_quest(p["level"])
         quest_id = f"random_quest_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        p["quests"][quest_id] = {
+        add_quest(p, quest_id, {
             **new_quest,
             "progress": 0,
             "status": "active"
-        }
-        save_players()
+        })
+        journal_record(p, "quest_new", "quests")
+        save_players(p)
         
         await query.answer(f"🎯 Новый квест получен: {new_quest['title']}", show_alert=True)
         await quests_cmd(update, context)
         return
 
+# ----------------------------- Лимит исходящих запросов -----------------------------
+#
+# Telegram ограничивает бота ~30 сообщениями в секунду всего, ~1 в секунду на личный чат
+# и ~20 в минуту на группу; превышение даёт 429. Все запросы бота с chat_id проходят
+# через PriorityRateLimiter: общий и поканальные token bucket'ы и очередь с приоритетами.
+# Правки сообщений (ходы боя и дуэли) по умолчанию идут раньше новых сообщений, а
+# рассылки помечаются rate_limit_args=PRIORITY_BULK и ждут, пока остальные уйдут.
+# Запросы без chat_id (answerCallbackQuery, getMe, setWebhook) не ограничиваются.
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+RATE_LIMIT_OVERALL = float(os.getenv("RATE_LIMIT_OVERALL", "30"))
+RATE_LIMIT_PER_CHAT = float(os.getenv("RATE_LIMIT_PER_CHAT", "1"))
+RATE_LIMIT_PER_GROUP = float(os.getenv("RATE_LIMIT_PER_GROUP", str(20 / 60)))
+RATE_LIMIT_CHAT_BURST = int(os.getenv("RATE_LIMIT_CHAT_BURST", "3"))
+
+class TokenBucket:
+    """rate токенов в секунду, не больше capacity про запас."""
+
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = now
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд появится токен (0 — уже есть)."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+class PriorityRateLimiter(BaseRateLimiter[int]):
+    """Очередь исходящих запросов: меньший приоритет уходит раньше, внутри — по порядку."""
+
+    # Сколько поканальных bucket'ов держать, прежде чем выбросить простаивающие
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, overall_rate: float = RATE_LIMIT_OVERALL, chat_rate: float = RATE_LIMIT_PER_CHAT,
+                 group_rate: float = RATE_LIMIT_PER_GROUP, chat_burst: int = RATE_LIMIT_CHAT_BURST):
+        self.overall_rate = overall_rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self._overall: Optional[TokenBucket] = None
+        self._chats: Dict[Any, TokenBucket] = {}
+        self._queue: List[tuple] = []
+        self._seq = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self.stats = {
+            "requests": 0, "queued": 0, "max_depth": 0,
+            "wait_total_ms": 0.0, "wait_max_ms": 0.0,
+            "by_priority": {PRIORITY_INTERACTIVE: 0, PRIORITY_NORMAL: 0, PRIORITY_BULK: 0},
+        }
+
+    async def initialize(self) -> None:
+        loop = asyncio.get_running_loop()
+        self._overall = TokenBucket(self.overall_rate, self.overall_rate, loop.time())
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        # Ждущие запросы отпускаем без ограничения, чтобы не зависнуть при остановке
+        for entry in self._queue:
+            if not entry[3].done():
+                entry[3].set_result(None)
+        self._queue.clear()
+
+    def _chat_bucket(self, chat_id: Any, now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.MAX_CHAT_BUCKETS:
+                self._chats = {key: b for key, b in self._chats.items() if not b.full(now)}
+            # Отрицательный chat_id — группа или канал
+            rate = self.group_rate if isinstance(chat_id, int) and chat_id < 0 else self.chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.chat_burst, now)
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None or self._dispatcher is None:
+            return await callback(*args, **kwargs)
+        if rate_limit_args is not None:
+            priority = rate_limit_args
+        else:
+            priority = PRIORITY_INTERACTIVE if endpoint.startswith("edit") else PRIORITY_NORMAL
+        self.stats["requests"] += 1
+        self.stats["by_priority"][priority] = self.stats["by_priority"].get(priority, 0) + 1
+
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        bucket = self._chat_bucket(chat_id, now)
+        if not self._queue and self._overall.delay(now) <= 0 and bucket.delay(now) <= 0:
+            # Очереди нет и токены есть — отправляем сразу
+            self._overall.take(now)
+            bucket.take(now)
+        else:
+            waiter = loop.create_future()
+            heapq.heappush(self._queue, (priority, self._seq, chat_id, waiter))
+            self._seq += 1
+            self.stats["queued"] += 1
+            self.stats["max_depth"] = max(self.stats["max_depth"], len(self._queue))
+            self._wakeup.set()
+            await waiter
+            waited_ms = (loop.time() - now) * 1000
+            self.stats["wait_total_ms"] += waited_ms
+            self.stats["wait_max_ms"] = max(self.stats["wait_max_ms"], waited_ms)
+        return await callback(*args, **kwargs)
+
+    async def _dispatch(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = loop.time()
+            delay = self._overall.delay(now)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            # Первый по приоритету запрос, чей чат не исчерпал лимит
+            chosen, deferred, retry_in = None, [], None
+            while self._queue:
+                entry = heapq.heappop(self._queue)
+                if entry[3].done():
+                    continue  # обработчик отменён
+                chat_delay = self._chat_bucket(entry[2], now).delay(now)
+                if chat_delay <= 0:
+                    chosen = entry
+                    break
+                deferred.append(entry)
+                retry_in = chat_delay if retry_in is None else min(retry_in, chat_delay)
+            for entry in deferred:
+                heapq.heappush(self._queue, entry)
+            if chosen is None:
+                if retry_in is not None:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), retry_in)
+                    except asyncio.TimeoutError:
+                        pass
+                continue
+            self._overall.take(now)
+            self._chat_bucket(chosen[2], now).take(now)
+            chosen[3].set_result(None)
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self.stats)
+        stats["depth"] = len(self._queue)
+        stats["chats"] = len(self._chats)
+        stats["wait_avg_ms"] = stats["wait_total_ms"] / stats["queued"] if stats["queued"] else 0.0
+        return stats
+
+rate_limiter = PriorityRateLimiter()
+
 # --------------------------------- Main --------------------------------------
 
-def main():
-    load_players()
-    load_clans()
+# Фоновые задачи, которые останавливаются вместе с ботом (кроме компактора журнала)
+_background: Dict[str, asyncio.Task] = {}
+
+async def on_startup(app) -> None:
+    """Запускает фоновые задачи бота."""
+    if JOURNAL_ENABLED:
+        _journal["compactor"] = asyncio.create_task(journal_compactor())
+    _background["business_income"] = asyncio.create_task(business_income_aggregator())
+    _background["timers"] = asyncio.create_task(timer_loop(app))
+
+async def on_stop(app) -> None:
+    """Досылает склеенные правки сообщений, пока бот ещё может отправлять запросы."""
+    await flush_message_edits()
+
+async def on_shutdown(app) -> None:
+    """Записывает накопленные изменения перед остановкой бота."""
+    compactor = _journal.pop("compactor", None)
+    if compactor is not None:
+        compactor.cancel()
+    for task in _background.values():
+        task.cancel()
+    _background.clear()
+    await stop_persistence()
+    close_journal()
+    storage.close()
+    stats = get_save_stats()
+    print(
+        f"Saved: {stats['flushes']} flushes for {stats['requests']} save requests, "
+        f"avg {stats['avg_ms']:.1f} ms, max {stats['max_ms']:.1f} ms"
+    )
+
+# ----------------------------- Webhook (FastAPI) -----------------------------
+#
+# python gamecode_ru.py --webhook запускает бота за FastAPI/uvicorn вместо run_polling().
+# Telegram присылает обновления POST-запросом на WEBHOOK_PATH; они сразу кладутся в
+# update_queue приложения. Если задан WEBHOOK_URL, вебхук регистрируется в Telegram при
+# старте. Для локальной проверки достаточно отправить записанный JSON обновления:
+#   curl -X POST localhost:8080/telegram -H 'Content-Type: application/json' -d @update.json
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+
+webhook_stats = {"received": 0, "rejected": 0, "invalid": 0}
+
+def get_metrics() -> Dict[str, Any]:
+    """Сводка счётчиков для /metrics."""
+    return {
+        "saves": get_save_stats(),
+        "player_cache": get_player_cache_stats(),
+        "locks": {"users": len(user_locks), "duels": len(duel_locks)},
+        "webhook": dict(webhook_stats),
+        "rate_limiter": rate_limiter.get_stats(),
+        "edit_retries": dict(retry_stats),
+        "edit_coalescing": get_coalesce_stats(),
+        "render_cache": get_render_stats(),
+        "keyboard_cache": get_keyboard_stats(),
+        "leaderboards": {name: len(board) for name, board in leaderboards.items()},
+        "business_income": dict(business_totals),
+        "timers": get_timer_stats(),
+        "pvp": {"requests": len(pvp_requests), "duels": len(active_duels)},
+    }
+
+def create_webhook_app(application):
+    """FastAPI-приложение, которое запускает и останавливает PTB Application вместе с собой."""
+    from contextlib import asynccontextmanager
+
+    from fastapi import FastAPI, Request, Response
+
+    @asynccontextmanager
+    async def lifespan(_):
+        await application.initialize()
+        if application.post_init:
+            await application.post_init(application)
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=Update.ALL_TYPES,
+            )
+        await application.start()
+        try:
+            yield
+        finally:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+            await application.shutdown()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+
+    api = FastAPI(lifespan=lifespan)
+
+    @api.post(WEBHOOK_PATH)
+    async def telegram_webhook(request: Request) -> Response:
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            webhook_stats["rejected"] += 1
+            return Response(status_code=403)
+        try:
+            update = Update.de_json(await request.json(), application.bot)
+        except Exception:
+            webhook_stats["invalid"] += 1
+            return Response(status_code=400)
+        webhook_stats["received"] += 1
+        await application.update_queue.put(update)
+        return Response(status_code=200)
+
+    @api.get("/health")
+    async def health() -> Dict[str, Any]:
+        return {
+            "status": "ok" if application.running else "starting",
+            "update_queue": application.update_queue.qsize(),
+            "pending_saves": len(_dirty_players) + len(_dirty_clans),
+        }
+
+    @api.get("/metrics")
+    async def metrics() -> Dict[str, Any]:
+        metrics = get_metrics()
+        metrics["update_queue"] = application.update_queue.qsize()
+        return metrics
+
+    return api
+
+def run_webhook(application) -> None:
+    import uvicorn
+
+    print(f"Bot is running (webhook on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH})...")
+    uvicorn.run(create_webhook_app(application), host=WEBHOOK_HOST, port=WEBHOOK_PORT)
+
+def build_application(webhook: bool = False):
     token = os.getenv('BOT_TOKEN', 'YOUR_TOKEN_BOT')
-    app = ApplicationBuilder().token(token).build()
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+        .rate_limiter(rate_limiter)
+        # Разные игроки обрабатываются параллельно, один игрок — по очереди (per_user)
+        .concurrent_updates(True)
+    )
+    if webhook:
+        # Обновления приходят через FastAPI, Updater для long polling не нужен
+        builder = builder.updater(None)
+    app = builder.build()
 
     # Основные команды
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("help", help_cmd))
-    app.add_handler(CommandHandler("status", status_cmd))
-    app.add_handler(CommandHandler("inventory", inventory_cmd))
-    app.add_handler(CommandHandler("use_potion", use_potion_cmd))
-    app.add_handler(CommandHandler("quests", quests_cmd))
-    app.add_handler(CommandHandler("adventure", adventure_cmd))
-    app.add_handler(CommandHandler("shop", shop_cmd))
-    app.add_handler(CommandHandler("casino", casino_cmd))
-    app.add_handler(CommandHandler("achievements", achievements_cmd))
-    app.add_handler(CommandHandler("daily", daily_cmd))
-    app.add_handler(CommandHandler("pets", pets_cmd))
-    app.add_handler(CommandHandler("clans", clans_cmd))
-    app.add_handler(CommandHandler("pvp", pvp_cmd))
-    app.add_handler(CommandHandler("pvp_challenge", pvp_challenge_cmd))
-    app.add_handler(CommandHandler("business", businesses_cmd))
-    app.add_handler(CommandHandler("spend", spend_cmd))
+    app.add_handler(CommandHandler("start", per_user(start)))
+    app.add_handler(CommandHandler("help", per_user(help_cmd)))
+    app.add_handler(CommandHandler("status", per_user(status_cmd)))
+    app.add_handler(CommandHandler("inventory", per_user(inventory_cmd)))
+    app.add_handler(CommandHandler("use_potion", per_user(use_potion_cmd)))
+    app.add_handler(CommandHandler("quests", per_user(quests_cmd)))
+    app.add_handler(CommandHandler("adventure", per_user(adventure_cmd)))
+    app.add_handler(CommandHandler("shop", per_user(shop_cmd)))
+    app.add_handler(CommandHandler("casino", per_user(casino_cmd)))
+    app.add_handler(CommandHandler("achievements", per_user(achievements_cmd)))
+    app.add_handler(CommandHandler("daily", per_user(daily_cmd)))
+    app.add_handler(CommandHandler("pets", per_user(pets_cmd)))
+    app.add_handler(CommandHandler("clans", per_user(clans_cmd)))
+    app.add_handler(CommandHandler("top", per_user(top_cmd)))
+    app.add_handler(CommandHandler("pvp", per_user(pvp_cmd)))
+    app.add_handler(CommandHandler("pvp_challenge", per_user(pvp_challenge_cmd)))
+    app.add_handler(CommandHandler("business", per_user(businesses_cmd)))
+    app.add_handler(CommandHandler("spend", per_user(spend_cmd)))
     
     # Обработчики callback'ов
-    app.add_handler(CallbackQueryHandler(battle_callback, pattern=r"^battle:"))
-    app.add_handler(CallbackQueryHandler(shop_callback, pattern=r"^shop:"))
-    app.add_handler(CallbackQueryHandler(casino_callback, pattern=r"^casino:"))
-    app.add_handler(CallbackQueryHandler(clan_callback, pattern=r"^clan:"))
-    app.add_handler(CallbackQueryHandler(businesses_callback, pattern=r"^biz:"))
-    app.add_handler(CallbackQueryHandler(spend_callback, pattern=r"^spend:"))
-    app.add_handler(CallbackQueryHandler(quest_callback, pattern=r"^quest:"))
-    app.add_handler(CallbackQueryHandler(pvp_callback, pattern=r"^pvp:"))
+    app.add_handler(CallbackQueryHandler(per_user(battle_callback), pattern=r"^battle:"))
+    app.add_handler(CallbackQueryHandler(per_user(shop_callback), pattern=r"^shop:"))
+    app.add_handler(CallbackQueryHandler(per_user(casino_callback), pattern=r"^casino:"))
+    app.add_handler(CallbackQueryHandler(per_user(clan_callback), pattern=r"^clan:"))
+    app.add_handler(CallbackQueryHandler(per_user(top_callback), pattern=r"^top:"))
+    app.add_handler(CallbackQueryHandler(per_user(businesses_callback), pattern=r"^biz:"))
+    app.add_handler(CallbackQueryHandler(per_user(spend_callback), pattern=r"^spend:"))
+    app.add_handler(CallbackQueryHandler(per_user(quest_callback), pattern=r"^quest:"))
+    app.add_handler(CallbackQueryHandler(per_user(pvp_callback), pattern=r"^pvp:"))
     
     # Обработчик текстовых сообщений (включая ставки для казино)
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_router))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, per_user(text_router)))
+    return app
 
+def main():
+    load_players()
+    load_clans()
+    build_leaderboards()
+    flush_all()
+    if "--webhook" in sys.argv:
+        run_webhook(build_application(webhook=True))
+        return
+    app = build_application()
     print("Bot is running...")
     app.run_polling()
 
 if __name__ == "__main__":
-    main()
+    if "--migrate" in sys.argv:
+        print(f"Migrated {migrate_storage()} player records to schema v{SCHEMA_VERSION}")
+    else:
+        main()
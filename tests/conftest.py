@@ -0,0 +1,56 @@
+"""Общие фикстуры: каждый тест работает с чистым состоянием модуля в своём каталоге.
+
+Запуск из корня репозитория: python -m pytest tests
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import gamecode_ru as game_module  # noqa: E402
+
+
+def _reset_state(game) -> None:
+    game.close_journal()
+    game._journal.update(segment=None, last_mark=-1, held={}, failed=[])
+    game._dirty_players.clear()
+    game._dirty_clans.clear()
+    game._save_state.update(all_players=False, clans=False, handle=None, inflight={}, taken=0)
+    game.pvp_requests.clear()
+    game.active_duels.clear()
+    game.user_to_duel.clear()
+    for name in game.leaderboards:
+        game.leaderboards[name] = game.Leaderboard()
+    game._clan_contrib.clear()
+
+
+@pytest.fixture
+def game(tmp_path, monkeypatch):
+    """Модуль бота с файлами данных и журналом во временном каталоге."""
+    # Пути к данным относительные, поэтому достаточно сменить каталог
+    monkeypatch.chdir(tmp_path)
+    _reset_state(game_module)
+    monkeypatch.setattr(game_module, "storage", game_module.JsonStorage())
+    monkeypatch.setattr(game_module, "players", game_module.PlayerRepository(game_module.storage, None))
+    monkeypatch.setattr(game_module, "clans", {})
+    yield game_module
+    game_module.storage.close()
+    _reset_state(game_module)
+
+
+@pytest.fixture
+def restart(game, monkeypatch):
+    """Имитирует перезапуск бота: память очищается, данные читаются заново."""
+    def _restart(mode: str = "json", cache_size=None) -> None:
+        game.storage.close()
+        _reset_state(game)
+        if cache_size is not None:
+            monkeypatch.setattr(game, "PLAYER_CACHE_SIZE", cache_size)
+        monkeypatch.setattr(game, "storage", game.create_storage(mode))
+        game.load_players()
+        game.load_clans()
+        game.build_leaderboards()
+        game.flush_all()
+    return _restart
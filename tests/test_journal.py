@@ -0,0 +1,117 @@
+def _legacy_player(uid: str, gold: int) -> dict:
+    return {"name": f"Игрок {uid}", "class": None, "level": 1, "xp": 0, "hp": 100, "max_hp": 100,
+            "attack": 5, "defense": 3, "gold": gold, "inventory": {}, "quests": {}}
+
+
+def _sharded_players(game, count: int, gold: int = 50):
+    game.storage = game.create_storage("sharded")
+    game.storage.write_players({str(i): _legacy_player(str(i), gold) for i in range(count)}, None)
+    game.players = game.PlayerRepository(game.storage, None)
+    return [game.players[str(i)] for i in range(count)]
+
+
+def _set_gold(game, player, gold: int) -> None:
+    player["gold"] = gold
+    game.journal_record(player, "test", "gold")
+    game.save_players(player)
+
+
+def _finish(game, batch, ok: bool) -> None:
+    if ok:
+        game._write_batch(batch)
+    else:
+        batch["elapsed_ms"] = 0.0
+    game._finish_batch(batch, ok)
+
+
+def _stored_gold(game) -> dict:
+    return {uid: record["gold"] for uid, record in game.storage._load_dir(game.storage.players_dir).items()}
+
+
+def _journaled_gold(game) -> dict:
+    return {entry["u"]: entry["set"]["gold"] for entry in game._journal_entries() if "u" in entry}
+
+
+def test_replay_keeps_players_evicted_during_replay(game, restart):
+    # Снимок с gold=50, журнал с более новым золотом у пяти игроков
+    for i, player in enumerate(_sharded_players(game, 5)):
+        _set_gold(game, player, 1000 + i)
+    game.close_journal()
+
+    # Кэш меньше числа доигрываемых игроков
+    restart("sharded", cache_size=2)
+
+    assert _stored_gold(game) == {str(i): 1000 + i for i in range(5)}
+    assert game.journal_segments() == []
+
+
+def test_records_after_snapshot_survive_discard(game):
+    first, second = _sharded_players(game, 2)
+    _set_gold(game, first, 100)
+    batch = game._take_batch()
+    _set_gold(game, second, 200)
+
+    _finish(game, batch, ok=True)
+
+    assert _journaled_gold(game) == {"1": 200}
+
+
+def test_failed_batch_keeps_its_journal_until_retried(game):
+    first, second = _sharded_players(game, 2)
+    _set_gold(game, first, 100)
+    failed = game._take_batch()
+    _set_gold(game, second, 200)
+    # Следующий пакет снят до того, как стало известно об ошибке первого
+    overlapping = game._take_batch()
+
+    _finish(game, failed, ok=False)
+    _finish(game, overlapping, ok=True)
+    # Запись первого игрока ещё не на диске — его строка журнала нужна
+    assert _stored_gold(game) == {"0": 50, "1": 200}
+    assert _journaled_gold(game)["0"] == 100
+
+    retry = game._take_batch()
+    _finish(game, retry, ok=True)
+    assert _stored_gold(game) == {"0": 100, "1": 200}
+    assert game.journal_segments() == []
+
+
+def test_legacy_single_file_journal_is_replayed(game, restart):
+    (player,) = _sharded_players(game, 1)
+    with open(game.JOURNAL_FILE, "w", encoding="utf-8") as f:
+        f.write('{"t":0,"u":"0","op":"test","set":{"gold":777}}\n')
+
+    restart("sharded")
+
+    assert _stored_gold(game) == {"0": 777}
+    assert game.journal_segments() == []
+
+
+def test_clan_mutations_are_replayed(game, restart):
+    for uid in ("1", "2"):
+        game.players[uid] = game.Player(_legacy_player(uid, 0))
+        game.upgrade_player(uid, game.players[uid])
+    game.flush_all()
+    assert game.create_clan("Клан", "1", "Игрок 1")
+    assert game.join_clan("Клан", "2")
+    # Снимок не записан: кланы и игроки восстанавливаются только из журнала
+    game._dirty_players.clear()
+    game._dirty_clans.clear()
+    game.close_journal()
+
+    restart()
+    assert list(game.clans["Клан"]["members"]) == ["1", "2"]
+    assert game.players["2"]["clan"] == "Клан"
+    assert game.leaderboards["clans"].value("Клан") == 2
+
+
+def test_torn_last_line_is_skipped(game):
+    player = game.Player(_legacy_player("1", 0))
+    game.upgrade_player("1", player)
+    _set_gold(game, player, 7)
+    _set_gold(game, player, 8)
+    game.close_journal()
+    path = game.journal_segments()[-1][1]
+    with open(path, "rb+") as f:
+        f.truncate(f.seek(0, 2) - 5)
+    assert _journaled_gold(game) == {"1": 7}
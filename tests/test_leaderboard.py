@@ -0,0 +1,72 @@
+"""Рейтинги: порядок, значения по умолчанию и построение при старте."""
+import os
+
+
+def test_leaderboard_orders_by_value_then_id(game):
+    board = game.Leaderboard()
+    board.update("b", 5)
+    board.update("a", 5)
+    board.update("c", 7)
+    assert board.top() == [("c", 7), ("a", 5), ("b", 5)]
+    assert board.rank("b") == 3
+
+    board.update("b", 9)
+    board.remove("c")
+    assert board.top() == [("b", 9), ("a", 5)]
+    assert board.rank("c") is None
+    assert len(board) == 2
+
+
+def test_empty_values_rank_as_defaults(game):
+    # NULL в sqlite или поле старой записи — уровень 1, 0 золота и побед
+    game._track_row("old", None, None, None, None)
+    game._track_row("new", 3, 10, 2, "Клан")
+    assert game.leaderboards["level"].top() == [("new", 3), ("old", 1)]
+    assert game.leaderboards["gold"].value("old") == 0
+    assert game.leaderboards["pvp"].rank("old") == 2
+    assert game.leaderboards["clans"].top() == [("Клан", 3)]
+
+
+def test_clan_rating_follows_member_moves(game):
+    game._track_row("1", 4, 0, 0, "A")
+    game._track_row("2", 2, 0, 0, "A")
+    game._track_row("1", 5, 0, 0, "B")
+    assert game.leaderboards["clans"].top() == [("B", 5), ("A", 2)]
+    game._track_row("2", 2, 0, 0, None)
+    assert game.leaderboards["clans"].top() == [("B", 5)]
+
+
+def _sharded(game, count):
+    storage = game.ShardedStorage()
+    records = {str(uid): {"uid": str(uid), "level": uid + 1, "gold": uid * 10, "pvp_wins": 0}
+               for uid in range(count)}
+    storage.write_players(records, list(records))
+    return storage
+
+
+def test_sharded_fresh_start_without_data(game, restart):
+    restart("sharded")
+    assert len(game.leaderboards["level"]) == 0
+
+
+def test_sharded_ranks_come_from_rank_index(game):
+    _sharded(game, 20)
+    storage = game.ShardedStorage()
+    # Файлы игроков не читаются, пока индексы свежие
+    storage._load_shard = None
+    rows = sorted(storage.ranked_rows(), key=lambda row: int(row[0]))
+    assert len(rows) == 20
+    assert rows[3] == ("3", 4, 30, 0, None)
+
+
+def test_sharded_stale_rank_index_is_rebuilt(game):
+    storage = _sharded(game, 5)
+    # Файл игрока записан, а индекс — нет (падение между ними)
+    path = storage._path(storage.players_dir, "2")
+    game._atomic_write_json(path, {"uid": "2", "level": 50, "gold": 0, "pvp_wins": 0})
+    index_path = os.path.join(storage.rank_dir, f"{storage._shard('2')}.json")
+    os.utime(index_path, (0, 0))
+
+    rows = {row[0]: row for row in game.ShardedStorage().ranked_rows()}
+    assert rows["2"][1] == 50
+    assert len(rows) == 5
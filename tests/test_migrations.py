@@ -0,0 +1,63 @@
+"""Версии схемы игрока: записи без "v" доводятся до SCHEMA_VERSION."""
+from datetime import datetime
+
+
+def _v0_player():
+    # Запись из первых версий бота: инвентарь по названиям, даты строками ISO
+    return {
+        "name": "Старый",
+        "level": 3,
+        "gold": 10,
+        "inventory": {"Малое зелье лечения": 2},
+        "achievements": {"first_blood": True},
+        "quests": {
+            "q1": {"title": "Готово", "status": "completed"},
+            "q2": {"title": "В пути", "status": "active"},
+        },
+        "last_daily_reward": "2024-01-02T03:04:05",
+        "casino_wins_streak": 2,
+        "casino_total_wins": 4,
+    }
+
+
+def test_v0_record_is_upgraded_to_current_schema(game):
+    player = _v0_player()
+    assert game.upgrade_player("7", player) is True
+    assert player["uid"] == "7"
+    assert player["v"] == game.SCHEMA_VERSION
+    # v0: недостающие поля
+    assert player["pvp_wins"] == 0 and player["pets"] == [] and player["clan"] is None
+    # v1: предметы по ID
+    assert player["inventory"] == {game.item_id("Малое зелье лечения"): 2}
+    # v2: таймеры в секундах эпохи
+    assert "last_daily_reward" not in player and "last_business_claim" not in player
+    assert player["timers"] == {"daily": datetime(2024, 1, 2, 3, 4, 5).timestamp()}
+    # v3: счётчики достижений
+    assert player["counters"] == {"kills": 1, "casino_wins": 4, "quests_completed": 1}
+    assert "casino_wins_streak" not in player
+    # v4: выполненные квесты в архиве
+    assert list(player["quests"]) == ["q2"]
+    assert player["quest_archive"] == [{"id": "q1", "title": "Готово", "t": None}]
+
+
+def test_current_record_is_left_alone(game):
+    player = _v0_player()
+    game.upgrade_player("7", player)
+    snapshot = dict(player)
+    assert game.upgrade_player("7", player) is False
+    assert player == snapshot
+
+
+def test_migration_resumes_from_stored_version(game):
+    # Запись версии 4 (до архива квестов): применяется только последний шаг
+    player = {"v": 4, "quests": {"q": {"title": "Т", "status": "completed"}}, "counters": {}}
+    game.upgrade_player("1", player)
+    assert player["quests"] == {}
+    assert player["counters"] == {}
+    assert "pets" not in player
+
+
+def test_unknown_inventory_items_are_kept(game):
+    player = {"inventory": {"Пропавший предмет": 1, "Малое зелье лечения": 1}}
+    game._migrate_v1(player)
+    assert player["inventory"] == {"Пропавший предмет": 1, game.item_id("Малое зелье лечения"): 1}
@@ -0,0 +1,60 @@
+"""Лимит исходящих запросов: очередь отдаёт запросы по приоритету, внутри — по порядку."""
+import asyncio
+
+
+def _send_all(game, requests):
+    """Отправляет requests [(метка, endpoint, приоритет или None), ...]; возвращает порядок ухода."""
+    # Токен на чат восполняется за 10 мс: после первого запроса остальные встают в очередь
+    limiter = game.PriorityRateLimiter(overall_rate=1000, chat_rate=100, chat_burst=1)
+    sent = []
+
+    async def run():
+        await limiter.initialize()
+
+        def request(label, endpoint, priority):
+            async def callback():
+                sent.append(label)
+            return limiter.process_request(callback, (), {}, endpoint, {"chat_id": 1}, priority)
+
+        try:
+            await asyncio.gather(*(request(*args) for args in requests))
+        finally:
+            await limiter.shutdown()
+
+    asyncio.run(run())
+    return sent, limiter.get_stats()
+
+
+def test_queued_requests_leave_in_priority_order(game):
+    sent, stats = _send_all(game, [
+        ("first", "sendMessage", None),
+        ("bulk", "sendMessage", game.PRIORITY_BULK),
+        ("normal", "sendMessage", None),
+        ("edit", "editMessageText", None),
+    ])
+    # Первый ушёл сразу; правка (по умолчанию интерактивная) обгоняет очередь
+    assert sent == ["first", "edit", "normal", "bulk"]
+    assert stats["queued"] == 3 and stats["depth"] == 0
+
+
+def test_same_priority_keeps_arrival_order(game):
+    sent, _ = _send_all(game, [(f"m{i}", "sendMessage", game.PRIORITY_NORMAL) for i in range(5)])
+    assert sent == [f"m{i}" for i in range(5)]
+
+
+def test_requests_without_chat_bypass_the_queue(game):
+    limiter = game.PriorityRateLimiter(overall_rate=1000, chat_rate=100, chat_burst=1)
+
+    async def run():
+        await limiter.initialize()
+
+        async def callback():
+            return "ok"
+
+        try:
+            return await limiter.process_request(callback, (), {}, "answerCallbackQuery", {}, None)
+        finally:
+            await limiter.shutdown()
+
+    assert asyncio.run(run()) == "ok"
+    assert limiter.get_stats()["requests"] == 0
@@ -0,0 +1,36 @@
+"""Записи со слотами: интерфейс словаря и преобразование в JSON и обратно."""
+import json
+
+
+def test_player_behaves_like_dict(game):
+    player = game.Player({"uid": "1", "gold": 5, "class": "Воин", "custom": True})
+    assert player["gold"] == 5 and player.gold == 5
+    # "class" — ключевое слово, слот называется class_
+    assert player["class"] == "Воин" and player.class_ == "Воин"
+    assert "level" not in player and player.get("level", 1) == 1
+    assert player.extra == {"custom": True}
+    assert player.setdefault("pets", []) == [] and "pets" in player
+    assert player.pop("custom") is True and "custom" not in player
+    del player["pets"]
+    assert set(player) == {"uid", "gold", "class"}
+
+
+def test_player_inventory_keys_survive_json(game):
+    player = game.Player({"uid": "1", "inventory": {1: 2, "старый предмет": 1}})
+    data = json.loads(json.dumps(player.to_dict(), ensure_ascii=False))
+    assert data["inventory"] == {"1": 2, "старый предмет": 1}
+    restored = game.Player.from_dict(data)
+    assert restored["inventory"] == {1: 2, "старый предмет": 1}
+    assert game.Player.from_dict(restored) is restored
+
+
+def test_decode_without_decoded_fields_returns_input(game):
+    data = {"gold": 1}
+    assert game.Player.decode(data) is data
+
+
+def test_clan_members_are_an_ordered_set_on_disk_a_list(game):
+    clan = game.Clan.from_dict({"name": "A", "leader": "2", "members": ["2", "1"]})
+    assert clan["members"] == {"2": None, "1": None}
+    clan["members"]["3"] = None
+    assert clan.to_dict()["members"] == ["2", "1", "3"]
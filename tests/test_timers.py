@@ -0,0 +1,60 @@
+"""Колесо таймеров: срабатывание по дедлайну, перенос и отмена."""
+
+
+def _cb(app, key):
+    return None
+
+
+def test_timer_fires_after_its_deadline(game):
+    wheel = game.TimerWheel(tick=1, slots=8)
+    wheel.schedule("duel", 2.5, _cb, now=100)
+    assert wheel.advance(now=101) == []
+    assert wheel.advance(now=102.4) == []
+    assert wheel.advance(now=102.5) == [("duel", _cb)]
+    assert "duel" not in wheel and len(wheel) == 0
+    assert wheel.advance(now=110) == []
+
+
+def test_rescheduling_replaces_the_timer(game):
+    wheel = game.TimerWheel(tick=1, slots=8)
+    wheel.schedule("req", 1, _cb, now=0)
+    wheel.schedule("req", 5, _cb, now=0)
+    assert len(wheel) == 1
+    assert wheel.advance(now=2) == []
+    assert [key for key, _ in wheel.advance(now=5)] == ["req"]
+
+
+def test_cancelled_timer_never_fires(game):
+    wheel = game.TimerWheel(tick=1, slots=8)
+    wheel.schedule("req", 1, _cb, now=0)
+    assert wheel.cancel("req") is True
+    assert wheel.cancel("req") is False
+    assert wheel.advance(now=5) == []
+    assert wheel.stats["cancelled"] == 1
+
+
+def test_timers_beyond_one_revolution_wait_for_their_deadline(game):
+    wheel = game.TimerWheel(tick=1, slots=4)
+    wheel.advance(now=0)
+    wheel.schedule("far", 10, _cb, now=0)
+    wheel.schedule("near", 1, _cb, now=0)
+    # Слот "far" просматривается раньше, но дедлайн ещё не наступил
+    assert [key for key, _ in wheel.advance(now=3)] == ["near"]
+    assert wheel.advance(now=9) == []
+    assert [key for key, _ in wheel.advance(now=10)] == ["far"]
+
+
+def test_long_pause_fires_everything_overdue(game):
+    wheel = game.TimerWheel(tick=1, slots=4)
+    wheel.advance(now=0)
+    for delay in range(1, 7):
+        wheel.schedule(f"t{delay}", delay, _cb, now=0)
+    assert sorted(key for key, _ in wheel.advance(now=100)) == [f"t{d}" for d in range(1, 7)]
+    assert wheel.stats["fired"] == 6
+
+
+def test_deadline_in_the_past_fires_on_next_advance(game):
+    wheel = game.TimerWheel(tick=1, slots=4)
+    wheel.advance(now=50)
+    wheel.schedule("late", -5, _cb, now=50)
+    assert [key for key, _ in wheel.advance(now=50)] == ["late"]